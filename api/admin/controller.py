@@ -32,7 +32,10 @@ from config import (
 
 from oauth import GoogleAuthService
 
-from api.controller import CirculationManagerController
+from api.controller import (
+    CirculationManagerController,
+    streaming_feed_response,
+)
 from api.coverage import MetadataWranglerCoverageProvider
 from core.app_server import entry_response
 from core.app_server import (
@@ -495,7 +498,7 @@ class FeedController(CirculationManagerController):
             url=this_url, annotator=annotator,
             pagination=pagination
         )
-        return feed_response(opds_feed)    
+        return streaming_feed_response(opds_feed)    
 
     def suppressed(self):
         this_url = self.url_for('suppressed')
@@ -508,7 +511,7 @@ class FeedController(CirculationManagerController):
             url=this_url, annotator=annotator,
             pagination=pagination
         )
-        return feed_response(opds_feed)
+        return streaming_feed_response(opds_feed)
 
     def genres(self):
         data = dict({
@@ -1,6 +1,9 @@
 from nose.tools import set_trace
 
-from api.opds import CirculationManagerAnnotator
+from api.opds import (
+    CirculationManagerAnnotator,
+    StreamingAcquisitionFeed,
+)
 from core.lane import Facets, Pagination
 from core.model import BaseMaterializedWork, LicensePool
 from core.opds import AcquisitionFeed
@@ -77,7 +80,7 @@ class AdminAnnotator(CirculationManagerAnnotator):
         feed.add_link(**search_link)
 
 
-class AdminFeed(AcquisitionFeed):
+class AdminFeed(StreamingAcquisitionFeed):
 
     @classmethod
     def complaints(cls, _db, title, url, annotator, pagination=None):
@@ -115,7 +118,7 @@ class AdminFeed(AcquisitionFeed):
             feed.add_link(rel="previous", href=annotator.complaints_url(facets, previous_page))
 
         annotator.annotate_feed(feed)
-        return unicode(feed)
+        return feed
 
     @classmethod
     def suppressed(cls, _db, title, url, annotator, pagination=None):
@@ -150,5 +153,5 @@ class AdminFeed(AcquisitionFeed):
             feed.add_link(rel="previous", href=annotator.suppressed_url(previous_page))
 
         annotator.annotate_feed(feed)
-        return unicode(feed)
+        return feed
             
@@ -0,0 +1,223 @@
+from nose.tools import set_trace
+import datetime
+
+from sqlalchemy import (
+    DateTime,
+    case,
+    func,
+    literal,
+    or_,
+)
+from sqlalchemy.orm import contains_eager
+
+from core.model import (
+    get_one_or_create,
+    CirculationEvent,
+    DataSource,
+    Hold,
+    Identifier,
+    LicensePool,
+    Loan,
+    Timestamp,
+)
+from core.monitor import Monitor
+
+
+class AvailabilityRefreshSchedule(object):
+    """Decide which books from one source most need their availability
+    refreshed.
+
+    Every LicensePool gets a priority score: the hours since it was
+    last checked, multiplied by one plus its demand. Demand counts
+    recent checkouts and holds, current local loans and holds, and the
+    vendor's own hold queue. A popular book's score grows faster than
+    a long-tail book's, so it's refreshed more often.
+
+    Once a book has gone `staleness_cap` without a check, waiting
+    longer doesn't make it any more urgent, so a stale book nobody
+    wants can't push a popular book out of the way. (Those books are
+    still checked eventually; see DemandWeightedRefreshMonitor.)
+
+    Books that have never been checked always come first, and books
+    checked within `minimum_interval` are left alone.
+    """
+
+    # Recent circulation events within this window count as demand.
+    DEMAND_WINDOW = datetime.timedelta(days=7)
+
+    RECENT_CHECKOUT_WEIGHT = 1
+    RECENT_HOLD_WEIGHT = 1
+    LOAN_WEIGHT = 2
+    HOLD_WEIGHT = 2
+    HOLD_QUEUE_WEIGHT = 1
+
+    NEVER_CHECKED = datetime.datetime(1970, 1, 1)
+
+    def __init__(self, _db, data_source_name, identifier_type,
+                 staleness_cap=datetime.timedelta(days=1),
+                 minimum_interval=datetime.timedelta(minutes=15)):
+        self._db = _db
+        self.data_source = DataSource.lookup(_db, data_source_name)
+        self.identifier_type = identifier_type
+        self.staleness_cap = staleness_cap
+        self.minimum_interval = minimum_interval
+
+    def _count_by_pool(self, column, pool_id_column, *filters):
+        return self._db.query(
+            pool_id_column.label('license_pool_id'),
+            func.count(column).label('count')
+        ).filter(*filters).group_by(pool_id_column).subquery()
+
+    def next_batch(self, size, now=None, exclude=None):
+        """Find the `size` Identifiers most in need of a refresh.
+
+        Their LicensePools are loaded along with them.
+
+        :param exclude: IDs of Identifiers that shouldn't be included,
+        because they're being refreshed anyway.
+        """
+        now = now or datetime.datetime.utcnow()
+        recent = now - self.DEMAND_WINDOW
+        recent_checkouts = self._count_by_pool(
+            CirculationEvent.id, CirculationEvent.license_pool_id,
+            CirculationEvent.type==CirculationEvent.CHECKOUT,
+            CirculationEvent.start > recent
+        )
+        recent_holds = self._count_by_pool(
+            CirculationEvent.id, CirculationEvent.license_pool_id,
+            CirculationEvent.type==CirculationEvent.HOLD_PLACE,
+            CirculationEvent.start > recent
+        )
+        loans = self._count_by_pool(Loan.id, Loan.license_pool_id)
+        holds = self._count_by_pool(Hold.id, Hold.license_pool_id)
+
+        demand = (
+            self.RECENT_CHECKOUT_WEIGHT * func.coalesce(recent_checkouts.c.count, 0)
+            + self.RECENT_HOLD_WEIGHT * func.coalesce(recent_holds.c.count, 0)
+            + self.LOAN_WEIGHT * func.coalesce(loans.c.count, 0)
+            + self.HOLD_WEIGHT * func.coalesce(holds.c.count, 0)
+            + self.HOLD_QUEUE_WEIGHT * func.coalesce(
+                LicensePool.patrons_in_hold_queue, 0)
+        )
+        hours_since_checked = func.extract(
+            'epoch', literal(now, DateTime) - func.coalesce(
+                LicensePool.last_checked, literal(self.NEVER_CHECKED, DateTime)
+            )
+        ) / 3600.0
+        staleness_cap_hours = self.staleness_cap.total_seconds() / 3600.0
+        priority = func.least(
+            hours_since_checked, staleness_cap_hours) * (1 + demand)
+
+        qu = self._db.query(Identifier).join(Identifier.licensed_through)
+        for subquery in (recent_checkouts, recent_holds, loans, holds):
+            qu = qu.outerjoin(
+                subquery, subquery.c.license_pool_id==LicensePool.id)
+        qu = qu.filter(
+            LicensePool.data_source==self.data_source).filter(
+                Identifier.type==self.identifier_type).filter(
+                    or_(LicensePool.last_checked==None,
+                        LicensePool.last_checked < now - self.minimum_interval)
+                )
+        if exclude:
+            qu = qu.filter(~Identifier.id.in_(exclude))
+        qu = qu.options(
+            contains_eager(Identifier.licensed_through)
+        ).order_by(
+            case([(LicensePool.last_checked==None, 0)], else_=1),
+            priority.desc(), Identifier.id
+        ).limit(size)
+        return qu.all()
+
+
+class DemandWeightedRefreshMonitor(Monitor):
+    """Refresh availability for the books that most need it, using a
+    sweep monitor's identifier_query() and process_batch() to do the
+    actual work.
+
+    Each run refreshes at most `batches_per_run` batches, so the
+    request budget stays the same no matter how big the collection
+    is. The first batch continues an ID-order pass through the whole
+    collection, so every book is checked eventually and books the
+    vendor no longer has are reaped. The schedule decides how to spend
+    the rest of the budget. Ranking the books is expensive, so it's
+    done once per run, for every batch at once.
+
+    If `batch_size` is None, the sweep's own batch size is used.
+    """
+
+    def __init__(self, _db, name, sweep, data_source_name, identifier_type,
+                 interval_seconds=60, batch_size=50, batches_per_run=10,
+                 staleness_cap=datetime.timedelta(days=1),
+                 minimum_interval=datetime.timedelta(minutes=15)):
+        super(DemandWeightedRefreshMonitor, self).__init__(
+            _db, name, interval_seconds=interval_seconds)
+        self.sweep = sweep
+        self._batch_size = batch_size
+        self.batches_per_run = batches_per_run
+        self.reap_cursor_service = "%s reap cursor" % name
+        self.schedule = AvailabilityRefreshSchedule(
+            _db, data_source_name, identifier_type,
+            staleness_cap=staleness_cap,
+            minimum_interval=minimum_interval
+        )
+
+    @property
+    def batch_size(self):
+        return self._batch_size or self.sweep.batch_size
+
+    def reap_cursor(self):
+        """Find or create the Timestamp that tracks how far the ID-order
+        pass has gotten.
+
+        Its counter is the ID of the last Identifier checked.
+        """
+        cursor, is_new = get_one_or_create(
+            self._db, Timestamp, service=self.reap_cursor_service
+        )
+        return cursor
+
+    def reap_batch(self):
+        """Find the next batch of Identifiers in the ID-order pass, and
+        move the cursor past them.
+        """
+        cursor = self.reap_cursor()
+        identifiers = self.sweep.identifier_query().filter(
+            Identifier.id > (cursor.counter or 0)
+        ).order_by(Identifier.id).limit(self.batch_size).all()
+        if len(identifiers) < self.batch_size:
+            # We've reached the end of the collection. Start over
+            # next time.
+            cursor.counter = 0
+        else:
+            cursor.counter = identifiers[-1].id
+        return identifiers
+
+    def run_once(self, start, cutoff):
+        batches = []
+        reap = self.reap_batch()
+        if reap:
+            batches.append(reap)
+        ranked_size = self.batch_size * (self.batches_per_run - len(batches))
+        if ranked_size > 0:
+            ranked = self.schedule.next_batch(
+                ranked_size, exclude=[x.id for x in reap]
+            )
+            for i in range(0, len(ranked), self.batch_size):
+                batches.append(ranked[i:i+self.batch_size])
+
+        refreshed = 0
+        for identifiers in batches:
+            self.sweep.process_batch(identifiers)
+            # Mark every book as checked, even if the vendor said the
+            # same thing as last time and nothing else was written, so
+            # the schedule moves on to other books.
+            now = datetime.datetime.utcnow()
+            for identifier in identifiers:
+                if identifier.licensed_through:
+                    identifier.licensed_through.last_checked = now
+            self._db.commit()
+            refreshed += len(identifiers)
+        # The reap cursor may have moved even if there was nothing to
+        # refresh.
+        self._db.commit()
+        self.log.info("Refreshed availability for %d books.", refreshed)
@@ -50,6 +50,8 @@ from circulation import (
     BaseCirculationAPI
 )
 from circulation_exceptions import *
+from payload_fingerprint import PayloadFingerprints
+from availability_refresh import DemandWeightedRefreshMonitor
 
 
 class Axis360API(BaseAxis360API, Authenticator, BaseCirculationAPI):
@@ -208,6 +210,7 @@ class Axis360CirculationMonitor(Monitor):
             default_start_time = self.VERY_LONG_AGO
         )
         self.batch_size = batch_size
+        self.fingerprints = PayloadFingerprints()
         metadata_wrangler_url = Configuration.integration_url(
                 Configuration.METADATA_WRANGLER_INTEGRATION
         )
@@ -231,15 +234,50 @@ class Axis360CirculationMonitor(Monitor):
         if status_code != 200:
             raise Exception(
                 "Got status code %d from API: %s" % (status_code, content))
+        self.fingerprints.rollback()
         count = 0
         for bibliographic, circulation in BibliographicParser().process_all(
                 content):
             self.process_book(bibliographic, circulation)
             count += 1
             if count % self.batch_size == 0:
-                self._db.commit()
+                self.commit()
+        self.commit()
+
+    def commit(self):
+        """Commit the books processed so far, and trust their
+        fingerprints from now on.
+        """
+        self._db.commit()
+        self.fingerprints.commit()
+
+    @classmethod
+    def availability_payload(cls, availability):
+        """The parts of a book's availability information that are
+        fingerprinted to see whether anything changed.
+
+        Bibliographic information isn't included. It's only applied to
+        new books, and two parses of the same response don't
+        necessarily produce identical Metadata objects.
+        """
+        return [
+            availability.licenses_owned, availability.licenses_available,
+            availability.licenses_reserved, availability.patrons_in_hold_queue,
+        ]
 
     def process_book(self, bibliographic, availability):
+        """Apply bibliographic and availability information for a book.
+
+        :return: A 2-tuple (edition, license_pool), or (None, None) if
+        the availability information is the same as what we applied and
+        committed last time, in which case nothing is done.
+        """
+        identifier = bibliographic.primary_identifier
+        key = (identifier.type, identifier.identifier)
+        payload = self.availability_payload(availability)
+        if self.fingerprints.unchanged(key, payload):
+            return None, None
+
         license_pool, new_license_pool = bibliographic.license_pool(self._db)
         edition, new_edition = bibliographic.edition(self._db)
         license_pool.edition = edition
@@ -252,6 +290,7 @@ class Axis360CirculationMonitor(Monitor):
                 replace_formats=True,
             )
         availability.update(license_pool, new_license_pool)
+        self.fingerprints.remember(key, payload)
         return edition, license_pool
 
 
@@ -278,6 +317,23 @@ class AxisCollectionReaper(IdentifierSweepMonitor):
         self.api.update_licensepools_for_identifiers(identifiers)
 
 
+class AxisAvailabilityRefresh(DemandWeightedRefreshMonitor):
+    """Keep availability fresh for the Axis 360 books patrons are
+    most interested in, while still checking the whole collection
+    over time.
+    """
+
+    def __init__(self, _db, interval_seconds=60):
+        super(AxisAvailabilityRefresh, self).__init__(
+            _db, "Axis Availability Refresh", AxisCollectionReaper(_db),
+            DataSource.AXIS_360, Identifier.AXIS_360_ID,
+            interval_seconds=interval_seconds)
+
+    def run(self):
+        self.sweep.api = Axis360API(self._db)
+        super(AxisAvailabilityRefresh, self).run()
+
+
 class ResponseParser(Axis360Parser):
 
     id_type = Identifier.AXIS_360_ID
@@ -352,7 +352,7 @@ class CirculationAPI(object):
             raise NoOpenAccessDownload()
 
         rep = fulfillment.resource.representation
-        cdn_host = Configuration.cdn_host(Configuration.CDN_OPEN_ACCESS_CONTENT)
+        cdn_host = Configuration.snapshot().open_access_cdn_host
         content_link = cdnify(rep.url, cdn_host)
         media_type = rep.media_type
         return FulfillmentInfo(
@@ -0,0 +1,120 @@
+from nose.tools import set_trace
+from collections import OrderedDict
+import gzip
+import hashlib
+import logging
+import threading
+from StringIO import StringIO
+
+try:
+    import brotli
+except ImportError, e:
+    brotli = None
+
+
+def gzip_compress(data):
+    out = StringIO()
+    f = gzip.GzipFile(fileobj=out, mode='wb', mtime=0)
+    f.write(data)
+    f.close()
+    return out.getvalue()
+
+
+class CompressedVariants(object):
+    """Keep compressed copies of documents we serve over and over, so
+    that each version of a document is only compressed once.
+
+    Variants are keyed by a digest of the uncompressed document, so a
+    cached feed that hasn't changed since the last request will find
+    its variants waiting, and a feed that has been regenerated will
+    get new ones.
+    """
+
+    # Content-Encodings we can produce, most preferred first.
+    ENCODERS = OrderedDict()
+    if brotli:
+        ENCODERS['br'] = brotli.compress
+    ENCODERS['gzip'] = gzip_compress
+
+    # Documents smaller than this aren't worth compressing.
+    MINIMUM_SIZE = 1024
+
+    def __init__(self, max_documents=500):
+        self.max_documents = max_documents
+        self._variants = OrderedDict()
+        self._lock = threading.Lock()
+        self.log = logging.getLogger("Compressed variants")
+
+    def variants(self, data):
+        """Find or create a dictionary mapping Content-Encoding to the
+        compressed version of `data`.
+        """
+        key = hashlib.sha1(data).digest()
+        with self._lock:
+            variants = self._variants.pop(key, None)
+            if variants is not None:
+                # Mark this document as recently used.
+                self._variants[key] = variants
+                return variants
+
+        variants = dict(
+            (encoding, encoder(data))
+            for encoding, encoder in self.ENCODERS.items()
+        )
+
+        with self._lock:
+            self._variants[key] = variants
+            while len(self._variants) > self.max_documents:
+                self._variants.popitem(last=False)
+        return variants
+
+    @classmethod
+    def acceptable_encodings(cls, accept_encoding):
+        """Parse an Accept-Encoding header into the list of encodings we
+        can produce that the client will take, best first.
+        """
+        if not accept_encoding:
+            return []
+        q_values = {}
+        for part in accept_encoding.split(','):
+            pieces = [x.strip() for x in part.split(';')]
+            encoding = pieces[0].lower()
+            q = 1.0
+            for param in pieces[1:]:
+                if param.startswith('q='):
+                    try:
+                        q = float(param[2:])
+                    except ValueError, e:
+                        q = 0
+            q_values[encoding] = q
+
+        wildcard = q_values.get('*', 0)
+        acceptable = []
+        for encoding in cls.ENCODERS:
+            q = q_values.get(encoding, wildcard)
+            if q > 0:
+                acceptable.append((q, encoding))
+        # Sort by q-value, keeping our own preference order for ties.
+        acceptable.sort(key=lambda x: -x[0])
+        return [encoding for q, encoding in acceptable]
+
+    def compress_response(self, response, accept_encoding):
+        """Replace the body of a Flask response with the best compressed
+        variant the client will accept.
+        """
+        if (response.status_code != 200 or response.is_streamed
+            or 'Content-Encoding' in response.headers):
+            return response
+        response.vary.add('Accept-Encoding')
+
+        data = response.get_data()
+        if len(data) < self.MINIMUM_SIZE:
+            return response
+        encodings = self.acceptable_encodings(accept_encoding)
+        if not encodings:
+            return response
+
+        encoding = encodings[0]
+        response.set_data(self.variants(data)[encoding])
+        response.headers['Content-Encoding'] = encoding
+        return response
@@ -1,6 +1,7 @@
 import re
 from nose.tools import set_trace
 import contextlib
+from collections import namedtuple
 from core.config import (
     Configuration as CoreConfiguration,
     CannotLoadConfiguration,
@@ -114,6 +115,70 @@ class Configuration(CoreConfiguration):
         CoreConfiguration.load()
         cls.instance = CoreConfiguration.instance
 
+    # The most recently built ConfigurationSnapshot, and the
+    # configuration object it was built from.
+    _snapshot = None
+    _snapshot_source = None
+
+    @classmethod
+    def snapshot(cls):
+        """Return a ConfigurationSnapshot of the current configuration.
+
+        The snapshot is only rebuilt if the configuration has been
+        replaced since the last call, so this is cheap enough to call
+        once per entry. Code that changes the configuration in place
+        must call refresh_snapshot() itself.
+        """
+        if cls._snapshot is None or cls._snapshot_source is not cls.instance:
+            cls.refresh_snapshot()
+        return cls._snapshot
+
+    @classmethod
+    def refresh_snapshot(cls):
+        """Rebuild the ConfigurationSnapshot from the current
+        configuration.
+        """
+        cls._snapshot = ConfigurationSnapshot.from_configuration(cls)
+        cls._snapshot_source = cls.instance
+        return cls._snapshot
+
+
+class ConfigurationSnapshot(namedtuple(
+        'ConfigurationSnapshot', [
+            'hold_policy', 'open_access_cdn_host', 'configuration_links'
+        ])):
+    """An immutable copy of the configuration values consulted while
+    rendering OPDS entries and documents.
+
+    :param configuration_links: A tuple of (rel, href) 2-tuples for the
+    terms of service, privacy policy, copyright and about pages.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_configuration(cls, configuration=Configuration):
+        links = []
+        for rel, value in (
+                ("terms-of-service", configuration.terms_of_service_url()),
+                ("privacy-policy", configuration.privacy_policy_url()),
+                ("copyright", configuration.acknowledgements_url()),
+                ("about", configuration.about_url()),
+        ):
+            if value:
+                links.append((rel, value))
+        return cls(
+            hold_policy=configuration.hold_policy(),
+            open_access_cdn_host=configuration.cdn_host(
+                configuration.CDN_OPEN_ACCESS_CONTENT
+            ),
+            configuration_links=tuple(links),
+        )
+
+    @property
+    def holds_allowed(self):
+        return self.hold_policy == Configuration.HOLD_POLICY_ALLOW
+
 
 @contextlib.contextmanager
 def empty_config():
@@ -1,12 +1,16 @@
 from nose.tools import set_trace
+import datetime
+import hashlib
 import json
 import logging
 import sys
+import time
 import urllib
 import urlparse
 import uuid
 
 from lxml import etree
+from sqlalchemy import tuple_
 
 from functools import wraps
 import flask
@@ -14,6 +18,7 @@ from flask import (
     Response,
     redirect,
 )
+from werkzeug.http import parse_options_header
 
 from core.app_server import (
     entry_response,
@@ -47,6 +52,7 @@ from core.model import (
     Hold,
     Identifier,
     Loan,
+    LicensePool,
     LicensePoolDeliveryMechanism,
     production_session,
 )
@@ -66,9 +72,13 @@ from circulation_exceptions import *
 from config import Configuration
 
 from opds import (
+    BulkLookupFeed,
+    ChangesFeed,
     CirculationManagerAnnotator,
+    CompactCirculationManagerAnnotator,
     CirculationManagerLoanAndHoldAnnotator,
     PreloadFeed,
+    StreamingAcquisitionFeed,
 )
 from problem_details import *
 
@@ -92,11 +102,57 @@ from threem import (
     ThreeMAPI,
     DummyThreeMAPI,
 )
+from compression import CompressedVariants
 from circulation import (
     CirculationAPI,
     DummyCirculationAPI,
 )
+from opds2 import OPDS2Serializer
+from pagination import load_keyset_pagination_from_request
+from rate_limit import RateLimiter
+from search_cache import CachingSearchClient
 from services import ServiceStatus
+from suggest import SuggestionIndex
+
+def streaming_feed_response(feed, cache_for=AcquisitionFeed.FEED_CACHE_TIME):
+    """Send a StreamingAcquisitionFeed to the client as a chunked
+    response, building each entry as it's sent.
+    """
+    if isinstance(cache_for, int):
+        cache_control = "public, no-transform, max-age=%d, s-maxage=%d" % (
+            cache_for, cache_for / 2)
+    else:
+        cache_control = "private, no-cache"
+    headers = {
+        "Content-Type" : OPDSFeed.ACQUISITION_FEED_TYPE,
+        "Cache-Control" : cache_control,
+    }
+    # Keep the request context (and with it the database session)
+    # around until the last entry has been sent.
+    content = flask.stream_with_context(feed.serialize())
+    return Response(content, 200, headers)
+
+
+def opds2_document_from_atom(content):
+    return OPDS2Serializer.to_json(OPDS2Serializer.from_atom(content))
+
+
+def opds2_response(document, cache_for=AcquisitionFeed.FEED_CACHE_TIME,
+                   media_type=OPDS2Serializer.FEED_TYPE):
+    """Send an OPDS 2 JSON document to the client."""
+    if isinstance(cache_for, int):
+        cache_control = "public, no-transform, max-age=%d, s-maxage=%d" % (
+            cache_for, cache_for / 2)
+    else:
+        cache_control = "private, no-cache"
+    if not isinstance(document, basestring):
+        document = OPDS2Serializer.to_json(document)
+    headers = {
+        "Content-Type" : media_type,
+        "Cache-Control" : cache_control,
+    }
+    return Response(document, 200, headers)
+
 
 class CirculationManager(object):
 
@@ -109,6 +165,10 @@ class CirculationManager(object):
     parent = None
     language_key = ""
 
+    # The most transformed versions of cached feeds to keep around
+    # at once.
+    MAX_TRANSFORMED_FEEDS = 500
+
     def __init__(self, _db, lanes=None, testing=False):
 
         self.log = logging.getLogger("Circulation manager web app")
@@ -121,6 +181,14 @@ class CirculationManager(object):
                 sys.exit()
         self._db = _db
 
+        # Build the configuration snapshot used by annotators and
+        # controllers now, rather than during the first request.
+        Configuration.snapshot()
+
+        # Set when the web app gets a SIGHUP; the configuration is
+        # reloaded before the next request.
+        self.reload_requested = False
+
         self.testing = testing
         if isinstance(lanes, LaneList):
             self.lanes = lanes
@@ -131,11 +199,31 @@ class CirculationManager(object):
         self.auth = Authenticator.initialize(self._db, test=testing)
         self.setup_circulation()
         self.external_search = self.setup_search()
+
+        # OpenSearch description documents, keyed by lane and URL. This
+        # is filled in as lanes are searched, since the documents
+        # contain absolute URLs that can only be generated during a
+        # request.
+        self.opensearch_documents = {}
+
+        # The most recently built preload feed, as a tuple
+        # (configuration hash, time built, content, ETag).
+        self.preload_feed = None
+
+        # Compact and OPDS 2 versions of cached feeds, keyed by the
+        # transformation and a digest of the full feed.
+        self.transformed_feeds = {}
+        self.suggestions = SuggestionIndex(self._db)
+        if not self.testing:
+            # The index keeps itself up to date in the background, so
+            # suggestion requests never wait for it.
+            self.suggestions.start()
         self.lending_policy = load_lending_policy(
             Configuration.policy('lending', {})
         )
 
         self.setup_controllers()
+        self.compressed_variants = CompressedVariants()
         self.urn_lookup_controller = URNLookupController(self._db)
         self.setup_adobe_vendor_id()
 
@@ -146,6 +234,34 @@ class CirculationManager(object):
 
         self.opds_authentication_document = self.create_authentication_document()
 
+    def reload_configuration_if_requested(self):
+        """Reload the configuration if someone asked for it (by sending
+        the web app a SIGHUP) since the last time this was called.
+        """
+        if not self.reload_requested:
+            return False
+        self.reload_requested = False
+        self.reload_configuration()
+        return True
+
+    def reload_configuration(self):
+        """Reload the configuration file and rebuild everything derived
+        from it.
+        """
+        try:
+            Configuration.load()
+        except CannotLoadConfiguration, e:
+            self.log.error("Could not reload configuration file: %s" % e)
+            return
+        # The configuration may have been loaded into the same object
+        # as before, so the snapshot has to be rebuilt explicitly.
+        Configuration.refresh_snapshot()
+        self.lending_policy = load_lending_policy(
+            Configuration.policy('lending', {})
+        )
+        self.opds_authentication_document = self.create_authentication_document()
+        self.log.info("Reloaded configuration.")
+
     def cdn_url_for(self, view, *args, **kwargs):
         return cdn_url_for(view, *args, **kwargs)
 
@@ -164,14 +280,17 @@ class CirculationManager(object):
     def setup_search(self):
         """Set up a search client."""
         if self.testing:
-            return DummyExternalSearchIndex()
+            search = DummyExternalSearchIndex()
         else:
             if Configuration.integration(
                     Configuration.ELASTICSEARCH_INTEGRATION):
-                return ExternalSearchIndex()
+                search = ExternalSearchIndex()
             else:
                 self.log.warn("No external search server configured.")
                 return None
+        # Popular queries are answered from a cache rather than going
+        # to the search cluster every time.
+        return CachingSearchClient(search, self._db)
 
     def setup_circulation(self):
         """Set up distributor APIs and a the Circulation object."""
@@ -179,6 +298,10 @@ class CirculationManager(object):
             self.circulation = DummyCirculationAPI(self._db)
         else:
             overdrive = OverdriveAPI.from_environment(self._db)
+            if overdrive:
+                # Everything the web app asks Overdrive is on behalf
+                # of a patron.
+                overdrive.rate_limit_priority = RateLimiter.PATRON
             threem = ThreeMAPI.from_environment(self._db)
             axis = Axis360API.from_environment(self._db)
             self.circulation = CirculationAPI(
@@ -194,7 +317,7 @@ class CirculationManager(object):
         self.opds_feeds = OPDSFeedController(self)
         self.loans = LoanController(self)
         self.accounts = AccountController(self)
-        self.urn_lookup = URNLookupController(self._db)
+        self.urn_lookup = WorkLookupController(self)
         self.work_controller = WorkController(self)
 
         self.heartbeat = HeartbeatController()
@@ -219,11 +342,42 @@ class CirculationManager(object):
             self.adobe_vendor_id = None
 
     def annotator(self, lane, *args, **kwargs):
-        """Create an appropriate OPDS annotator for the given lane."""
-        return CirculationManagerAnnotator(
+        """Create an appropriate OPDS annotator for the given lane.
+
+        :param compact: If this is True, the annotator will build
+        minimal entries for list views.
+        """
+        if kwargs.pop('compact', False):
+            annotator_class = CompactCirculationManagerAnnotator
+        else:
+            annotator_class = CirculationManagerAnnotator
+        return annotator_class(
             self.circulation, lane, *args, top_level_title=self.display_name, **kwargs
         )
 
+    def transformed_feed(self, content, transform):
+        """Find or create a transformed version of a cached feed, such
+        as a version with compact entries.
+        """
+        key = (transform, hashlib.sha1(content.encode("utf8")).digest())
+        transformed = self.transformed_feeds.get(key)
+        if transformed is None:
+            transformed = transform(content)
+            if len(self.transformed_feeds) >= self.MAX_TRANSFORMED_FEEDS:
+                self.transformed_feeds.clear()
+            self.transformed_feeds[key] = transformed
+        return transformed
+
+    def compact_feed(self, content):
+        """Find or create a version of a cached feed with compact entries."""
+        return self.transformed_feed(
+            content, CompactCirculationManagerAnnotator.compact_feed
+        )
+
+    def opds2_feed(self, content):
+        """Find or create an OPDS 2 JSON version of a cached feed."""
+        return self.transformed_feed(content, opds2_document_from_atom)
+
     def create_authentication_document(self):
         """Create the OPDS authentication document to be used when
         there's a 401 error.
@@ -237,14 +391,8 @@ class CirculationManager(object):
         opds_id = str(uuid.uuid3(uuid.NAMESPACE_DNS, str(netloc)))
 
         links = {}
-        for rel, value in (
-                ("terms-of-service", Configuration.terms_of_service_url()),
-                ("privacy-policy", Configuration.privacy_policy_url()),
-                ("copyright", Configuration.acknowledgements_url()),
-                ("about", Configuration.about_url()),
-        ):
-            if value:
-                links[rel] = dict(href=value, type="text/html")
+        for rel, value in Configuration.snapshot().configuration_links:
+            links[rel] = dict(href=value, type="text/html")
 
         doc = OPDSAuthenticationDocument.fill_in(
             base_opds_document, auth_type, "Library", opds_id, None, "Barcode",
@@ -263,6 +411,60 @@ class CirculationManagerController(object):
         self.url_for = self.manager.url_for
         self.cdn_url_for = self.manager.cdn_url_for
 
+    def compact_entries_requested(self):
+        """Did the client ask for compact entries?
+
+        A client can ask with a query parameter, or with a `profile`
+        parameter on one of the media types in its Accept header. In
+        the second case the response must say it varies by Accept, so
+        that a shared cache doesn't hand compact entries to a client
+        that wanted full ones.
+        """
+        parameter = CompactCirculationManagerAnnotator.PARAMETER
+        value = CompactCirculationManagerAnnotator.VALUE
+        if flask.request.args.get(parameter) == value:
+            return True
+        profile = CompactCirculationManagerAnnotator.PROFILE
+        accept = flask.request.headers.get('Accept') or ''
+        for media_range in accept.split(','):
+            media_type, options = parse_options_header(media_range)
+            if options.get('profile') != profile:
+                continue
+            try:
+                quality = float(options.get('q', 1))
+            except ValueError:
+                continue
+            if quality > 0:
+                return True
+        return False
+
+    def opds2_requested(self):
+        """Would the client rather have OPDS 2 JSON than an Atom feed?"""
+        accept = flask.request.accept_mimetypes
+        best = accept.best_match([
+            OPDSFeed.ACQUISITION_FEED_TYPE, "application/atom+xml",
+            OPDS2Serializer.FEED_TYPE, OPDS2Serializer.PUBLICATION_TYPE,
+        ])
+        return best in (
+            OPDS2Serializer.FEED_TYPE, OPDS2Serializer.PUBLICATION_TYPE
+        )
+
+    def negotiated(self, response):
+        """Note that a response's media type depends on the client's
+        Accept header, so that shared caches keep the Atom and OPDS 2
+        variants apart.
+        """
+        response.vary.add('Accept')
+        return response
+
+    def compressed(self, response):
+        """Send a cacheable document compressed, if the client can
+        take it that way.
+        """
+        return self.manager.compressed_variants.compress_response(
+            response, flask.request.headers.get('Accept-Encoding')
+        )
+
     def authenticated_patron_from_request(self):
         header = flask.request.authorization
         if not header:
@@ -373,8 +575,7 @@ class CirculationManagerController(object):
 
         if (license_pool.licenses_available == 0 and
             not license_pool.open_access and
-            Configuration.hold_policy() !=
-            Configuration.HOLD_POLICY_ALLOW
+            not Configuration.snapshot().holds_allowed
         ):
             return FORBIDDEN_BY_POLICY.detailed(
                 "Library policy prohibits the placement of holds.",
@@ -435,6 +636,15 @@ class IndexController(CirculationManagerController):
 
 class OPDSFeedController(CirculationManagerController):
 
+    # OpenSearch description documents only change when the lane
+    # tree changes.
+    OPENSEARCH_CACHE_TIME = 3600 * 24
+    OPENSEARCH_MEDIA_TYPE = "application/opensearchdescription+xml"
+
+    # How long to keep the preload feed before rebuilding it. This
+    # should be about as often as the materialized views are refreshed.
+    PRELOAD_CACHE_TIME = 600
+
     def groups(self, languages, lane_name):
         """Build or retrieve a grouped acquisition feed."""
 
@@ -449,7 +659,14 @@ class OPDSFeedController(CirculationManagerController):
 
         annotator = self.manager.annotator(lane)
         feed = AcquisitionFeed.groups(self._db, title, url, lane, annotator)
-        return feed_response(feed.content)
+        content = feed.content
+        if self.compact_entries_requested():
+            content = self.manager.compact_feed(content)
+        if self.opds2_requested():
+            response = opds2_response(self.manager.opds2_feed(content))
+        else:
+            response = feed_response(content)
+        return self.compressed(self.negotiated(response))
 
     def feed(self, languages, lane_name):
         """Build or retrieve a paginated acquisition feed."""
@@ -467,7 +684,7 @@ class OPDSFeedController(CirculationManagerController):
         facets = load_facets_from_request()
         if isinstance(facets, ProblemDetail):
             return facets
-        pagination = load_pagination_from_request()
+        pagination = load_keyset_pagination_from_request(facets)
         if isinstance(pagination, ProblemDetail):
             return pagination
         feed = AcquisitionFeed.page(
@@ -475,7 +692,14 @@ class OPDSFeedController(CirculationManagerController):
             facets=facets,
             pagination=pagination,
         )
-        return feed_response(feed.content)
+        content = feed.content
+        if self.compact_entries_requested():
+            content = self.manager.compact_feed(content)
+        if self.opds2_requested():
+            response = opds2_response(self.manager.opds2_feed(content))
+        else:
+            response = feed_response(content)
+        return self.compressed(self.negotiated(response))
 
     def search(self, languages, lane_name):
 
@@ -488,7 +712,7 @@ class OPDSFeedController(CirculationManagerController):
         )
         if not query:
             # Send the search form
-            return OpenSearchDocument.for_lane(lane, this_url)
+            return self.opensearch_document(lane, this_url)
 
         pagination = load_pagination_from_request()
         if isinstance(pagination, ProblemDetail):
@@ -496,24 +720,150 @@ class OPDSFeedController(CirculationManagerController):
 
         # Run a search.    
         this_url += "?q=" + urllib.quote(query.encode("utf8"))
-        annotator = self.manager.annotator(lane)
+        annotator = self.manager.annotator(
+            lane, compact=self.compact_entries_requested()
+        )
         info = OpenSearchDocument.search_info(lane)
         opds_feed = AcquisitionFeed.search(
             _db=self._db, title=info['name'], 
             url=this_url, lane=lane, search_engine=self.manager.external_search,
             query=query, annotator=annotator, pagination=pagination,
         )
-        return feed_response(opds_feed)
+        return self.compressed(self.negotiated(feed_response(opds_feed)))
 
-    def preload(self):
-        this_url = url_for("preload", _external=True)
+    def opensearch_document(self, lane, url):
+        """Serve the OpenSearch description document for a lane.
 
+        The document only depends on the lane and the URL, so it's
+        generated once and then served with an ETag.
+        """
+        key = (lane.language_key, lane.name, url)
+        cached = self.manager.opensearch_documents.get(key)
+        if cached is None:
+            document = unicode(OpenSearchDocument.for_lane(lane, url))
+            etag = hashlib.sha1(document.encode("utf8")).hexdigest()
+            cached = (document, etag)
+            self.manager.opensearch_documents[key] = cached
+        document, etag = cached
+
+        headers = {
+            "Content-Type" : self.OPENSEARCH_MEDIA_TYPE,
+            "Cache-Control" : "public, max-age=%d" % self.OPENSEARCH_CACHE_TIME,
+            "ETag" : '"%s"' % etag,
+        }
+        if flask.request.if_none_match.contains(etag):
+            return Response(status=304, headers=headers)
+        return Response(document, 200, headers)
+
+    def suggest(self, languages, lane_name):
+        """Suggest titles and authors that start with what the patron
+        has typed so far, in OpenSearch suggestions format.
+        """
+        lane = self.load_lane(languages, lane_name)
+        if isinstance(lane, ProblemDetail):
+            return lane
+        query = flask.request.args.get('q', '')
+
+        suggestions = self.manager.suggestions.suggestions(
+            query, lane.languages
+        )
+        return Response(
+            json.dumps([query, suggestions]), 200,
+            {"Content-Type": "application/x-suggestions+json",
+             "Cache-Control": "public, max-age=300"}
+        )
+
+    CHANGES_DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+    def changes(self):
+        """Serve a feed of works whose availability or presentation has
+        changed since a given time.
+
+        The first page fixes the end of the time window as `until`, and
+        every later page keeps it. Once a client reaches the last page,
+        it can use `until` as `since` for its next sync.
+        """
+        try:
+            since = datetime.datetime.strptime(
+                flask.request.args.get('since', ''), self.CHANGES_DATE_FORMAT
+            )
+        except ValueError, e:
+            return INVALID_INPUT.detailed(
+                "You must provide a 'since' time in the format %s." %
+                self.CHANGES_DATE_FORMAT
+            )
+        until = flask.request.args.get('until')
+        if until:
+            try:
+                until = datetime.datetime.strptime(
+                    until, self.CHANGES_DATE_FORMAT
+                )
+            except ValueError, e:
+                return INVALID_INPUT.detailed("Invalid 'until' time.")
+        else:
+            until = datetime.datetime.utcnow().replace(microsecond=0)
+        try:
+            after_work = int(flask.request.args.get('after_work', 0))
+        except ValueError, e:
+            return INVALID_INPUT.detailed("Invalid 'after_work' value.")
+        pagination = load_pagination_from_request()
+        if isinstance(pagination, ProblemDetail):
+            return pagination
+
+        window = dict(
+            since=since.strftime(self.CHANGES_DATE_FORMAT),
+            until=until.strftime(self.CHANGES_DATE_FORMAT),
+            size=pagination.size,
+        )
+        this_url = self.url_for("changes", **window)
         annotator = self.manager.annotator(None)
-        opds_feed = PreloadFeed.page(
-            self._db, "Content to Preload", this_url,
-            annotator=annotator,
+        feed, work_ids = ChangesFeed.page(
+            self._db, "Changes", this_url, annotator, since, until,
+            after_work, pagination.size
+        )
+        if len(work_ids) == pagination.size:
+            feed.add_link(
+                rel="next", href=self.url_for(
+                    "changes", after_work=work_ids[-1], **window
+                )
+            )
+        return feed_response(unicode(feed))
+
+    def preload(self):
+        """Serve the feed of content to preload on devices.
+
+        The feed only changes when the configured list of identifiers
+        changes or the materialized views are refreshed, so it's built
+        once per configuration and kept for PRELOAD_CACHE_TIME seconds.
+        """
+        this_url = url_for("preload", _external=True)
+        configured_content = Configuration.policy(
+            Configuration.PRELOADED_CONTENT
         )
-        return feed_response(opds_feed)
+        configuration_hash = hashlib.sha1(
+            json.dumps([this_url, configured_content], sort_keys=True)
+        ).hexdigest()
+
+        now = time.time()
+        cached = self.manager.preload_feed
+        if (cached is None or cached[0] != configuration_hash
+            or now - cached[1] > self.PRELOAD_CACHE_TIME):
+            annotator = self.manager.annotator(None)
+            opds_feed = PreloadFeed.page(
+                self._db, "Content to Preload", this_url,
+                annotator=annotator,
+            )
+            etag = hashlib.sha1(opds_feed.encode("utf8")).hexdigest()
+            cached = (configuration_hash, now, opds_feed, etag)
+            self.manager.preload_feed = cached
+        ignore, ignore, opds_feed, etag = cached
+
+        if flask.request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = self.compressed(feed_response(opds_feed))
+        response.headers['ETag'] = '"%s"' % etag
+        return response
 
 
 class AccountController(CirculationManagerController):
@@ -547,10 +897,36 @@ class LoanController(CirculationManagerController):
                 # display the current active loans, as we understand them.
                 self.manager.log.error("ERROR DURING SYNC: %r", e, exc_info=e)
 
+        # If the client already has the current version of the
+        # bookshelf, there's no need to send it again. The Atom and
+        # OPDS 2 documents are different representations, so they get
+        # different ETags.
+        opds2 = self.opds2_requested()
+        version = CirculationManagerLoanAndHoldAnnotator.bookshelf_version(
+            self._db, patron
+        )
+        if opds2:
+            version += "-opds2"
+        headers = {
+            "ETag" : '"%s"' % version,
+            "Cache-Control" : "private, no-cache",
+            "Vary" : "Accept",
+        }
+        if flask.request.if_none_match.contains(version):
+            return Response(status=304, headers=headers)
+
         # Then make the feed.
         feed = CirculationManagerLoanAndHoldAnnotator.active_loans_for(
             self.circulation, patron)
-        return feed_response(feed, cache_for=None)
+        if opds2:
+            document = OPDS2Serializer.streaming_feed(
+                feed, self.url_for('active_loans')
+            )
+            response = opds2_response(document, cache_for=None)
+        else:
+            response = streaming_feed_response(feed, cache_for=None)
+        response.headers['ETag'] = headers['ETag']
+        return self.negotiated(response)
 
     def borrow(self, data_source, identifier, mechanism_id=None):
         """Create a new loan or hold for a book.
@@ -786,6 +1162,80 @@ class LoanController(CirculationManagerController):
             return feed_response(feed, None)
 
 
+class WorkLookupController(CirculationManagerController):
+    """Look up any number of works by URN, so that a client can refresh
+    its whole local catalog in one request.
+    """
+
+    # How long to remember which work a URN identifies.
+    URN_CACHE_TIME = 300
+    MAX_CACHED_URNS = 100000
+
+    def __init__(self, manager):
+        super(WorkLookupController, self).__init__(manager)
+        # Maps URN to (expiration time, identifier ID, work ID).
+        self.ids_by_urn = {}
+
+    def work_lookup(self, annotator, route_name='work'):
+        urns = []
+        for urn in flask.request.args.getlist('urn'):
+            if urn not in urns:
+                urns.append(urn)
+
+        # Only go to the database for URNs we haven't seen recently.
+        now = time.time()
+        ids_by_urn = {}
+        unresolved = []
+        for urn in urns:
+            cached = self.ids_by_urn.get(urn)
+            if cached and cached[0] > now:
+                ids_by_urn[urn] = cached[1:]
+            else:
+                unresolved.append(urn)
+        resolved, messages_by_urn = BulkLookupFeed.resolve_urns(
+            self._db, unresolved
+        )
+        if len(self.ids_by_urn) + len(resolved) > self.MAX_CACHED_URNS:
+            self.ids_by_urn = {}
+        for urn, (identifier_id, work_id) in resolved.items():
+            self.ids_by_urn[urn] = (
+                now + self.URN_CACHE_TIME, identifier_id, work_id
+            )
+        ids_by_urn.update(resolved)
+
+        identifier_ids = []
+        work_ids = []
+        for urn in urns:
+            if urn in ids_by_urn:
+                identifier_id, work_id = ids_by_urn[urn]
+                identifier_ids.append(identifier_id)
+                if work_id not in work_ids:
+                    work_ids.append(work_id)
+        identifiers = BulkLookupFeed.load_identifiers(self._db, identifier_ids)
+        works = dict(
+            (work.id, work)
+            for work in BulkLookupFeed.load_works(self._db, work_ids)
+        )
+
+        # One entry for every URN we found, even if several of them
+        # identify the same work, so the client can match each entry
+        # to the URN it asked about.
+        entries = []
+        for urn in urns:
+            if urn not in ids_by_urn:
+                continue
+            identifier_id, work_id = ids_by_urn[urn]
+            if identifier_id in identifiers and work_id in works:
+                entries.append((identifiers[identifier_id], works[work_id]))
+
+        this_url = self.url_for(route_name, urn=urns)
+        feed = BulkLookupFeed(
+            self._db, "Lookup results", this_url, entries, annotator,
+            messages_by_urn=messages_by_urn
+        )
+        return feed_response(unicode(feed))
+
+
 class WorkController(CirculationManagerController):
 
     def permalink(self, data_source, identifier):
@@ -804,8 +1254,76 @@ class WorkController(CirculationManagerController):
             return pool
         work = pool.work
         annotator = self.manager.annotator(None)
-        return entry_response(
-            AcquisitionFeed.single_entry(self._db, work, annotator)
+        if self.opds2_requested():
+            publication = OPDS2Serializer(annotator).publication(work)
+            response = opds2_response(
+                publication, media_type=OPDS2Serializer.PUBLICATION_TYPE
+            )
+        else:
+            response = entry_response(
+                AcquisitionFeed.single_entry(self._db, work, annotator)
+            )
+        return self.compressed(self.negotiated(response))
+
+    # The most books a client can ask about in one availability request.
+    MAX_AVAILABILITY_BOOKS = 500
+
+    def availability(self):
+        """Report the current availability of any number of books, as
+        JSON read straight from their LicensePools.
+
+        Books are identified as `<data source>/<identifier>`, the same
+        way they are in permalinks. They can be sent as `book` query
+        parameters or as a JSON list of [data source, identifier] pairs
+        in a POST body.
+        """
+        if flask.request.method == 'POST':
+            try:
+                books = json.loads(flask.request.data)
+                books = [(unicode(ds), unicode(id)) for ds, id in books]
+            except (TypeError, ValueError), e:
+                return INVALID_INPUT.detailed(
+                    "Expected a JSON list of [data source, identifier] pairs."
+                )
+        else:
+            books = []
+            for book in flask.request.args.getlist('book'):
+                if '/' not in book:
+                    return INVALID_INPUT.detailed(
+                        "Invalid book: %s" % book
+                    )
+                books.append(tuple(book.split('/', 1)))
+        if len(books) > self.MAX_AVAILABILITY_BOOKS:
+            return INVALID_INPUT.detailed(
+                "You can only ask about %d books at once." %
+                self.MAX_AVAILABILITY_BOOKS
+            )
+
+        availability = []
+        if books:
+            q = self._db.query(
+                DataSource.name, Identifier.identifier,
+                LicensePool.licenses_owned, LicensePool.licenses_available,
+                LicensePool.patrons_in_hold_queue,
+            ).select_from(LicensePool).join(
+                LicensePool.data_source
+            ).join(
+                LicensePool.identifier
+            ).filter(
+                tuple_(DataSource.name, Identifier.identifier).in_(books)
+            )
+            for (data_source, identifier, owned, available,
+                 holds) in q:
+                availability.append(dict(
+                    data_source=data_source, identifier=identifier,
+                    licenses_owned=owned, licenses_available=available,
+                    patrons_in_hold_queue=holds,
+                ))
+
+        return Response(
+            json.dumps(dict(availability=availability)), 200,
+            {"Content-Type": "application/json",
+             "Cache-Control": "private, no-cache"}
         )
 
     def report(self, data_source, identifier):
@@ -27,6 +27,7 @@ from core.opds_import import (
 from core.external_search import (
     ExternalSearchIndex,
 )
+from search_cache import SearchIndexGeneration
 
 class SearchIndexUpdateMonitor(WorkSweepMonitor):
     """Make sure the search index is up-to-date for every work.
@@ -54,6 +55,9 @@ class SearchIndexUpdateMonitor(WorkSweepMonitor):
                 logging.warn(
                     "Work %d is presentation-ready but has no title?" % work.id
                 )
+        if batch:
+            # Cached search results may now be out of date.
+            SearchIndexGeneration.bump(self._db)
         return highest_id
 
 
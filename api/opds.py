@@ -1,24 +1,39 @@
+import hashlib
 import urllib
 from nose.tools import set_trace
 from flask import url_for
 from lxml import etree
 from collections import defaultdict
 
-from sqlalchemy.orm import lazyload
+from sqlalchemy import (
+    and_,
+    or_,
+    tuple_,
+)
+from sqlalchemy.orm import (
+    joinedload,
+    lazyload,
+    subqueryload,
+)
 
 from config import Configuration
 from core.opds import (
     Annotator,
     AcquisitionFeed,
     E,
+    LookupAcquisitionFeed,
     OPDSFeed,
     opds_ns,
     simplified_ns
 )
 from core.model import (
+    CirculationEvent,
+    Hold,
     Identifier,
     LicensePool,
     LicensePoolDeliveryMechanism,
+    Loan,
+    Resource,
     Session,
     BaseMaterializedWork,
     Work,
@@ -26,6 +41,7 @@ from core.model import (
 )
 from core.lane import Lane
 from circulation import BaseCirculationAPI
+from pagination import KeysetPagination
 from core.app_server import cdn_url_for
 from core.util.cdn import cdnify
 
@@ -47,6 +63,10 @@ class CirculationManagerAnnotator(Annotator):
         self.test_mode = test_mode
         self._top_level_title = top_level_title
 
+        # The most recent work to go into the feed. Keyset pagination
+        # needs this to build the link to the next page.
+        self.last_work = None
+
     def top_level_title(self):
         return self._top_level_title
 
@@ -120,6 +140,10 @@ class CirculationManagerAnnotator(Annotator):
         kwargs = dict({})
         if facets != None:
             kwargs.update(dict(facets.items()))
+        if (isinstance(pagination, KeysetPagination) and pagination.pending
+            and self.last_work is not None):
+            # The next page starts after the last work in this one.
+            pagination = pagination.after_item(self.last_work)
         if pagination != None:
             kwargs.update(dict(pagination.items()))
         return self.cdn_url_for(
@@ -199,6 +223,7 @@ class CirculationManagerAnnotator(Annotator):
         return url
 
     def annotate_work_entry(self, work, active_license_pool, edition, identifier, feed, entry):
+        self.last_work = work
         active_loan = self.active_loans_by_work.get(work)
         active_hold = self.active_holds_by_work.get(work)
 
@@ -288,20 +313,14 @@ class CirculationManagerAnnotator(Annotator):
 
     @classmethod
     def add_configuration_links(cls, feed):
-        for rel, value in (
-                ("terms-of-service", Configuration.terms_of_service_url()),
-                ("privacy-policy", Configuration.privacy_policy_url()),
-                ("copyright", Configuration.acknowledgements_url()),
-                ("about", Configuration.about_url()),
-        ):
-            if value:
-                d = dict(href=value, type="text/html", rel=rel)
-                if isinstance(feed, OPDSFeed):
-                    feed.add_link(**d)
-                else:
-                    # This is an ElementTree object.
-                    link = E.link(**d)
-                    feed.append(link)
+        for rel, value in Configuration.snapshot().configuration_links:
+            d = dict(href=value, type="text/html", rel=rel)
+            if isinstance(feed, OPDSFeed):
+                feed.add_link(**d)
+            else:
+                # This is an ElementTree object.
+                link = E.link(**d)
+                feed.append(link)
 
     def acquisition_links(self, active_license_pool, active_loan, active_hold,
                           feed, data_source_name, identifier_identifier):
@@ -310,10 +329,7 @@ class CirculationManagerAnnotator(Annotator):
         can_borrow = False
         can_fulfill = False
         can_revoke = False
-        can_hold = (
-            Configuration.hold_policy() == 
-            Configuration.HOLD_POLICY_ALLOW
-        )
+        can_hold = Configuration.snapshot().holds_allowed
 
         if active_loan:
             can_fulfill = True
@@ -503,7 +519,7 @@ class CirculationManagerAnnotator(Annotator):
         return link_tag
 
     def open_access_link(self, lpdm):
-        cdn_host = Configuration.cdn_host(Configuration.CDN_OPEN_ACCESS_CONTENT)
+        cdn_host = Configuration.snapshot().open_access_cdn_host
         url = cdnify(lpdm.resource.url, cdn_host)
         kw = dict(rel=OPDSFeed.OPEN_ACCESS_REL, href=url)
         rep = lpdm.resource.representation
@@ -527,33 +543,193 @@ class CirculationManagerAnnotator(Annotator):
         feed_obj.feed.append(patron_tag)
 
 
+class CompactCirculationManagerAnnotator(CirculationManagerAnnotator):
+    """Builds minimal entries for list and grid views: title, author,
+    cover, permalink, and a single acquisition link with availability
+    information. Everything else is left for the permalink.
+    """
+
+    # The query parameter that asks for compact entries.
+    PARAMETER = "entries"
+    VALUE = "compact"
+
+    # The Accept header profile that asks for compact entries.
+    PROFILE = "http://librarysimplified.org/terms/profile/compact"
+
+    ATOM_NS = "http://www.w3.org/2005/Atom"
+    KEEP_TAGS = set(
+        "{%s}%s" % (ATOM_NS, x) for x in ['id', 'title', 'author', 'updated']
+    )
+    KEEP_LINK_RELS = set([
+        'alternate', 'collection',
+        'http://opds-spec.org/image',
+        'http://opds-spec.org/image/thumbnail',
+    ])
+    ACQUISITION_REL = "http://opds-spec.org/acquisition"
+
+    # Feed-level links that lead to another page of the same feed, and
+    # so should also ask for compact entries.
+    NAVIGATION_RELS = set([
+        'next', 'previous', 'first', 'http://opds-spec.org/facet'
+    ])
+
+    @classmethod
+    def compact_url(cls, url):
+        if "%s=%s" % (cls.PARAMETER, cls.VALUE) in url:
+            return url
+        if '?' in url:
+            connector = '&'
+        else:
+            connector = '?'
+        return url + connector + "%s=%s" % (cls.PARAMETER, cls.VALUE)
+
+    def feed_url(self, lane, facets=None, pagination=None):
+        return self.compact_url(super(
+            CompactCirculationManagerAnnotator, self).feed_url(
+                lane, facets, pagination))
+
+    def search_url(self, lane, query, pagination):
+        return self.compact_url(super(
+            CompactCirculationManagerAnnotator, self).search_url(
+                lane, query, pagination))
+
+    def facet_url(self, facets):
+        return self.compact_url(super(
+            CompactCirculationManagerAnnotator, self).facet_url(facets))
+
+    def annotate_work_entry(self, work, active_license_pool, edition,
+                            identifier, feed, entry):
+        super(CompactCirculationManagerAnnotator, self).annotate_work_entry(
+            work, active_license_pool, edition, identifier, feed, entry
+        )
+        self.compact_entry(entry)
+
+    @classmethod
+    def compact_entry(cls, entry):
+        """Remove everything but the essentials from an entry."""
+        link_tag = "{%s}link" % cls.ATOM_NS
+        found_acquisition_link = False
+        for child in list(entry):
+            if child.tag == link_tag:
+                rel = child.get('rel') or ''
+                if rel in cls.KEEP_LINK_RELS:
+                    continue
+                if (rel.startswith(cls.ACQUISITION_REL)
+                    and not found_acquisition_link):
+                    # Keep the availability information, but not the
+                    # list of formats.
+                    found_acquisition_link = True
+                    for indirect in child.findall(
+                            "{%s}indirectAcquisition" % opds_ns):
+                        child.remove(indirect)
+                    continue
+                entry.remove(child)
+            elif child.tag not in cls.KEEP_TAGS:
+                entry.remove(child)
+
+    @classmethod
+    def compact_feed(cls, content):
+        """Turn an already-rendered feed into one with compact entries."""
+        if isinstance(content, unicode):
+            content = content.encode("utf8")
+        feed = etree.fromstring(content)
+        for link in feed.findall("{%s}link" % cls.ATOM_NS):
+            if link.get('rel') in cls.NAVIGATION_RELS and link.get('href'):
+                link.set('href', cls.compact_url(link.get('href')))
+        for entry in feed.findall("{%s}entry" % cls.ATOM_NS):
+            cls.compact_entry(entry)
+        return etree.tostring(feed, encoding=unicode)
+
+
 class CirculationManagerLoanAndHoldAnnotator(CirculationManagerAnnotator):
 
     @classmethod
     def active_loans_for(cls, circulation, patron, test_mode=False):
         db = Session.object_session(patron)
+        loans, holds = cls.loans_and_holds_for(db, patron)
+
+        # The license pools and works were eager-loaded, so none of
+        # this triggers a query.
+        works = []
         active_loans_by_work = {}
-        for loan in patron.loans:
+        for loan in loans:
             work = loan.work
             if work:
                 active_loans_by_work[work] = loan
+                works.append(work)
         active_holds_by_work = {}
-        for hold in patron.holds:
+        for hold in holds:
             work = hold.work
             if work:
                 active_holds_by_work[work] = hold
+                if work not in active_loans_by_work:
+                    works.append(work)
 
         annotator = cls(
             circulation, None, patron, active_loans_by_work, active_holds_by_work,
             test_mode=test_mode
         )
         url = annotator.url_for('active_loans', _external=True)
-        works = patron.works_on_loan_or_on_hold()
 
-        feed_obj = AcquisitionFeed(db, "Active loans and holds", url, works, annotator)
+        feed_obj = StreamingAcquisitionFeed(
+            db, "Active loans and holds", url, works, annotator
+        )
         annotator.annotate_feed(feed_obj, None)
         return feed_obj
 
+    @classmethod
+    def loans_and_holds_for(cls, _db, patron):
+        """Load a patron's loans and holds, along with everything the
+        annotator will need to turn them into OPDS entries, in a
+        fixed number of queries.
+
+        :return: A 2-tuple (loans, holds).
+        """
+        loans = _db.query(Loan).filter(Loan.patron==patron).options(
+            *cls._license_pool_load_options(Loan.license_pool)
+        ).all()
+        holds = _db.query(Hold).filter(Hold.patron==patron).options(
+            *cls._license_pool_load_options(Hold.license_pool)
+        ).all()
+        return loans, holds
+
+    @classmethod
+    def bookshelf_version(cls, _db, patron):
+        """A string that changes whenever anything shown in the patron's
+        loans feed changes: a loan or hold is created or removed, its
+        dates change, a loan is fulfilled, or a hold moves in the queue.
+        """
+        loans = _db.query(
+            Loan.id, Loan.start, Loan.end, Loan.fulfillment_id
+        ).filter(Loan.patron==patron).order_by(Loan.id).all()
+        holds = _db.query(
+            Hold.id, Hold.start, Hold.end, Hold.position
+        ).filter(Hold.patron==patron).order_by(Hold.id).all()
+        shelf = repr((patron.id, loans, holds))
+        return hashlib.sha1(shelf).hexdigest()
+
+    @classmethod
+    def _license_pool_load_options(cls, relationship):
+        """Eager-loading options for a LicensePool reached through
+        `relationship`, and for its Work.
+        """
+        pool = lambda: joinedload(relationship)
+        mechanisms = lambda: pool().subqueryload(
+            LicensePool.delivery_mechanisms)
+        work = lambda: pool().joinedload(LicensePool.work)
+        return [
+            pool().joinedload(LicensePool.data_source),
+            pool().joinedload(LicensePool.identifier),
+            pool().joinedload(LicensePool.edition),
+            mechanisms().joinedload(
+                LicensePoolDeliveryMechanism.delivery_mechanism),
+            mechanisms().joinedload(
+                LicensePoolDeliveryMechanism.resource).joinedload(
+                    Resource.representation),
+            work().joinedload(Work.primary_edition),
+            work().subqueryload(Work.license_pools),
+        ]
+
     @classmethod
     def single_loan_feed(cls, circulation, loan, test_mode=False):
         db = Session.object_session(loan)
@@ -580,6 +756,223 @@ class CirculationManagerLoanAndHoldAnnotator(CirculationManagerAnnotator):
         return AcquisitionFeed.single_entry(db, work, annotator)
 
 
+class StreamingAcquisitionFeed(AcquisitionFeed):
+    """An acquisition feed whose entries are created and serialized one
+    at a time, as the feed is being sent, rather than all at once.
+
+    The feed-level elements are built up front, as with any other
+    AcquisitionFeed; only the entries are deferred.
+    """
+
+    def __init__(self, _db, title, url, works, annotator=None, **kwargs):
+        super(StreamingAcquisitionFeed, self).__init__(
+            _db, title, url, [], annotator, **kwargs
+        )
+        self.works = works
+
+    def serialize(self):
+        """Yield the feed as a series of unicode strings: everything up to
+        the closing tag, then each entry, then the closing tag.
+        """
+        document = etree.tostring(self.feed, encoding=unicode)
+        close = document.rindex("</")
+        yield document[:close]
+        for work in self.works:
+            entry = self.create_entry(work, None)
+            if isinstance(entry, etree._Element):
+                yield etree.tostring(entry, encoding=unicode)
+        yield document[close:]
+
+    def __unicode__(self):
+        return u"".join(self.serialize())
+
+
+class BulkLookupFeed(LookupAcquisitionFeed):
+    """A feed of the works identified by a list of URNs, built with a
+    constant number of queries no matter how many URNs there are.
+
+    As with any LookupAcquisitionFeed, `works` is a list of
+    (Identifier, Work) 2-tuples, one per URN that was looked up, and
+    each entry's ID is the URN the client asked about.
+    """
+
+    NOT_FOUND = (404, "I've never heard of this work.")
+    INVALID_URN = (400, "Could not parse identifier.")
+
+    def __init__(self, _db, title, url, works, annotator=None,
+                 messages_by_urn=None):
+        super(BulkLookupFeed, self).__init__(
+            _db, title, url, works, annotator
+        )
+        for urn, (status_code, message) in (messages_by_urn or {}).items():
+            self.add_message(urn, status_code, message)
+
+    def add_message(self, urn, status_code, message):
+        """Explain why no entry was provided for a URN."""
+        tag = E._makeelement("{%s}message" % simplified_ns)
+        tag.append(E.id(urn))
+        status_tag = E._makeelement("{%s}status_code" % simplified_ns)
+        status_tag.text = unicode(status_code)
+        tag.append(status_tag)
+        message_tag = E._makeelement("{%s}description" % simplified_ns)
+        message_tag.text = message
+        tag.append(message_tag)
+        self.feed.append(tag)
+
+    @classmethod
+    def resolve_urns(cls, _db, urns):
+        """Find the Identifier ID and Work ID for each URN, in one query.
+
+        :return: A 2-tuple (ids_by_urn, messages_by_urn). ids_by_urn
+        maps URN to a 2-tuple (identifier ID, work ID). A URN that
+        can't be parsed or doesn't identify a work shows up in
+        messages_by_urn instead.
+        """
+        messages_by_urn = {}
+        urns_by_key = {}
+        for urn in urns:
+            try:
+                key = Identifier.type_and_identifier_for_urn(urn)
+            except ValueError, e:
+                messages_by_urn[urn] = cls.INVALID_URN
+                continue
+            urns_by_key[tuple(key)] = urn
+
+        ids_by_urn = {}
+        if urns_by_key:
+            q = _db.query(
+                Identifier.type, Identifier.identifier, Identifier.id,
+                LicensePool.work_id
+            ).join(
+                LicensePool, LicensePool.identifier_id==Identifier.id
+            ).filter(
+                tuple_(Identifier.type, Identifier.identifier).in_(
+                    urns_by_key.keys()
+                )
+            ).filter(LicensePool.work_id != None)
+            for type, identifier, identifier_id, work_id in q:
+                ids_by_urn[urns_by_key[(type, identifier)]] = (
+                    identifier_id, work_id
+                )
+
+        for urn in urns_by_key.values():
+            if urn not in ids_by_urn:
+                messages_by_urn[urn] = cls.NOT_FOUND
+        return ids_by_urn, messages_by_urn
+
+    @classmethod
+    def load_identifiers(cls, _db, identifier_ids):
+        """Load the given identifiers in one query.
+
+        :return: A dictionary mapping ID to Identifier.
+        """
+        if not identifier_ids:
+            return {}
+        identifiers = _db.query(Identifier).filter(
+            Identifier.id.in_(identifier_ids))
+        return dict((x.id, x) for x in identifiers)
+
+    @classmethod
+    def load_works(cls, _db, work_ids):
+        """Load the given works, and everything needed to build their
+        entries, in a constant number of queries.
+        """
+        if not work_ids:
+            return []
+        pools = lambda: subqueryload(Work.license_pools)
+        mechanisms = lambda: pools().subqueryload(
+            LicensePool.delivery_mechanisms)
+        works = _db.query(Work).filter(Work.id.in_(work_ids)).options(
+            joinedload(Work.primary_edition),
+            pools().joinedload(LicensePool.data_source),
+            pools().joinedload(LicensePool.identifier),
+            pools().joinedload(LicensePool.edition),
+            mechanisms().joinedload(
+                LicensePoolDeliveryMechanism.delivery_mechanism),
+            mechanisms().joinedload(
+                LicensePoolDeliveryMechanism.resource).joinedload(
+                    Resource.representation),
+        ).all()
+        by_id = dict((work.id, work) for work in works)
+        return [by_id[x] for x in work_ids if x in by_id]
+
+
+class ChangesFeed(AcquisitionFeed):
+    """A feed of works whose availability or presentation changed in a
+    given time window, so that clients can sync incrementally.
+
+    A CirculationEvent is logged whenever a LicensePool's availability
+    actually changes, so that's how we know which works' availability
+    changed. LicensePool.last_checked is no good for this: it's updated
+    every time a monitor looks at a book, whether or not anything
+    changed.
+
+    A work that changed but is no longer presentation-ready (because
+    it was withdrawn, for instance) gets an Atom tombstone (RFC 6721)
+    instead of an entry, so that clients know to drop it.
+    """
+
+    TOMBSTONES_NS = "http://purl.org/atompub/tombstones/1.0"
+    TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+    @classmethod
+    def changed_work_ids(cls, _db, since, until, after_id=0, size=50):
+        """Find the IDs of works that changed in the window (since, until],
+        whether or not they're still presentation-ready.
+
+        Works are returned in ID order, starting after `after_id`, so
+        the window can be paged through without missing or repeating
+        any works.
+        """
+        availability_changed = _db.query(LicensePool.work_id).join(
+            CirculationEvent, CirculationEvent.license_pool_id==LicensePool.id
+        ).filter(
+            CirculationEvent.start > since,
+            CirculationEvent.start <= until,
+        )
+        work_changed = and_(
+            Work.last_update_time > since,
+            Work.last_update_time <= until,
+        )
+        q = _db.query(Work.id).filter(
+            or_(Work.id.in_(availability_changed), work_changed)
+        ).filter(
+            Work.id > after_id
+        ).order_by(Work.id).limit(size)
+        return [work_id for [work_id] in q]
+
+    @classmethod
+    def page(cls, _db, title, url, annotator, since, until, after_id=0,
+             size=50):
+        work_ids = cls.changed_work_ids(_db, since, until, after_id, size)
+        works = BulkLookupFeed.load_works(_db, work_ids)
+        ready = [work for work in works if work.presentation_ready]
+        removed = [work for work in works if not work.presentation_ready]
+        feed = cls(_db, title, url, ready, annotator)
+        for work in removed:
+            feed.add_tombstone(work, until)
+        return feed, work_ids
+
+    def add_tombstone(self, work, until):
+        """Tell clients that `work` no longer has an entry.
+
+        We don't keep track of when a work stopped being
+        presentation-ready, so the end of the window is used as the
+        time it was removed.
+        """
+        edition = work.primary_edition
+        if not edition or not edition.primary_identifier:
+            # There's no entry ID for a client to know this work by.
+            return
+        tag = E._makeelement(
+            "{%s}deleted-entry" % self.TOMBSTONES_NS,
+            nsmap=dict(at=self.TOMBSTONES_NS),
+            ref=edition.primary_identifier.urn,
+            when=until.strftime(self.TIME_FORMAT),
+        )
+        self.feed.append(tag)
+
+
 class PreloadFeed(AcquisitionFeed):
 
     @classmethod
@@ -589,8 +982,16 @@ class PreloadFeed(AcquisitionFeed):
         """Create a feed of content to preload on devices."""
         configured_content = Configuration.policy(Configuration.PRELOADED_CONTENT)
 
-        identifiers = [Identifier.parse_urn(_db, urn)[0] for urn in configured_content]
-        identifier_ids = [identifier.id for identifier in identifiers]
+        # Look up every configured identifier in a single query.
+        type_and_identifier = [
+            Identifier.type_and_identifier_for_urn(urn)
+            for urn in configured_content or []
+        ]
+        identifier_ids = _db.query(Identifier.id).filter(
+            tuple_(Identifier.type, Identifier.identifier).in_(
+                type_and_identifier
+            )
+        ).subquery()
 
         if use_materialized_works:
             from core.model import MaterializedWork
@@ -0,0 +1,294 @@
+from nose.tools import set_trace
+from collections import OrderedDict
+import json
+
+from lxml import etree
+
+from core.model import BaseMaterializedWork
+from core.opds import (
+    AcquisitionFeed,
+    OPDSFeed,
+)
+
+
+class OPDS2Serializer(object):
+    """Serialize feeds and entries as OPDS 2.0 JSON.
+
+    Publications are described from the works themselves, but their
+    acquisition links come from the annotator's acquisition_links(),
+    so the JSON offers exactly what the Atom feed would.
+    """
+
+    FEED_TYPE = "application/opds+json"
+    PUBLICATION_TYPE = "application/opds-publication+json"
+
+    ATOM_NS = "http://www.w3.org/2005/Atom"
+    DCTERMS_NS = "http://purl.org/dc/terms/"
+
+    IMAGE_RELS = set([
+        "http://opds-spec.org/image",
+        "http://opds-spec.org/image/thumbnail",
+    ])
+    COLLECTION_REL = "collection"
+
+    # Attributes of OPDS 1 link children that hold numbers.
+    NUMERIC_PROPERTIES = set(['total', 'available', 'position'])
+
+    def __init__(self, annotator=None):
+        self.annotator = annotator
+
+    @classmethod
+    def _atom(cls, tag):
+        return "{%s}%s" % (cls.ATOM_NS, tag)
+
+    @classmethod
+    def _localname(cls, element):
+        return etree.QName(element).localname
+
+    @classmethod
+    def to_json(cls, document):
+        return json.dumps(document, separators=(',', ':'))
+
+    # Links.
+
+    @classmethod
+    def link(cls, element):
+        """Convert an Atom <link> tag, such as one of the tags made by
+        the annotator, into an OPDS 2 link object.
+        """
+        link = OrderedDict()
+        for attribute in ('href', 'rel', 'type', 'title'):
+            value = element.get(attribute)
+            if value:
+                link[attribute] = value
+        properties = OrderedDict()
+        for child in element:
+            name = cls._localname(child)
+            if name == 'indirectAcquisition':
+                properties.setdefault('indirectAcquisition', []).append(
+                    cls.indirect_acquisition(child)
+                )
+            elif name == 'availability':
+                availability = OrderedDict()
+                for key, value in child.attrib.items():
+                    if key == 'status':
+                        key = 'state'
+                    availability[key] = value
+                properties['availability'] = availability
+            elif name in ('holds', 'copies'):
+                properties[name] = cls._numeric_attributes(child)
+        if properties:
+            link['properties'] = properties
+        return link
+
+    @classmethod
+    def indirect_acquisition(cls, element):
+        acquisition = OrderedDict(type=element.get('type'))
+        children = [
+            cls.indirect_acquisition(x) for x in element
+            if cls._localname(x) == 'indirectAcquisition'
+        ]
+        if children:
+            acquisition['child'] = children
+        return acquisition
+
+    @classmethod
+    def _numeric_attributes(cls, element):
+        d = OrderedDict()
+        for key, value in element.attrib.items():
+            if key in cls.NUMERIC_PROPERTIES:
+                try:
+                    value = int(value)
+                except ValueError, e:
+                    pass
+            d[key] = value
+        return d
+
+    # Publications built directly from works.
+
+    def publication(self, work):
+        """Describe a work as an OPDS 2 publication."""
+        annotator = self.annotator
+        pool = annotator.active_licensepool_for(work)
+
+        metadata = OrderedDict()
+        metadata['@type'] = "http://schema.org/Book"
+        metadata['title'] = work.title
+        if getattr(work, 'author', None):
+            metadata['author'] = [dict(name=work.author)]
+        if pool:
+            metadata['identifier'] = pool.identifier.urn
+        for field, key in (('language', 'language'),
+                           ('summary_text', 'description')):
+            value = getattr(work, field, None)
+            if value:
+                metadata[key] = value
+        modified = getattr(work, 'last_update_time', None)
+        if modified:
+            metadata['modified'] = modified.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+        links = []
+        if pool:
+            if isinstance(work, BaseMaterializedWork):
+                identifier = work.identifier
+                data_source_name = work.name
+            else:
+                identifier = pool.identifier.identifier
+                data_source_name = pool.data_source.name
+            links.append(OrderedDict([
+                ('rel', 'self'),
+                ('href', annotator.permalink_for(work, pool, identifier)),
+                ('type', OPDSFeed.ENTRY_TYPE),
+            ]))
+            active_loan = annotator.active_loans_by_work.get(work)
+            active_hold = annotator.active_holds_by_work.get(work)
+            for tag in annotator.acquisition_links(
+                    pool, active_loan, active_hold, AcquisitionFeed,
+                    data_source_name, identifier):
+                if tag is not None:
+                    links.append(self.link(tag))
+
+        images = []
+        for field, rel in (
+                ('cover_full_url', "http://opds-spec.org/image"),
+                ('cover_thumbnail_url', "http://opds-spec.org/image/thumbnail"),
+        ):
+            url = getattr(work, field, None)
+            if url:
+                images.append(OrderedDict([('href', url), ('rel', rel)]))
+
+        publication = OrderedDict([('metadata', metadata), ('links', links)])
+        if images:
+            publication['images'] = images
+        return publication
+
+    def feed(self, title, url, works, link_tags=[]):
+        """Describe a list of works as an OPDS 2 feed.
+
+        :param link_tags: Feed-level Atom <link> tags, as added by the
+        annotator's annotate_feed().
+        """
+        links = [OrderedDict([
+            ('rel', 'self'), ('href', url), ('type', self.FEED_TYPE)
+        ])]
+        links.extend(
+            self.link(x) for x in link_tags if x.get('rel') != 'self'
+        )
+        return OrderedDict([
+            ('metadata', dict(title=title)),
+            ('links', links),
+            ('publications', [self.publication(work) for work in works]),
+        ])
+
+    @classmethod
+    def streaming_feed(cls, feed, url):
+        """Describe a StreamingAcquisitionFeed, whose entries haven't
+        been rendered yet, without rendering them as Atom.
+        """
+        serializer = cls(feed.annotator)
+        return serializer.feed(
+            feed.feed.findtext(cls._atom('title')), url, feed.works,
+            feed.feed.findall(cls._atom('link'))
+        )
+
+    # Feeds that have already been rendered as Atom.
+
+    @classmethod
+    def from_atom(cls, content):
+        """Convert an Atom feed, such as a cached lane or group feed,
+        into an OPDS 2 feed.
+
+        Entries that belong to a group (they have a 'collection' link)
+        are put into OPDS 2 groups.
+        """
+        if isinstance(content, unicode):
+            content = content.encode("utf8")
+        root = etree.fromstring(content)
+
+        document = OrderedDict()
+        document['metadata'] = dict(title=root.findtext(cls._atom('title')))
+        document['links'] = [
+            cls.link(x) for x in root.findall(cls._atom('link'))
+        ]
+
+        publications = []
+        groups = OrderedDict()
+        for entry in root.findall(cls._atom('entry')):
+            publication, collection = cls.publication_from_entry(entry)
+            if collection is None:
+                publications.append(publication)
+                continue
+            href = collection.get('href')
+            if href not in groups:
+                groups[href] = OrderedDict([
+                    ('metadata', dict(title=collection.get('title'))),
+                    ('links', [OrderedDict([
+                        ('rel', 'self'), ('href', href),
+                        ('type', cls.FEED_TYPE)])]),
+                    ('publications', []),
+                ])
+            groups[href]['publications'].append(publication)
+
+        if publications or not groups:
+            document['publications'] = publications
+        if groups:
+            document['groups'] = groups.values()
+        return document
+
+    @classmethod
+    def publication_from_entry(cls, entry):
+        """Convert an Atom entry into an OPDS 2 publication.
+
+        :return: A 2-tuple (publication, collection link). The collection
+        link is None if the entry doesn't belong to a group.
+        """
+        metadata = OrderedDict()
+        metadata['@type'] = "http://schema.org/Book"
+        metadata['title'] = entry.findtext(cls._atom('title'))
+        authors = [
+            dict(name=x.findtext(cls._atom('name')))
+            for x in entry.findall(cls._atom('author'))
+        ]
+        if authors:
+            metadata['author'] = authors
+        metadata['identifier'] = entry.findtext(cls._atom('id'))
+        modified = entry.findtext(cls._atom('updated'))
+        if modified:
+            metadata['modified'] = modified
+        summary = entry.findtext(cls._atom('summary'))
+        if summary:
+            metadata['description'] = summary
+        language = entry.findtext("{%s}language" % cls.DCTERMS_NS)
+        if language:
+            metadata['language'] = language
+        subjects = []
+        for category in entry.findall(cls._atom('category')):
+            subject = OrderedDict(
+                name=category.get('label') or category.get('term')
+            )
+            if category.get('scheme'):
+                subject['scheme'] = category.get('scheme')
+            subject['code'] = category.get('term')
+            subjects.append(subject)
+        if subjects:
+            metadata['subject'] = subjects
+
+        links = []
+        images = []
+        collection = None
+        for tag in entry.findall(cls._atom('link')):
+            rel = tag.get('rel')
+            if rel == cls.COLLECTION_REL:
+                collection = tag
+            elif rel in cls.IMAGE_RELS:
+                images.append(cls.link(tag))
+            else:
+                if rel == 'alternate':
+                    tag = etree.Element(tag.tag, tag.attrib)
+                    tag.set('rel', 'self')
+                links.append(cls.link(tag))
+
+        publication = OrderedDict([('metadata', metadata), ('links', links)])
+        if images:
+            publication['images'] = images
+        return publication, collection
@@ -2,6 +2,8 @@ from nose.tools import set_trace
 import datetime
 import json
 import requests
+import time
+import zlib
 
 from sqlalchemy.orm import contains_eager
 
@@ -29,6 +31,8 @@ from core.model import (
     Loan,
     Representation,
     Session,
+    Timestamp,
+    get_one_or_create,
 )
 
 from core.monitor import (
@@ -37,6 +41,11 @@ from core.monitor import (
 )
 
 from circulation_exceptions import *
+from config import Configuration
+from worker_pool import WorkerPool
+from payload_fingerprint import PayloadFingerprints
+from rate_limit import RateLimiter
+from availability_refresh import DemandWeightedRefreshMonitor
 
 class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI):
 
@@ -60,12 +69,65 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI):
     # displayed to a patron, so it doesn't matter much.
     DEFAULT_ERROR_URL = "http://librarysimplified.org/"
 
+    # If these are set in the Overdrive integration configuration,
+    # every process shares a single budget of requests to Overdrive.
+    RATE_LIMIT = "requests_per_second"
+    RATE_LIMIT_BURST = "request_burst"
+
+    # Requests that aren't made on behalf of a patron give way to
+    # those that are. The web app raises this to PATRON.
+    rate_limit_priority = RateLimiter.BACKGROUND
+
+    @classmethod
+    def shared_rate_limiter(cls, _db):
+        """The RateLimiter for the Overdrive API, or None if no rate
+        limit is configured.
+        """
+        config = Configuration.integration(
+            Configuration.OVERDRIVE_INTEGRATION) or {}
+        rate = config.get(cls.RATE_LIMIT)
+        if not rate:
+            return None
+        return RateLimiter(
+            _db, "Overdrive", rate, config.get(cls.RATE_LIMIT_BURST)
+        )
+
+    @property
+    def rate_limiter(self):
+        if not hasattr(self, '_rate_limiter'):
+            self._rate_limiter = self.shared_rate_limiter(self._db)
+        return self._rate_limiter
+
+    def wait_for_rate_limit(self, priority=None):
+        """Wait for the shared rate limit, if there is one, to allow
+        another request.
+        """
+        limiter = self.rate_limiter
+        priority = priority or self.rate_limit_priority
+        if limiter and not limiter.acquire(priority):
+            # A patron has waited long enough. Make the request anyway,
+            # but charge it to the shared budget so background work
+            # makes up for it.
+            limiter.overdraw()
+
+    def get(self, url, extra_headers, exception_on_401=False):
+        self.wait_for_rate_limit()
+        if WorkerPool.in_worker_thread():
+            # Refreshing the access token means using the database
+            # session, which belongs to another thread. If the token
+            # has expired, fail; the token is refreshed in the main
+            # thread before work is handed to the pool.
+            exception_on_401 = True
+        return super(OverdriveAPI, self).get(
+            url, extra_headers, exception_on_401)
+
     def patron_request(self, patron, pin, url, extra_headers={}, data=None,
                        exception_on_401=False, method=None):
         """Make an HTTP request on behalf of a patron.
 
         The results are never cached.
         """
+        self.wait_for_rate_limit(RateLimiter.PATRON)
         patron_credential = self.get_patron_credential(patron, pin)
         headers = dict(Authorization="Bearer %s" % patron_credential.credential)
         headers.update(extra_headers)
@@ -461,6 +523,20 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI):
             return True
         raise CannotReleaseHold(response.content)
        
+    # Ask about the availability of many books at once.
+    BULK_AVAILABILITY_ENDPOINT = "http://api.overdrive.com/v2/collections/%(collection_token)s/availability?products=%(product_ids)s"
+    MAX_BULK_AVAILABILITY = 25
+
+    # How many products to ask for per page when walking the whole
+    # collection.
+    PRODUCTS_PAGE_SIZE = 200
+
+    # How many times to retry an availability request that was
+    # rejected because we're over the rate limit, and how long to wait
+    # before the first retry.
+    RATE_LIMIT_RETRIES = 3
+    RATE_LIMIT_BACKOFF = 2
+
     def update_licensepool(self, book):
         """Update availability information for a single book.
 
@@ -470,9 +546,24 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI):
         The book's LicensePool will be updated with current
         circulation information.
         """
-        # Retrieve current circulation information about this book
-        orig_book = book
-        book_id = None
+        book = self.fetch_availability(book)
+        if book is None:
+            return None, None, False
+        return self.apply_availability(book)
+
+    def fetch_availability(self, book):
+        """Retrieve current circulation information about a book.
+
+        This only makes an HTTP request, so it's safe to call from a
+        thread other than the one that owns the database session.
+
+        :param book: An Overdrive ID, or a dictionary containing the
+        book's 'id' and 'availability_link'.
+
+        :return: A dictionary of book information with the
+        availability information added, or None if the information
+        couldn't be retrieved.
+        """
         if isinstance(book, basestring):
             book_id = book
             circulation_link = self.AVAILABILITY_ENDPOINT % dict(
@@ -481,26 +572,143 @@ class OverdriveAPI(BaseOverdriveAPI, BaseCirculationAPI):
             )
             book = dict(id=book_id)
         else:
-            book_id = book['id']
+            book = dict(book)
             circulation_link = book['availability_link']
-        try:
-            status_code, headers, content = self.get(circulation_link, {})
-        except Exception, e:
-            status_code = None
-            self.log.error(
-                "HTTP exception communicating with Overdrive",
-                exc_info=e
-            )
+
+        status_code, headers, content = self.get_with_backoff(
+            circulation_link
+        )
         if status_code != 200:
             self.log.error(
                 "Could not get availability for %s: status code %s",
                 book['id'], status_code
             )
-            return None, None, False
+            return None
 
         book.update(json.loads(content))
+        return book
+
+    def get_with_backoff(self, url):
+        """Make a GET request, waiting and trying again if Overdrive says
+        we're over the rate limit.
+
+        :return: A 3-tuple (status code, headers, content). The status
+        code is None if the request couldn't be made at all.
+        """
+        backoff = self.RATE_LIMIT_BACKOFF
+        for attempt in range(self.RATE_LIMIT_RETRIES + 1):
+            try:
+                status_code, headers, content = self.get(url, {})
+            except Exception, e:
+                self.log.error(
+                    "HTTP exception communicating with Overdrive",
+                    exc_info=e
+                )
+                return None, {}, None
+            if status_code != 429 or attempt == self.RATE_LIMIT_RETRIES:
+                break
+            # We're going too fast. Wait and try again.
+            try:
+                delay = int(headers.get('retry-after', backoff))
+            except ValueError, e:
+                delay = backoff
+            self.log.warn(
+                "Rate limited by Overdrive; retrying %s in %d sec.", url, delay
+            )
+            time.sleep(delay)
+            backoff *= 2
+        return status_code, headers, content
+
+    def fetch_bulk_availability(self, overdrive_ids):
+        """Retrieve current circulation information about up to
+        MAX_BULK_AVAILABILITY books in a single request.
+
+        Like fetch_availability(), this is safe to call from a thread
+        other than the one that owns the database session.
+
+        :return: A dictionary mapping lowercased Overdrive ID to a
+        dictionary of availability information, in the format used by
+        fetch_availability(). Books Overdrive didn't tell us about are
+        left out.
+        """
+        url = self.BULK_AVAILABILITY_ENDPOINT % dict(
+            collection_token=self.collection_token,
+            product_ids=",".join(overdrive_ids)
+        )
+        status_code, headers, content = self.get_with_backoff(url)
+        if status_code != 200:
+            self.log.error(
+                "Could not get bulk availability for %d books: status code %s",
+                len(overdrive_ids), status_code
+            )
+            return {}
+
+        books = {}
+        for item in json.loads(content).get('availability', []):
+            book_id = item.get('reserveId') or item.get('id')
+            if not book_id:
+                continue
+            book = dict(item)
+            book['id'] = book_id
+            books[book_id.lower()] = book
+        return books
+
+    def products_link(self, offset=0):
+        """The link to a page of the collection's products, starting
+        `offset` products in.
+        """
+        base = self.get_library()['links']['products']['href']
+        return "%s?limit=%d&offset=%d" % (
+            base, self.PRODUCTS_PAGE_SIZE, offset
+        )
+
+    def product_pages(self, offset=0):
+        """Walk the whole collection one page at a time, starting
+        `offset` products in.
+
+        :yield: A 2-tuple (total number of products in the collection,
+        list of books) for each page. Each book is a dictionary suitable
+        for passing into fetch_availability().
+        """
+        link = self.products_link(offset)
+        while link:
+            status_code, headers, content = self.get_with_backoff(link)
+            if status_code != 200:
+                raise RemoteInitiatedServerError(
+                    "Got status code %s from %s" % (status_code, link)
+                )
+            data = json.loads(content)
+            books = []
+            for product in data.get('products', []):
+                links = product.get('links', {})
+                if 'availability' in links:
+                    books.append(dict(
+                        id=product['id'],
+                        availability_link=links['availability']['href']
+                    ))
+                else:
+                    books.append(product['id'])
+            yield data.get('totalItems'), books
+            link = data.get('links', {}).get('next', {}).get('href')
+
+    def update_licensepool_availability(self, book, license_pool):
+        """Update an existing LicensePool's availability, and nothing
+        else, from a dictionary of availability information.
+
+        :return: True if the availability changed.
+        """
+        circulation = OverdriveRepresentationExtractor.book_info_to_circulation(
+            book
+        )
+        return circulation.update(license_pool, False)
+
+    def apply_availability(self, book):
+        """Apply availability information obtained from
+        fetch_availability() to the book's LicensePool.
+        """
         license_pool, is_new = LicensePool.for_foreign_id(
-            self._db, DataSource.OVERDRIVE, Identifier.OVERDRIVE_ID, book_id)
+            self._db, DataSource.OVERDRIVE, Identifier.OVERDRIVE_ID,
+            book['id'])
         return self.update_licensepool_with_book_info(
             book, license_pool, is_new
         )
@@ -610,11 +818,15 @@ class OverdriveCirculationMonitor(Monitor):
     """
     def __init__(self, _db, name="Overdrive Circulation Monitor",
                  interval_seconds=500,
-                 maximum_consecutive_unchanged_books=None):
+                 maximum_consecutive_unchanged_books=None,
+                 batch_size=50, workers=5):
         super(OverdriveCirculationMonitor, self).__init__(
             _db, name, interval_seconds=interval_seconds)
         self.maximum_consecutive_unchanged_books = (
             maximum_consecutive_unchanged_books)
+        self.batch_size = batch_size
+        self.worker_pool = WorkerPool(workers)
+        self.fingerprints = PayloadFingerprints()
 
     def recently_changed_ids(self, start, cutoff):
         return self.api.recently_changed_ids(start, cutoff)
@@ -624,44 +836,78 @@ class OverdriveCirculationMonitor(Monitor):
         super(OverdriveCirculationMonitor, self).run()
 
     def run_once(self, start, cutoff):
-        _db = self._db
-        added_books = 0
-        overdrive_data_source = DataSource.lookup(
-            _db, DataSource.OVERDRIVE)
-
-        total_books = 0
-        consecutive_unchanged_books = 0
-        for i, book in enumerate(self.recently_changed_ids(start, cutoff)):
-            total_books += 1
-            if not total_books % 100:
-                self.log.info("%s books processed", total_books)
+        self.total_books = 0
+        self.consecutive_unchanged_books = 0
+        batch = []
+        for book in self.recently_changed_ids(start, cutoff):
+            self.total_books += 1
+            if not self.total_books % 100:
+                self.log.info("%s books processed", self.total_books)
             if not book:
                 continue
-            license_pool, is_new, is_changed = self.api.update_licensepool(book)
+            batch.append(book)
+            if len(batch) >= self.batch_size:
+                keep_going = self.process_batch(batch, start)
+                batch = []
+                if not keep_going:
+                    break
+        else:
+            if batch:
+                self.process_batch(batch, start)
+
+        if self.total_books:
+            self.log.info("Processed %d books total.", self.total_books)
+
+    def process_batch(self, books, start):
+        """Fetch availability for a batch of books in parallel, then
+        apply it, in order, and commit once.
+
+        :return: False if we found enough consecutive unchanged books
+        to stop this run; True otherwise.
+        """
+        _db = self._db
+        # Anything left over from a batch that never got committed
+        # can't be trusted.
+        self.fingerprints.rollback()
+        # Make sure the access token is good before the worker
+        # threads start using it, since they can't refresh it.
+        self.api.check_creds()
+        fetched = self.worker_pool.map(self.api.fetch_availability, books)
+        keep_going = True
+        for book in fetched:
+            if book is None:
+                license_pool, is_new, is_changed = None, None, False
+            elif self.fingerprints.unchanged(book['id'], book):
+                # Overdrive told us exactly what it told us last time.
+                license_pool, is_new, is_changed = None, None, False
+            else:
+                license_pool, is_new, is_changed = (
+                    self.api.apply_availability(book))
+                self.fingerprints.remember(book['id'], book)
             # Log a circulation event for this work.
             if is_new:
                 CirculationEvent.log(
                     _db, license_pool, CirculationEvent.TITLE_ADD,
                     None, None, start=license_pool.last_checked)
-            _db.commit()
 
             if is_changed:
-                consecutive_unchanged_books = 0
+                self.consecutive_unchanged_books = 0
             else:
-                consecutive_unchanged_books += 1
+                self.consecutive_unchanged_books += 1
                 if (self.maximum_consecutive_unchanged_books
-                    and consecutive_unchanged_books >= 
+                    and self.consecutive_unchanged_books >= 
                     self.maximum_consecutive_unchanged_books):
                     # We're supposed to stop this run after finding a
                     # run of books that have not changed, and we have
                     # in fact seen that many consecutive unchanged
                     # books.
                     self.log.info("Stopping at %d unchanged books.",
-                                  consecutive_unchanged_books)
+                                  self.consecutive_unchanged_books)
+                    keep_going = False
                     break
-
-        if total_books:
-            self.log.info("Processed %d books total.", total_books)
+        _db.commit()
+        self.fingerprints.commit()
+        return keep_going
 
 class FullOverdriveCollectionMonitor(OverdriveCirculationMonitor):
     """Monitor every single book in the Overdrive collection.
@@ -673,19 +919,153 @@ class FullOverdriveCollectionMonitor(OverdriveCirculationMonitor):
     def __init__(self, _db, interval_seconds=3600*4):
         super(FullOverdriveCollectionMonitor, self).__init__(
             _db, "Overdrive Collection Overview", interval_seconds)
+        self.checkpoint_service = "%s checkpoint" % self.service_name
+        self.last_product_service = "%s last product" % self.service_name
+
+    def checkpoint(self):
+        """Find or create the Timestamp that tracks how far we've gotten
+        through the current sweep.
+
+        Its counter is the number of products already processed; its
+        timestamp is when the sweep started.
+        """
+        checkpoint, is_new = get_one_or_create(
+            self._db, Timestamp, service=self.checkpoint_service
+        )
+        return checkpoint
+
+    def last_product(self):
+        """Find or create the Timestamp that remembers the last product
+        processed in the current sweep.
+
+        Its counter is the product's fingerprint.
+        """
+        last_product, is_new = get_one_or_create(
+            self._db, Timestamp, service=self.last_product_service
+        )
+        return last_product
+
+    @classmethod
+    def product_fingerprint(cls, book):
+        """A number that identifies a product and fits in a Timestamp's
+        counter.
+        """
+        if isinstance(book, dict):
+            book = book['id']
+        return zlib.crc32(book.lower().encode("utf8")) & 0x7fffffff
 
     def recently_changed_ids(self, start, cutoff):
-        """Ignore the dates and return all IDs."""
-        return self.api.all_ids()
+        """Ignore the dates and return all IDs, picking up where the
+        last, unfinished sweep left off.
+        """
+        checkpoint = self.checkpoint()
+        last_product = None
+        if checkpoint.counter and checkpoint.timestamp:
+            self.log.info(
+                "Resuming sweep started %s, %d products in.",
+                checkpoint.timestamp, checkpoint.counter
+            )
+            last_product = self.last_product().counter
+        else:
+            checkpoint.counter = 0
+            checkpoint.timestamp = datetime.datetime.utcnow()
+        self._db.commit()
+        self.resumed_offset = checkpoint.counter
+        self.resumed_at = time.time()
+        self.collection_size = None
+        return self._products(self.resumed_offset, last_product)
+
+    def _products(self, offset, last_product=None):
+        """Yield every product starting `offset` products in.
+
+        When resuming, we start one product early, to make sure the
+        last product we processed is still where we left it. If it
+        isn't, products were added or removed in the meantime, the
+        offset no longer means what it did, and the sweep starts over.
+        """
+        check = bool(offset) and last_product is not None
+        if check:
+            offset -= 1
+        for total, books in self.api.product_pages(offset):
+            if total is not None:
+                self.collection_size = total
+            for book in books:
+                if check:
+                    check = False
+                    if self.product_fingerprint(book) == last_product:
+                        # We processed this one last time.
+                        continue
+                    self.log.warn(
+                        "The collection changed since the sweep was interrupted; starting over."
+                    )
+                    self.restart_sweep()
+                    for book in self._products(0):
+                        yield book
+                    return
+                yield book
+
+    def restart_sweep(self):
+        checkpoint = self.checkpoint()
+        checkpoint.counter = 0
+        checkpoint.timestamp = datetime.datetime.utcnow()
+        self.last_product().counter = None
+        self._db.commit()
+        self.resumed_offset = 0
+
+    def process_batch(self, books, start):
+        keep_going = super(FullOverdriveCollectionMonitor, self).process_batch(
+            books, start
+        )
+        # Everything we've seen so far has now been processed and
+        # committed, so a crash from here on can resume after it.
+        checkpoint = self.checkpoint()
+        checkpoint.counter = self.resumed_offset + self.total_books
+        self.last_product().counter = self.product_fingerprint(books[-1])
+        self._db.commit()
+        self.log_progress(checkpoint.counter)
+        return keep_going
+
+    def log_progress(self, processed):
+        if not self.collection_size:
+            self.log.info("%d products processed.", processed)
+            return
+        elapsed = time.time() - self.resumed_at
+        remaining = max(self.collection_size - processed, 0)
+        message = "%d/%d products processed (%.1f%%)." % (
+            processed, self.collection_size,
+            100.0 * processed / self.collection_size
+        )
+        if self.total_books and elapsed:
+            seconds_left = remaining * elapsed / self.total_books
+            finish = datetime.datetime.utcnow() + datetime.timedelta(
+                seconds=seconds_left
+            )
+            message += " Expect to finish around %s." % (
+                finish.strftime("%Y-%m-%d %H:%M:%S")
+            )
+        self.log.info(message)
+
+    def run_once(self, start, cutoff):
+        super(FullOverdriveCollectionMonitor, self).run_once(start, cutoff)
+        # The sweep finished, so the next one starts from the beginning.
+        checkpoint = self.checkpoint()
+        self.log.info(
+            "Sweep started %s is complete.", checkpoint.timestamp
+        )
+        checkpoint.counter = 0
+        checkpoint.timestamp = None
+        self.last_product().counter = None
+        self._db.commit()
 
 class OverdriveCollectionReaper(IdentifierSweepMonitor):
     """Check for books that are in the local collection but have left our
     Overdrive collection.
     """
 
-    def __init__(self, _db, interval_seconds=3600*4):
+    def __init__(self, _db, interval_seconds=3600*4, workers=5):
         super(OverdriveCollectionReaper, self).__init__(
             _db, "Overdrive Collection Reaper", interval_seconds)
+        self.worker_pool = WorkerPool(workers)
 
     def run(self):
         self.api = OverdriveAPI(self._db)
@@ -698,8 +1078,54 @@ class OverdriveCollectionReaper(IdentifierSweepMonitor):
                     contains_eager(Identifier.licensed_through))
 
     def process_batch(self, identifiers):
-        for i in identifiers:
-            self.api.update_licensepool(i.identifier)
+        """Check a batch of books with bulk availability requests.
+
+        Books missing from the bulk responses are checked one at a
+        time, the way they always were.
+        """
+        pools = dict(
+            (i.identifier.lower(), i.licensed_through) for i in identifiers
+        )
+        ids = [i.identifier for i in identifiers]
+        size = self.api.MAX_BULK_AVAILABILITY
+        chunks = [ids[i:i+size] for i in range(0, len(ids), size)]
+        self.api.check_creds()
+        results = self.worker_pool.map(self.api.fetch_bulk_availability, chunks)
+
+        missing = []
+        for chunk, books in zip(chunks, results):
+            books = books or {}
+            for overdrive_id in chunk:
+                book = books.get(overdrive_id.lower())
+                if book is None:
+                    missing.append(overdrive_id)
+                else:
+                    self.api.update_licensepool_availability(
+                        book, pools[overdrive_id.lower()]
+                    )
+        if missing:
+            self.log.info(
+                "%d of %d books missing from bulk availability; checking them one at a time.",
+                len(missing), len(ids)
+            )
+        for overdrive_id in missing:
+            self.api.update_licensepool(overdrive_id)
+
+class OverdriveAvailabilityRefresh(DemandWeightedRefreshMonitor):
+    """Keep availability fresh for the Overdrive books patrons are
+    most interested in, while still checking the whole collection
+    over time.
+    """
+
+    def __init__(self, _db, interval_seconds=60):
+        super(OverdriveAvailabilityRefresh, self).__init__(
+            _db, "Overdrive Availability Refresh",
+            OverdriveCollectionReaper(_db), DataSource.OVERDRIVE,
+            Identifier.OVERDRIVE_ID, interval_seconds=interval_seconds)
+
+    def run(self):
+        self.sweep.api = OverdriveAPI(self._db)
+        super(OverdriveAvailabilityRefresh, self).run()
 
 class RecentOverdriveCollectionMonitor(OverdriveCirculationMonitor):
     """Monitor recently changed books in the Overdrive collection."""
@@ -718,6 +1144,12 @@ class OverdriveBibliographicCoverageProvider(BaseOverdriveBibliographicCoverageP
     Then mark the works as presentation-ready.
     """
     def process_batch(self, identifiers):
+        # Each identifier costs one request to Overdrive's metadata
+        # API, which comes out of the same budget as everything else.
+        rate_limiter = OverdriveAPI.shared_rate_limiter(self._db)
+        if rate_limiter:
+            for identifier in identifiers:
+                rate_limiter.acquire(RateLimiter.BACKGROUND)
         results = []
         for result in super(OverdriveBibliographicCoverageProvider, self).process_batch(identifiers):
             # Mark every successful result as presentation-ready.
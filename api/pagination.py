@@ -0,0 +1,257 @@
+from nose.tools import set_trace
+import base64
+import datetime
+import json
+
+import flask
+from sqlalchemy import (
+    and_,
+    false,
+    or_,
+)
+
+from core.app_server import load_pagination_from_request
+from core.lane import (
+    Facets,
+    Pagination,
+)
+from core.util.problem_detail import ProblemDetail
+from problem_details import *
+
+
+class KeysetPagination(Pagination):
+    """Paginate through a feed by remembering the sort key of the last
+    item on the previous page, rather than the number of items that
+    came before.
+
+    With offset pagination the database has to find and discard every
+    item on every earlier page. With keyset pagination it can go
+    straight to the first item of the page it's asked for.
+    """
+
+    # The fields that make up the sort key for each supported order
+    # facet. The work ID is always added at the end to break ties.
+    SORT_FIELDS = {
+        Facets.ORDER_TITLE : ['sort_title', 'sort_author'],
+        Facets.ORDER_AUTHOR : ['sort_author', 'sort_title'],
+        Facets.ORDER_ADDED_TO_COLLECTION : ['availability_time'],
+    }
+
+    # The type of each sort field's values, so that a key from a URL
+    # can be checked before it's used in a query.
+    FIELD_TYPES = {
+        'sort_title' : basestring,
+        'sort_author' : basestring,
+        'availability_time' : datetime.datetime,
+    }
+
+    DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+    def __init__(self, facets, size=Pagination.DEFAULT_SIZE, key=None,
+                 pending=False):
+        """Constructor.
+
+        :param key: The sort key of the last item on the previous page,
+        as a list of values. If this is None, this is the first page.
+
+        :param pending: If this is True, this object represents the page
+        after a page that's still being generated. The key will be filled
+        in, by after_item(), once we know the last item on that page.
+        """
+        super(KeysetPagination, self).__init__(0, size)
+        self.facets = facets
+        self.key = key
+        self.pending = pending
+
+    @classmethod
+    def supports(cls, facets):
+        return facets.order in cls.SORT_FIELDS
+
+    @property
+    def ascending(self):
+        return getattr(self.facets, 'order_ascending', True)
+
+    def items(self):
+        if self.key is not None:
+            yield("key", self.encode_key(self.key))
+        yield("size", self.size)
+
+    @property
+    def first_page(self):
+        return KeysetPagination(self.facets, self.size)
+
+    @property
+    def next_page(self):
+        return KeysetPagination(self.facets, self.size, pending=True)
+
+    @property
+    def previous_page(self):
+        # We only know how to go forward.
+        return None
+
+    def after_item(self, work):
+        """Create a KeysetPagination for the page that starts after the
+        given work.
+        """
+        return KeysetPagination(
+            self.facets, self.size, self.key_for(work)
+        )
+
+    @classmethod
+    def _id_field(cls, model):
+        if hasattr(model, 'works_id'):
+            # This is a materialized view.
+            return 'works_id'
+        return 'id'
+
+    def key_for(self, work):
+        """The sort key for the given work."""
+        key = [getattr(work, field, None)
+               for field in self.SORT_FIELDS[self.facets.order]]
+        key.append(getattr(work, self._id_field(work)))
+        return key
+
+    def apply(self, q):
+        """Modify the given query to order by the sort key and start
+        after the last item on the previous page.
+        """
+        model = q.column_descriptions[0]['entity']
+        columns = [getattr(model, field)
+                   for field in self.SORT_FIELDS[self.facets.order]]
+        id_field = getattr(model, self._id_field(model))
+
+        # NULLs sort before any real value, including the empty string.
+        q = q.order_by(None)
+        if self.ascending:
+            order_by = [column.nullsfirst() for column in columns]
+            order_by.append(id_field)
+        else:
+            order_by = [column.desc().nullslast() for column in columns]
+            order_by.append(id_field.desc())
+        q = q.order_by(*order_by)
+
+        if self.key is not None:
+            q = q.filter(self.seek(columns + [id_field], self.key))
+        return q.limit(self.size)
+
+    def seek(self, columns, key):
+        """A clause matching every row that sorts after `key`, in the
+        same order apply() uses.
+
+        A row comes after the key if it matches the key on some number
+        of leading columns and comes after it on the next one. The
+        comparisons are on the plain columns, with NULLs handled
+        explicitly, so they agree with the ORDER BY and can use the
+        columns' indexes.
+        """
+        clauses = []
+        for i, (column, value) in enumerate(zip(columns, key)):
+            after = self._after(column, value)
+            if after is None:
+                continue
+            equal = [self._equal(c, v) for c, v in zip(columns[:i], key[:i])]
+            clauses.append(and_(*(equal + [after])))
+        if not clauses:
+            # Nothing can come after this key.
+            return false()
+        return or_(*clauses)
+
+    def _equal(self, column, value):
+        if value is None:
+            return column == None
+        return column == value
+
+    def _after(self, column, value):
+        """A clause matching values of `column` that sort after `value`,
+        or None if nothing can.
+        """
+        if self.ascending:
+            # NULLs come first, so every real value comes after a NULL,
+            # and no NULL comes after a real value.
+            if value is None:
+                return column != None
+            return column > value
+        else:
+            # NULLs come last.
+            if value is None:
+                return None
+            return or_(column < value, column == None)
+
+    @classmethod
+    def encode_key(cls, key):
+        values = []
+        for value in key:
+            if isinstance(value, datetime.datetime):
+                value = dict(date=value.strftime(cls.DATE_FORMAT))
+            values.append(value)
+        return base64.urlsafe_b64encode(json.dumps(values))
+
+    @classmethod
+    def decode_key(cls, encoded, order):
+        """Turn a key from a URL back into a list of values, checking
+        each value against the sort field it goes with.
+
+        :raise ValueError: If the key can't be decoded, or doesn't
+        match the sort fields for `order`.
+        """
+        try:
+            values = json.loads(base64.urlsafe_b64decode(str(encoded)))
+        except (TypeError, ValueError), e:
+            raise ValueError("Could not decode pagination key.")
+        fields = cls.SORT_FIELDS[order]
+        if not isinstance(values, list) or len(values) != len(fields) + 1:
+            raise ValueError("Pagination key does not match the sort order.")
+
+        key = []
+        for field, value in zip(fields, values):
+            if cls.FIELD_TYPES[field] is datetime.datetime:
+                value = cls._decode_date(value)
+            elif value is not None and not isinstance(
+                    value, cls.FIELD_TYPES[field]):
+                raise ValueError("Bad value for %s in pagination key." % field)
+            key.append(value)
+
+        # The work ID is always there, and always a number.
+        work_id = values[-1]
+        if isinstance(work_id, bool) or not isinstance(work_id, (int, long)):
+            raise ValueError("Bad work ID in pagination key.")
+        key.append(work_id)
+        return key
+
+    @classmethod
+    def _decode_date(cls, value):
+        if value is None:
+            return None
+        if not isinstance(value, dict) or not isinstance(
+                value.get('date'), basestring):
+            raise ValueError("Bad date in pagination key.")
+        try:
+            return datetime.datetime.strptime(value['date'], cls.DATE_FORMAT)
+        except ValueError, e:
+            raise ValueError("Bad date in pagination key.")
+
+
+def load_keyset_pagination_from_request(facets):
+    """Figure out how to paginate a feed with the given facets.
+
+    Clients that ask for a numeric offset (`after`) get offset
+    pagination, as do feeds whose order doesn't have a sort key.
+    Everyone else gets keyset pagination.
+    """
+    pagination = load_pagination_from_request()
+    if isinstance(pagination, ProblemDetail):
+        return pagination
+    if 'after' in flask.request.args or not KeysetPagination.supports(facets):
+        return pagination
+
+    key = flask.request.args.get('key')
+    if key:
+        try:
+            key = KeysetPagination.decode_key(key, facets.order)
+        except ValueError, e:
+            return INVALID_INPUT.detailed(
+                "Invalid pagination key: %s" % e.message
+            )
+    else:
+        key = None
+    return KeysetPagination(facets, pagination.size, key)
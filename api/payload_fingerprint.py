@@ -0,0 +1,91 @@
+from nose.tools import set_trace
+import hashlib
+import json
+import time
+
+
+class PayloadFingerprints(object):
+    """Remembers a fingerprint of the last payload a monitor applied
+    and committed for each book, so that a payload identical to the
+    last one can be skipped without touching the database.
+
+    A payload is only trusted once the transaction that applied it
+    has been committed: remember() sets the fingerprint aside, and
+    commit() makes it count. If the transaction fails, the pending
+    fingerprints are thrown away by rollback() and the payloads will
+    be applied again next time.
+
+    Fingerprints only live as long as the monitor process, and each
+    one expires after `max_age` seconds, so every book gets written
+    out in full every so often even if its payload never changes.
+    That way a LicensePool that was changed behind the monitor's back
+    can't be ignored forever.
+    """
+
+    def __init__(self, max_age=3600*6, max_entries=500000):
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.fingerprints = {}
+        self.pending = {}
+
+    @classmethod
+    def fingerprint(cls, payload):
+        """Turn a payload into a short digest.
+
+        The payload may contain objects such as Metadata, which are
+        fingerprinted by their public attributes, and database
+        objects, which are fingerprinted by their IDs.
+        """
+        data = json.dumps(payload, sort_keys=True, default=cls._simplify)
+        return hashlib.sha1(data).digest()
+
+    @classmethod
+    def _simplify(cls, value):
+        if hasattr(value, '__table__'):
+            return [value.__class__.__name__, getattr(value, 'id', None)]
+        if hasattr(value, '__dict__'):
+            return dict(
+                (k, v) for k, v in value.__dict__.items()
+                if not k.startswith('_')
+            )
+        return unicode(value)
+
+    def unchanged(self, key, payload):
+        """Is this the same payload we last committed for `key`?"""
+        value = self.fingerprints.get(key)
+        if value is None:
+            return False
+        digest, recorded_at = value
+        if time.time() - recorded_at > self.max_age:
+            del self.fingerprints[key]
+            return False
+        return digest == self.fingerprint(payload)
+
+    def remember(self, key, payload):
+        """Note that `payload` has been applied for `key`, in a
+        transaction that hasn't been committed yet.
+        """
+        self.pending[key] = self.fingerprint(payload)
+
+    def commit(self):
+        """The transaction that applied the pending payloads has been
+        committed, so they can be trusted from now on.
+        """
+        new_keys = [x for x in self.pending if x not in self.fingerprints]
+        if len(self.fingerprints) + len(new_keys) > self.max_entries:
+            self.fingerprints.clear()
+        now = time.time()
+        for key, digest in self.pending.items():
+            self.fingerprints[key] = (digest, now)
+        self.pending = {}
+
+    def rollback(self):
+        """The transaction that applied the pending payloads didn't
+        make it, so forget about them.
+        """
+        self.pending = {}
+
+    def forget(self, key):
+        """Make sure the next payload for `key` is applied, whatever it is."""
+        self.fingerprints.pop(key, None)
+        self.pending.pop(key, None)
@@ -0,0 +1,188 @@
+from nose.tools import set_trace
+import datetime
+import logging
+import math
+import time
+
+from sqlalchemy import (
+    DateTime,
+    Integer,
+    and_,
+    cast,
+    func,
+    literal,
+    select,
+)
+from sqlalchemy.exc import IntegrityError
+
+from core.model import Timestamp
+
+
+class RateLimiter(object):
+    """A token bucket for a vendor API, shared between every process
+    that talks to the vendor.
+
+    The bucket is kept in a Timestamp row: the counter holds the number
+    of tokens (in thousandths, so slow refill rates work) and the
+    timestamp holds the last time a token was taken. Taking a token is
+    a single UPDATE that refills the bucket and spends from it, run
+    on its own connection and committed right away, so it never holds
+    a lock for longer than that one statement.
+
+    Patron-facing requests have first claim on the budget. Part of the
+    bucket is held in reserve for them: background requests have to
+    wait until the bucket holds more than the reserve, while patron
+    requests can spend it down to nothing. A patron request that
+    still can't get a token goes ahead anyway, but overdraws the
+    bucket, so background requests wait until the debt is paid off.
+    """
+
+    PATRON = "patron"
+    BACKGROUND = "background"
+
+    SCALE = 1000
+
+    # The longest a patron request will wait for a token before
+    # going ahead anyway.
+    PATRON_MAX_WAIT = 5
+
+    def __init__(self, _db, name, rate, capacity=None, patron_reserve=0.5):
+        """Constructor.
+
+        :param name: The name of the vendor API budget. Every process
+        using the same name shares the same bucket.
+        :param rate: Requests per second allowed by the vendor.
+        :param capacity: The most requests that can be made in a burst.
+        Defaults to one second's worth, but never less than two, so
+        there's room for a reserve.
+        :param patron_reserve: The portion of the bucket that only
+        patron requests may spend. If this is more than zero, at least
+        one token is reserved.
+
+        :raise ValueError: If a reserve is wanted but the bucket is
+        too small to hold one.
+        """
+        self._db = _db
+        self.service = "%s rate limit" % name
+        self.rate = float(rate)
+        self.capacity = int(capacity or max(int(math.ceil(self.rate)), 2))
+        if patron_reserve > 0:
+            if self.capacity < 2:
+                raise ValueError(
+                    "A bucket of %d request(s) has no room for a patron reserve." % self.capacity
+                )
+            self.reserve = min(
+                max(int(math.ceil(self.capacity * patron_reserve)), 1),
+                self.capacity - 1
+            )
+        else:
+            self.reserve = 0
+        self.log = logging.getLogger("Rate limiter (%s)" % name)
+
+    def acquire(self, priority=BACKGROUND, cost=1, max_wait=None):
+        """Wait until `cost` tokens can be taken, and take them.
+
+        Background requests wait as long as it takes, unless
+        `max_wait` is given. Patron requests wait at most
+        PATRON_MAX_WAIT seconds; a caller that goes ahead after that
+        should call overdraw().
+
+        :return: True if the tokens were taken, False if we gave up
+        waiting.
+        """
+        if priority == self.PATRON and max_wait is None:
+            max_wait = self.PATRON_MAX_WAIT
+        started = time.time()
+        while not self.take(priority, cost):
+            if max_wait is not None and time.time() - started >= max_wait:
+                self.log.warn(
+                    "Gave up waiting for the rate limit after %.1f sec.",
+                    time.time() - started
+                )
+                return False
+            time.sleep(cost / self.rate)
+        return True
+
+    def take(self, priority=BACKGROUND, cost=1):
+        """Take `cost` tokens if they're available, without waiting.
+
+        :return: True if the tokens were taken.
+        """
+        if priority == self.PATRON:
+            reserve = 0
+        else:
+            reserve = self.reserve
+        table = Timestamp.__table__
+        now = datetime.datetime.utcnow()
+        refilled = self._refilled(now)
+        update = table.update().where(
+            and_(table.c.service==self.service,
+                 refilled >= (cost + reserve) * self.SCALE)
+        ).values(counter=refilled - cost * self.SCALE, timestamp=now)
+
+        connection = self._db.get_bind().connect()
+        try:
+            if self._execute(connection, update).rowcount:
+                return True
+            exists = self._execute(
+                connection,
+                select([table.c.id]).where(table.c.service==self.service)
+            ).first()
+            if exists:
+                return False
+            # This is the first request ever made against this
+            # budget. Start with a full bucket.
+            try:
+                self._execute(connection, table.insert().values(
+                    service=self.service, timestamp=now,
+                    counter=(self.capacity - cost) * self.SCALE
+                ))
+            except IntegrityError, e:
+                # Another process created the bucket first.
+                return False
+            return True
+        finally:
+            connection.close()
+
+    def overdraw(self, cost=1):
+        """Take `cost` tokens whether or not they're there.
+
+        This is for patron requests that couldn't wait any longer. The
+        bucket may go below zero, and nobody else gets a token until
+        it has refilled past the overdraft.
+        """
+        table = Timestamp.__table__
+        now = datetime.datetime.utcnow()
+        update = table.update().where(
+            table.c.service==self.service
+        ).values(counter=self._refilled(now) - cost * self.SCALE,
+                 timestamp=now)
+        connection = self._db.get_bind().connect()
+        try:
+            self._execute(connection, update)
+        finally:
+            connection.close()
+        self.log.warn("Overdrew the rate limit by %d request(s).", cost)
+
+    def _refilled(self, now):
+        """The number of tokens in the bucket (times SCALE) as of `now`."""
+        table = Timestamp.__table__
+        # Never count more time than it takes to fill the bucket, so
+        # the refill can't overflow.
+        elapsed = func.least(
+            func.greatest(
+                func.extract(
+                    'epoch', literal(now, DateTime) - table.c.timestamp
+                ), 0
+            ),
+            self.capacity / self.rate
+        )
+        return func.least(
+            table.c.counter + cast(elapsed * self.rate * self.SCALE, Integer),
+            self.capacity * self.SCALE
+        )
+
+    def _execute(self, connection, statement):
+        return connection.execute(
+            statement.execution_options(autocommit=True)
+        )
@@ -1,6 +1,8 @@
 from nose.tools import set_trace
 from functools import wraps
+import logging
 import os
+import signal
 
 import flask
 from flask import (
@@ -34,6 +36,29 @@ def initialize_circulation_manager():
             # on initial setup) are committed before continuing.
             app.manager._db.commit()
 
+@app.before_request
+def reload_configuration_if_requested():
+    manager = getattr(app, 'manager', None)
+    if manager is not None:
+        manager.reload_configuration_if_requested()
+
+def request_configuration_reload(signum, frame):
+    """Handle SIGHUP by asking for the configuration to be reloaded
+    before the next request.
+
+    A signal handler interrupts whatever the main thread was doing, so
+    it only sets a flag.
+    """
+    manager = getattr(app, 'manager', None)
+    if manager is not None:
+        manager.reload_requested = True
+
+# Signal handlers can only be installed from the main thread, so this
+# has to happen when the app is imported, not during a request.
+try:
+    signal.signal(signal.SIGHUP, request_configuration_reload)
+except ValueError, e:
+    logging.warn("Could not install SIGHUP handler: %s", e)
 
 
 h = ErrorHandler(app, app.config['DEBUG'])
@@ -93,6 +118,16 @@ def feed(languages, lane_name):
 def lane_search(languages, lane_name):
     return app.manager.opds_feeds.search(languages, lane_name)
 
+@app.route('/search/<languages>/<lane_name>/suggest')
+@returns_problem_detail
+def lane_search_suggestions(languages, lane_name):
+    return app.manager.opds_feeds.suggest(languages, lane_name)
+
+@app.route('/changes')
+@returns_problem_detail
+def changes():
+    return app.manager.opds_feeds.changes()
+
 @app.route('/preload')
 @returns_problem_detail
 def preload():
@@ -143,6 +178,11 @@ def work():
     annotator = CirculationManagerAnnotator(app.manager.circulation, None)
     return app.manager.urn_lookup.work_lookup(annotator, 'work')
 
+@app.route('/availability', methods=['GET', 'POST'])
+@returns_problem_detail
+def availability():
+    return app.manager.work_controller.availability()
+
 @app.route('/works/<data_source>/<identifier>')
 @returns_problem_detail
 def permalink(data_source, identifier):
@@ -0,0 +1,128 @@
+from nose.tools import set_trace
+from collections import OrderedDict
+import datetime
+import logging
+import threading
+import time
+import urllib
+
+from core.model import (
+    Timestamp,
+    get_one,
+    get_one_or_create,
+)
+
+
+def normalize_query(query):
+    """Turn a search query into a form suitable for use as a cache key.
+
+    Queries that differ only in case or whitespace give the same
+    search results, so they share a key.
+    """
+    if isinstance(query, str):
+        query = query.decode("utf8")
+    query = u" ".join(query.lower().split())
+    return urllib.quote(query.encode("utf8"))
+
+
+class SearchIndexGeneration(object):
+    """Keeps track of how many times the search index has been updated,
+    so that cached search results can be thrown out once the index
+    changes underneath them.
+
+    The generation is stored as the counter on a Timestamp, so it's
+    shared between the search index monitor and every web process.
+    """
+
+    SERVICE_NAME = "Search index generation"
+
+    @classmethod
+    def bump(cls, _db):
+        """Note that the search index has changed."""
+        timestamp, is_new = get_one_or_create(
+            _db, Timestamp, service=cls.SERVICE_NAME
+        )
+        timestamp.counter = (timestamp.counter or 0) + 1
+        timestamp.timestamp = datetime.datetime.utcnow()
+        return timestamp.counter
+
+    @classmethod
+    def current(cls, _db):
+        timestamp = get_one(_db, Timestamp, service=cls.SERVICE_NAME)
+        if not timestamp:
+            return 0
+        return timestamp.counter or 0
+
+
+class CachingSearchClient(object):
+    """Wraps a search client and remembers the results of recent
+    queries.
+
+    Lane searches are dominated by a small set of queries, so most of
+    them can be answered without going to the search cluster. Cached
+    results only contain work IDs; the feed itself is built from the
+    database as usual.
+
+    Anything other than `query_works` is passed through to the
+    underlying client.
+    """
+
+    def __init__(self, search_client, _db, ttl=300, max_queries=1000,
+                 generation_check_interval=30):
+        self.search_client = search_client
+        self._db = _db
+        self.ttl = ttl
+        self.max_queries = max_queries
+        self.generation_check_interval = generation_check_interval
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = None
+        self._generation_checked_at = None
+        self.log = logging.getLogger("Search result cache")
+
+    def __getattr__(self, name):
+        return getattr(self.search_client, name)
+
+    def cache_key(self, args, kwargs):
+        args = list(args)
+        if args and isinstance(args[0], basestring):
+            args[0] = normalize_query(args[0])
+        if isinstance(kwargs.get('query_string'), basestring):
+            kwargs = dict(kwargs)
+            kwargs['query_string'] = normalize_query(kwargs['query_string'])
+        return repr((args, sorted(kwargs.items())))
+
+    def check_generation(self):
+        """Throw out every cached result if the search index has been
+        updated since we last looked.
+        """
+        now = time.time()
+        if (self._generation_checked_at is not None
+            and now - self._generation_checked_at < self.generation_check_interval):
+            return
+        self._generation_checked_at = now
+        generation = SearchIndexGeneration.current(self._db)
+        if generation != self._generation:
+            with self._lock:
+                self._results.clear()
+            self._generation = generation
+
+    def query_works(self, *args, **kwargs):
+        self.check_generation()
+        key = self.cache_key(args, kwargs)
+        now = time.time()
+        with self._lock:
+            cached = self._results.pop(key, None)
+            if cached is not None:
+                expires, results = cached
+                if expires > now:
+                    self._results[key] = cached
+                    return results
+
+        results = self.search_client.query_works(*args, **kwargs)
+
+        with self._lock:
+            self._results[key] = (now + self.ttl, results)
+            while len(self._results) > self.max_queries:
+                self._results.popitem(last=False)
+        return results
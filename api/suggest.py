@@ -0,0 +1,287 @@
+from nose.tools import set_trace
+from bisect import bisect_left
+from collections import defaultdict
+import datetime
+import heapq
+import logging
+import threading
+import time
+
+from sqlalchemy.orm import Session
+
+from core.model import (
+    Edition,
+    Work,
+)
+
+from search_cache import SearchIndexGeneration
+
+
+class PrefixIndex(object):
+    """A sorted list of search terms that can quickly find every term
+    starting with a given prefix.
+
+    The normalized terms and the strings to display for them are kept
+    in two parallel sorted lists, which is much more compact than a
+    trie, and a lookup is a binary search.
+    """
+
+    def __init__(self):
+        # The two lists are always replaced together, so that a
+        # lookup running in another thread sees a consistent pair.
+        self._arrays = ([], [])
+
+    @classmethod
+    def normalize(cls, term):
+        return u" ".join(term.lower().split())
+
+    def extend(self, terms):
+        """Add terms to the index.
+
+        The new terms are sorted on their own and merged into the
+        existing lists, rather than sorting everything again.
+        """
+        new_pairs = sorted(
+            set((self.normalize(term), term) for term in terms if term)
+        )
+        if not new_pairs:
+            return
+        keys, values = self._arrays
+        new_keys = []
+        new_values = []
+        last = None
+        for pair in heapq.merge(zip(keys, values), new_pairs):
+            if pair == last:
+                continue
+            new_keys.append(pair[0])
+            new_values.append(pair[1])
+            last = pair
+        self._arrays = (new_keys, new_values)
+
+    def remove(self, terms):
+        """Remove terms from the index."""
+        doomed = set(terms)
+        if not doomed:
+            return
+        keys, values = self._arrays
+        kept = [(key, value) for key, value in zip(keys, values)
+                if value not in doomed]
+        self._arrays = (
+            [key for key, value in kept],
+            [value for key, value in kept],
+        )
+
+    def matches(self, prefix, limit=10):
+        """Find terms that start with `prefix`, in alphabetical order."""
+        prefix = self.normalize(prefix)
+        if not prefix:
+            return []
+        keys, values = self._arrays
+        results = []
+        i = bisect_left(keys, prefix)
+        while (i < len(keys) and len(results) < limit
+               and keys[i].startswith(prefix)):
+            if values[i] not in results:
+                results.append(values[i])
+            i += 1
+        return results
+
+    def __len__(self):
+        return len(self._arrays[0])
+
+
+class SuggestionIndex(object):
+    """Keystroke-level suggestions for titles and authors, one
+    PrefixIndex per language.
+
+    The index is built from the presentation-ready works in the
+    database. When the search index monitor reports that the search
+    index has changed, every work updated since the last pass is
+    indexed again: new and retitled works are added, and works that
+    are no longer presentation-ready are taken out. Not every change
+    touches Work.last_update_time, so every `rebuild_interval` seconds
+    the index is rebuilt from scratch instead.
+
+    Once start() is called, all of this happens in a background thread
+    with its own database session. A request only ever reads whatever
+    index was most recently swapped in.
+    """
+
+    def __init__(self, _db, generation_check_interval=30,
+                 rebuild_interval=3600*24):
+        self._db = _db
+        self.generation_check_interval = generation_check_interval
+        self.rebuild_interval = rebuild_interval
+        self.by_language = defaultdict(PrefixIndex)
+        # The terms each work contributed, and how many works
+        # contributed each term, so that a term only leaves the index
+        # when the last work using it does.
+        self.terms_by_work = {}
+        self.term_counts = defaultdict(int)
+        self.last_update_time = None
+        self._built_at = None
+        self._generation = None
+        self._generation_checked_at = None
+        # Held while the index is being changed.
+        self._lock = threading.Lock()
+        # Held while deciding whether to update the index and updating
+        # it, so only one update happens at a time.
+        self._update_lock = threading.Lock()
+        self.log = logging.getLogger("Suggestion index")
+        self.update()
+
+    def start(self):
+        """Keep the index up to date in a background thread."""
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _run(self):
+        _db = Session(bind=self._db.get_bind())
+        while True:
+            time.sleep(self.generation_check_interval)
+            try:
+                self.update_if_needed(_db)
+            except Exception, e:
+                self.log.error(
+                    "Could not update the suggestion index.", exc_info=e
+                )
+            finally:
+                _db.close()
+
+    def _query(self, _db):
+        return _db.query(
+            Work.id, Work.presentation_ready, Work.last_update_time,
+            Edition.title, Edition.sort_author, Edition.language
+        ).join(Work.primary_edition)
+
+    @classmethod
+    def _terms(cls, language, *terms):
+        return tuple((language, term) for term in terms if term)
+
+    def rebuild_due(self):
+        return (self._built_at is None
+                or time.time() - self._built_at >= self.rebuild_interval)
+
+    def update(self, _db=None):
+        """Bring the index up to date with the database."""
+        _db = _db or self._db
+        self._generation = SearchIndexGeneration.current(_db)
+        if self.rebuild_due():
+            self.rebuild(_db)
+        else:
+            self.update_changed_works(_db)
+
+    def rebuild(self, _db=None):
+        """Index every presentation-ready work from scratch."""
+        _db = _db or self._db
+        # If no work has a last_update_time, the next incremental pass
+        # starts from the time this one did.
+        started = datetime.datetime.utcnow()
+        q = self._query(_db).filter(Work.presentation_ready==True)
+        terms_by_work = {}
+        term_counts = defaultdict(int)
+        last_update_time = None
+        for work_id, ready, updated, title, sort_author, language in q:
+            terms = self._terms(language, title, sort_author)
+            terms_by_work[work_id] = terms
+            for term in terms:
+                term_counts[term] += 1
+            if updated and (not last_update_time or updated > last_update_time):
+                last_update_time = updated
+
+        terms_by_language = defaultdict(list)
+        for language, term in term_counts:
+            terms_by_language[language].append(term)
+        by_language = defaultdict(PrefixIndex)
+        for language, terms in terms_by_language.items():
+            by_language[language].extend(terms)
+
+        with self._lock:
+            self.by_language = by_language
+            self.terms_by_work = terms_by_work
+            self.term_counts = term_counts
+            self.last_update_time = last_update_time or started
+            self._built_at = time.time()
+        self.log.info(
+            "Indexed %d works in %d languages.",
+            len(terms_by_work), len(by_language)
+        )
+
+    def update_changed_works(self, _db=None):
+        """Index again every work updated since the last pass."""
+        _db = _db or self._db
+        # Works updated at the same moment as the last work we saw
+        # may not have been committed yet, so look at them again.
+        changed = self._query(_db).filter(
+            Work.last_update_time >= self.last_update_time
+        ).all()
+
+        with self._lock:
+            added = set()
+            removed = set()
+            for work_id, ready, updated, title, sort_author, language in changed:
+                for term in self.terms_by_work.pop(work_id, ()):
+                    self.term_counts[term] -= 1
+                    if not self.term_counts[term]:
+                        del self.term_counts[term]
+                        if term in added:
+                            added.remove(term)
+                        else:
+                            removed.add(term)
+                if ready:
+                    terms = self._terms(language, title, sort_author)
+                    self.terms_by_work[work_id] = terms
+                    for term in terms:
+                        self.term_counts[term] += 1
+                        if self.term_counts[term] == 1:
+                            if term in removed:
+                                removed.remove(term)
+                            else:
+                                added.add(term)
+                if updated > self.last_update_time:
+                    self.last_update_time = updated
+
+            for language in set(x[0] for x in removed):
+                self.by_language[language].remove(
+                    [term for l, term in removed if l == language]
+                )
+            for language in set(x[0] for x in added):
+                self.by_language[language].extend(
+                    [term for l, term in added if l == language]
+                )
+        self.log.info(
+            "Indexed %d changed works: %d terms added, %d removed.",
+            len(changed), len(added), len(removed)
+        )
+
+    def update_if_needed(self, _db=None):
+        """Update the index if the search index has changed or a
+        rebuild is due.
+        """
+        _db = _db or self._db
+        with self._update_lock:
+            now = time.time()
+            if (self._generation_checked_at is not None
+                and now - self._generation_checked_at < self.generation_check_interval):
+                return
+            self._generation_checked_at = now
+            if (self.rebuild_due() or
+                SearchIndexGeneration.current(_db) != self._generation):
+                self.update(_db)
+
+    def suggestions(self, prefix, languages=None, limit=10):
+        """Find titles and authors that start with `prefix`.
+
+        :param languages: Only consider works in these languages. If
+        this is None, consider all languages.
+        """
+        if languages is None:
+            languages = self.by_language.keys()
+        results = []
+        for language in languages:
+            if language not in self.by_language:
+                continue
+            results.extend(self.by_language[language].matches(prefix, limit))
+        return sorted(set(results), key=PrefixIndex.normalize)[:limit]
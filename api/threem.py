@@ -5,10 +5,15 @@ import datetime
 import os
 import re
 import logging
+import time
 
 from nose.tools import set_trace
 
 from sqlalchemy import or_
+from sqlalchemy.orm import (
+    contains_eager,
+    joinedload,
+)
 
 from circulation import (
     FulfillmentInfo,
@@ -18,9 +23,11 @@ from circulation import (
 )
 from core.model import (
     CirculationEvent,
+    CoverageRecord,
     DataSource,
     DeliveryMechanism,
     Edition,
+    Equivalency,
     get_one,
     Identifier,
     LicensePool,
@@ -38,11 +45,15 @@ from core.monitor import (
 )
 from core.util.xmlparser import XMLParser
 from core.threem import (
+    ItemListParser,
     ThreeMAPI as BaseThreeMAPI,
     ThreeMBibliographicCoverageProvider as BaseThreeMBibliographicCoverageProvider
 )
 
 from circulation_exceptions import *
+from payload_fingerprint import PayloadFingerprints
+from worker_pool import WorkerPool
+from availability_refresh import DemandWeightedRefreshMonitor
 
 class ThreeMAPI(BaseThreeMAPI, BaseCirculationAPI):
 
@@ -84,9 +95,46 @@ class ThreeMAPI(BaseThreeMAPI, BaseCirculationAPI):
             raise e
         return events
 
+    def bibliographic_lookup_batch(self, identifiers):
+        """Look up bibliographic information for a number of books with
+        a single request.
+
+        :return: A dictionary mapping 3M ID to Metadata.
+        """
+        url = "/items/" + ",".join(x.identifier for x in identifiers)
+        response = self.request(url)
+        if response.status_code == 404:
+            return {}
+        if response.status_code != 200:
+            raise IOError("Server gave status code %s: %s" % (
+                response.status_code, response.content))
+        metadata_by_id = dict()
+        for metadata in ItemListParser().parse(response.content):
+            metadata_by_id[metadata.primary_identifier.identifier] = metadata
+        return metadata_by_id
+
+    def fetch_events_between(self, start, end):
+        """Return a list of events between the given times.
+
+        The result is never cached, so this doesn't use the database
+        and is safe to call from a thread other than the one that owns
+        the database session.
+        """
+        return list(self.get_events_between(start, end, cache_result=False))
+
+    CIRCULATION_PATH = "/circulation/items/"
+
+    def full_url(self, path):
+        """The URL request() will actually ask for, given a path."""
+        if not path.startswith("/"):
+            path = "/" + path
+        if not path.startswith("/cirrus"):
+            path = "/cirrus/library/%s%s" % (self.library_id, path)
+        return self.base_url + path
+
     def get_circulation_for(self, identifiers):
         """Return circulation objects for the selected identifiers."""
-        url = "/circulation/items/" + ",".join(identifiers)
+        url = self.CIRCULATION_PATH + ",".join(identifiers)
         response = self.request(url)
         if response.status_code == 404:
             return
@@ -514,84 +562,208 @@ class ThreeMCirculationSweep(IdentifierSweepMonitor):
     because this monitor and the main 3M circulation monitor will
     count the same event.  However it will greatly improve our current
     view of our 3M circulation, which is more important.
+
+    Each batch of identifiers is split into several requests to 3M,
+    which are made at the same time. The number of books asked about
+    in a single request grows while 3M answers quickly, and shrinks
+    when it's slow or a request fails, but is never allowed to make
+    the URL longer than 3M will accept.
     """
-    def __init__(self, _db, testing=False):
+
+    # 3M rejects URLs longer than this.
+    MAX_URL_LENGTH = 2000
+
+    # Bounds on the number of books to ask about in a single request.
+    MIN_REQUEST_SIZE = 5
+    MAX_REQUEST_SIZE = 100
+    REQUEST_SIZE_INCREMENT = 5
+
+    # If a request takes longer than this many seconds, ask about
+    # fewer books at once.
+    TARGET_RESPONSE_TIME = 10
+
+    def __init__(self, _db, testing=False, workers=5, batch_size=None):
         super(ThreeMCirculationSweep, self).__init__(
-            _db, "3M Circulation Sweep", batch_size=25)
+            _db, "3M Circulation Sweep", batch_size=batch_size)
         self._db = _db
         self.api = ThreeMAPI(self._db, testing=testing)
         self.data_source = DataSource.lookup(self._db, DataSource.THREEM)
+        self.fingerprints = PayloadFingerprints()
+        self.workers = workers
+        self.worker_pool = WorkerPool(workers)
+        self.request_size = 25
+
+    @property
+    def batch_size(self):
+        """Unless it was set explicitly, a batch is enough books to
+        give every worker one full-size request, so the batch size
+        follows the request size as it's adjusted.
+        """
+        return self._batch_size or self.request_size * self.workers
+
+    @batch_size.setter
+    def batch_size(self, value):
+        self._batch_size = value
 
     def identifier_query(self):
         return self._db.query(Identifier).filter(
-            Identifier.type==Identifier.THREEM_ID)
+            Identifier.type==Identifier.THREEM_ID).options(
+                joinedload(Identifier.licensed_through))
+
+    def requests_for(self, threem_ids):
+        """Split a list of 3M IDs into lists small enough to ask
+        about in a single request.
+        """
+        base_length = len(self.api.full_url(self.api.CIRCULATION_PATH))
+        requests = []
+        current = []
+        length = base_length
+        for threem_id in threem_ids:
+            added_length = len(threem_id) + 1
+            if current and (len(current) >= self.request_size
+                            or length + added_length > self.MAX_URL_LENGTH):
+                requests.append(current)
+                current = []
+                length = base_length
+            current.append(threem_id)
+            length += added_length
+        if current:
+            requests.append(current)
+        return requests
+
+    def fetch_circulation(self, threem_ids):
+        """Get circulation information for some books. Called from a
+        worker thread.
+
+        :return: A 2-tuple (list of circulation dictionaries, seconds
+        the request took).
+        """
+        start = time.time()
+        circulation = list(self.api.get_circulation_for(threem_ids))
+        return circulation, time.time() - start
+
+    def adjust_request_size(self, response_times, failures):
+        """Ask about more books per request if 3M is keeping up, and
+        fewer if it isn't.
+        """
+        old_size = self.request_size
+        if failures or (response_times and
+                        max(response_times) > self.TARGET_RESPONSE_TIME):
+            self.request_size = max(self.request_size / 2,
+                                    self.MIN_REQUEST_SIZE)
+        elif (response_times and
+              max(response_times) < self.TARGET_RESPONSE_TIME / 2.0):
+            self.request_size = min(
+                self.request_size + self.REQUEST_SIZE_INCREMENT,
+                self.MAX_REQUEST_SIZE
+            )
+        if self.request_size != old_size:
+            self.log.info("Now asking about %d books per request.",
+                          self.request_size)
 
     def process_batch(self, identifiers):
+        # Anything left over from a batch that never got committed
+        # can't be trusted.
+        self.fingerprints.rollback()
         identifiers_by_threem_id = dict()
-        threem_ids = set()
         for identifier in identifiers:
-            threem_ids.add(identifier.identifier)
             identifiers_by_threem_id[identifier.identifier] = identifier
 
+        requests = self.requests_for(sorted(identifiers_by_threem_id))
+        results = self.worker_pool.map(self.fetch_circulation, requests)
+        response_times = [x[1] for x in results if x is not None]
+        failures = len([x for x in results if x is None])
+        self.adjust_request_size(response_times, failures)
+
         identifiers_not_mentioned_by_threem = set(identifiers)
         now = datetime.datetime.utcnow()
-        for circ in self.api.get_circulation_for(threem_ids):
-            if not circ:
-                continue
-            threem_id = circ[Identifier][Identifier.THREEM_ID]
-            identifier = identifiers_by_threem_id[threem_id]
-            identifiers_not_mentioned_by_threem.remove(identifier)
-
-            pool = identifier.licensed_through
-            if not pool:
-                # We don't have a license pool for this work. That
-                # shouldn't happen--how did we know about the
-                # identifier?--but it shouldn't be a big deal to
-                # create one.
-                pool, ignore = LicensePool.for_foreign_id(
-                    self._db, self.data_source, identifier.type,
-                    identifier.identifier)
-                CirculationEvent.log(
-                    self._db, pool, CirculationEvent.TITLE_ADD,
-                    None, None, start=now)
-
-            if pool.edition:
-                self.log.info("Updating %s (%s)", pool.edition.title,
-                              pool.edition.author)
-            else:
-                self.log.info(
-                    "Updating unknown work %s", identifier.identifier
-                )
-            # Update availability and send out notifications.
-            pool.update_availability(
-                circ.get(LicensePool.licenses_owned, 0),
-                circ.get(LicensePool.licenses_available, 0),
-                circ.get(LicensePool.licenses_reserved, 0),
-                circ.get(LicensePool.patrons_in_hold_queue, 0))
-
+        updated = unchanged = created = removed = 0
+        for threem_ids, result in zip(requests, results):
+            if result is None:
+                # The request failed in the worker thread. Try once
+                # more; if this fails the whole batch fails.
+                result = self.fetch_circulation(threem_ids)
+            circulation, elapsed = result
+            for circ in circulation:
+                if not circ:
+                    continue
+                threem_id = circ[Identifier][Identifier.THREEM_ID]
+                identifier = identifiers_by_threem_id[threem_id]
+                identifiers_not_mentioned_by_threem.discard(identifier)
+
+                payload = [
+                    circ.get(LicensePool.licenses_owned, 0),
+                    circ.get(LicensePool.licenses_available, 0),
+                    circ.get(LicensePool.licenses_reserved, 0),
+                    circ.get(LicensePool.patrons_in_hold_queue, 0),
+                ]
+                if self.fingerprints.unchanged(threem_id, payload):
+                    # Nothing has changed since the last sweep.
+                    unchanged += 1
+                    continue
+
+                pool = identifier.licensed_through
+                if not pool:
+                    # We don't have a license pool for this work. That
+                    # shouldn't happen--how did we know about the
+                    # identifier?--but it shouldn't be a big deal to
+                    # create one.
+                    pool, ignore = LicensePool.for_foreign_id(
+                        self._db, self.data_source, identifier.type,
+                        identifier.identifier)
+                    CirculationEvent.log(
+                        self._db, pool, CirculationEvent.TITLE_ADD,
+                        None, None, start=now)
+                    created += 1
+
+                # Update availability and send out notifications.
+                pool.update_availability(*payload)
+                self.fingerprints.remember(threem_id, payload)
+                updated += 1
 
         # At this point there may be some license pools left over
         # that 3M doesn't know about.  This is a pretty reliable
         # indication that we no longer own any licenses to the
         # book.
+        removed_ids = []
         for identifier in identifiers_not_mentioned_by_threem:
+            self.fingerprints.forget(identifier.identifier)
             pool = identifier.licensed_through
             if not pool:
                 continue
-            if pool.edition:
-                self.log.warn("Removing %s (%s) from circulation",
-                              pool.edition.title, pool.edition.author)
-            else:
-                self.log.warn(
-                    "Removing unknown work %s from circulation.",
-                    identifier.identifier
-                )
-            pool.licenses_owned = 0
-            pool.licenses_available = 0
-            pool.licenses_reserved = 0
-            pool.patrons_in_hold_queue = 0
+            removed_ids.append(identifier.identifier)
+            # Go through update_availability() so the change is
+            # logged like any other.
+            pool.update_availability(0, 0, 0, 0)
             pool.last_checked = now
 
+        self.log.info(
+            "%d books in %d requests: %d updated (%d new), %d unchanged, %d removed.",
+            len(identifiers), len(requests), updated, created, unchanged,
+            len(removed_ids)
+        )
+        self._db.commit()
+        self.fingerprints.commit()
+        if removed_ids:
+            self.log.warn("Removed from circulation: %s",
+                          ", ".join(sorted(removed_ids)))
+
+
+class ThreeMAvailabilityRefresh(DemandWeightedRefreshMonitor):
+    """Keep availability fresh for the 3M books patrons are most
+    interested in, while still checking the whole collection over
+    time.
+    """
+
+    def __init__(self, _db, interval_seconds=60, testing=False):
+        # Batches are as big as the sweep wants them to be, so that
+        # every worker has a request to make.
+        super(ThreeMAvailabilityRefresh, self).__init__(
+            _db, "3M Availability Refresh",
+            ThreeMCirculationSweep(_db, testing=testing), DataSource.THREEM,
+            Identifier.THREEM_ID, interval_seconds=interval_seconds,
+            batch_size=None)
+
 
 class ThreeMEventMonitor(Monitor):
 
@@ -606,15 +778,31 @@ class ThreeMEventMonitor(Monitor):
 
     TWO_YEARS_AGO = datetime.timedelta(365*2)
 
+    # How many new books to look up in a single bibliographic request.
+    LOOKUP_BATCH_SIZE = 25
+
+    # How many times to try looking up a new book before leaving it to
+    # the ThreeMBibliographicCoverageProvider.
+    MAX_LOOKUP_ATTEMPTS = 3
+
+    # The most books without delivery mechanisms to pick up on startup.
+    STARTUP_LOOKUP_LIMIT = 1000
+
     def __init__(self, _db, default_start_time=None,
                  account_id=None, library_id=None, account_key=None,
-                 cli_date=None, testing=False):
+                 cli_date=None, testing=False, workers=5):
         self.service_name = "3M Event Monitor"
         if not default_start_time:
             default_start_time = self.create_default_start_time(_db, cli_date)
         super(ThreeMEventMonitor, self).__init__(
             _db, self.service_name, default_start_time=default_start_time)
         self.api = ThreeMAPI(self._db, testing=testing)
+        self.pending_lookups = None
+        # How many times each pending LicensePool has failed to be
+        # looked up, keyed by LicensePool ID.
+        self.lookup_attempts = {}
+        self.workers = workers
+        self.worker_pool = WorkerPool(workers)
 
     def create_default_start_time(self, _db, cli_date):
         """Sets the default start time if it's passed as an argument.
@@ -660,90 +848,315 @@ class ThreeMEventMonitor(Monitor):
             slice_start = slice_start + increment
 
     def run_once(self, start, cutoff):
-        added_books = 0
+        if self.pending_lookups is None:
+            # Pick up any new books that were never looked up, because
+            # an earlier run stopped before it got to them.
+            self.pending_lookups = self.pools_without_delivery_mechanisms()
         i = 0
         one_day = datetime.timedelta(days=1)
-        for start, cutoff, full_slice in self.slice_timespan(
-                start, cutoff, one_day):
-            most_recent_timestamp = start
-            self.log.info("Asking for events between %r and %r", start, cutoff)
-            try:
-                events = self.api.get_events_between(start, cutoff, full_slice)
-                for event in events:
-                    event_timestamp = self.handle_event(*event)
-                    if (not most_recent_timestamp or
-                        (event_timestamp > most_recent_timestamp)):
-                        most_recent_timestamp = event_timestamp
-                    i += 1
-                    if not i % 1000:
-                        self._db.commit()
+        slices = list(self.slice_timespan(start, cutoff, one_day))
+        most_recent_timestamp = None
+        # When catching up, fetch several slices at once, but apply
+        # them one at a time, in order.
+        for window_start in range(0, len(slices), self.workers):
+            window = slices[window_start:window_start+self.workers]
+            if len(window) > 1:
+                self.log.info(
+                    "Asking for events between %r and %r", window[0][0],
+                    window[-1][1]
+                )
+                prefetched = self.worker_pool.map(self.fetch_slice, window)
+            else:
+                prefetched = [None]
+            for (start, cutoff, full_slice), events in zip(window, prefetched):
+                if events is None:
+                    # Either this slice wasn't prefetched, or
+                    # prefetching it failed. Get it the normal way; if
+                    # that fails too, we stop here, before the
+                    # timestamp moves past this slice.
+                    self.log.info(
+                        "Asking for events between %r and %r", start, cutoff
+                    )
+                    events = list(
+                        self.api.get_events_between(start, cutoff, full_slice)
+                    )
+                most_recent_timestamp = start
+                try:
+                    event_timestamp = self.handle_events(events)
+                except Exception, e:
+                    self.log.error(
+                        "Fatal error processing 3M events between %r and %r.",
+                        start, cutoff, exc_info=e
+                    )
+                    raise e
+                if event_timestamp and event_timestamp > most_recent_timestamp:
+                    most_recent_timestamp = event_timestamp
+                i += len(events)
+                self.timestamp.timestamp = most_recent_timestamp
                 self._db.commit()
-            except Exception, e:
-                self.log.error("Fatal error processing 3M event %r.", event,
-                               exc_info=e)
-                raise e
-            self.timestamp.timestamp = most_recent_timestamp
+                self.process_pending_lookups()
         self.log.info("Handled %d events total", i)
         return most_recent_timestamp
 
+    def fetch_slice(self, slice):
+        """Fetch the events for a slice of time. Called from a worker
+        thread.
+        """
+        start, cutoff, full_slice = slice
+        return self.api.fetch_events_between(start, cutoff)
+
     def handle_event(self, threem_id, isbn, foreign_patron_id,
                      start_time, end_time, internal_event_type):
-        # Find or lookup the LicensePool for this event.
-        license_pool, is_new = LicensePool.for_foreign_id(
-            self._db, self.api.source, Identifier.THREEM_ID, threem_id)
+        return self.handle_events([
+            (threem_id, isbn, foreign_patron_id, start_time, end_time,
+             internal_event_type)
+        ])
 
-        if is_new:
-            # Add a DistributionMechanism. For the time being, assume
-            # that everything is EPUB.
+    def handle_events(self, events):
+        """Register a batch of events, such as a day's worth.
 
-            metadata = self.api.bibliographic_lookup(
-                license_pool.identifier
-            )
-            for format in metadata.formats:
-                mech = license_pool.set_delivery_mechanism(
-                    format.content_type,
-                    format.drm_scheme,
-                    format.link
-                )
+        The LicensePools, ISBNs, Editions and equivalencies the events
+        mention are looked up a few queries at a time, rather than a
+        few queries per event, and the CirculationEvents are inserted
+        in bulk. Events we've already registered are ignored.
 
-        # Force the ThreeMCirculationMonitor to check on this book the
-        # next time it runs.
-        license_pool.last_checked = None
+        :return: The start time of the latest event.
+        """
+        if not events:
+            return None
+        _db = self._db
+        source = self.api.source
+        threem_ids = set(x[0] for x in events)
+        isbns = set(x[1] for x in events if x[1])
+
+        # Find or create a LicensePool for every book.
+        pools = dict()
+        qu = _db.query(LicensePool).join(LicensePool.identifier).filter(
+            LicensePool.data_source==source).filter(
+                Identifier.type==Identifier.THREEM_ID).filter(
+                    Identifier.identifier.in_(threem_ids)).options(
+                        contains_eager(LicensePool.identifier))
+        for pool in qu:
+            pools[pool.identifier.identifier] = pool
+        new_pools = set()
+        for threem_id in threem_ids - set(pools):
+            license_pool, is_new = LicensePool.for_foreign_id(
+                _db, source, Identifier.THREEM_ID, threem_id)
+            if is_new:
+                self.new_license_pool(license_pool)
+                new_pools.add(license_pool)
+            pools[threem_id] = license_pool
+
+        for license_pool in pools.values():
+            # Force the ThreeMCirculationMonitor to check on this book
+            # the next time it runs.
+            license_pool.last_checked = None
+
+        # Find or create the ISBNs.
+        isbn_identifiers = dict()
+        if isbns:
+            qu = _db.query(Identifier).filter(
+                Identifier.type==Identifier.ISBN).filter(
+                    Identifier.identifier.in_(isbns))
+            for identifier in qu:
+                isbn_identifiers[identifier.identifier] = identifier
+        for isbn in isbns - set(isbn_identifiers):
+            isbn_identifiers[isbn], ignore = Identifier.for_foreign_id(
+                _db, Identifier.ISBN, isbn)
+
+        # Find or create an Edition for every book.
+        pools_by_identifier_id = dict(
+            (pool.identifier.id, pool) for pool in pools.values()
+        )
+        editions = dict()
+        qu = _db.query(Edition).filter(
+            Edition.data_source_id==source.id).filter(
+                Edition.primary_identifier_id.in_(
+                    pools_by_identifier_id.keys()))
+        for edition in qu:
+            pool = pools_by_identifier_id[edition.primary_identifier_id]
+            editions[pool.identifier.identifier] = edition
+        for threem_id in threem_ids - set(editions):
+            editions[threem_id], ignore = Edition.for_foreign_id(
+                _db, source, Identifier.THREEM_ID, threem_id)
 
-        threem_identifier = license_pool.identifier
-        isbn, ignore = Identifier.for_foreign_id(
-            self._db, Identifier.ISBN, isbn)
+        # The ISBN and the 3M identifier are exactly equivalent.
+        pairs = set()
+        for event in events:
+            threem_id, isbn = event[0], event[1]
+            if isbn:
+                pairs.add((pools[threem_id].identifier, isbn_identifiers[isbn]))
+        if pairs:
+            qu = _db.query(
+                Equivalency.input_id, Equivalency.output_id).filter(
+                    Equivalency.data_source_id==source.id).filter(
+                        Equivalency.input_id.in_(
+                            set(x.id for x, y in pairs)))
+            existing = set(qu)
+            for threem_identifier, isbn in pairs:
+                if (threem_identifier.id, isbn.id) not in existing:
+                    threem_identifier.equivalent_to(source, isbn, strength=1)
+
+        # Log the events we haven't seen before.
+        _db.flush()
+        self.insert_circulation_events(events, pools, new_pools)
 
-        edition, ignore = Edition.for_foreign_id(
-            self._db, self.api.source, Identifier.THREEM_ID, threem_id)
+        most_recent_timestamp = None
+        for (threem_id, isbn, foreign_patron_id, start_time, end_time,
+             internal_event_type) in events:
+            title = editions[threem_id].title or "[no title]"
+            self.log.info("%r %s: %s", start_time, title, internal_event_type)
+            if not most_recent_timestamp or start_time > most_recent_timestamp:
+                most_recent_timestamp = start_time
+        return most_recent_timestamp
 
-        # The ISBN and the 3M identifier are exactly equivalent.
-        threem_identifier.equivalent_to(self.api.source, isbn, strength=1)
-
-        # Log the event.
-        event, was_new = get_one_or_create(
-            self._db, CirculationEvent, license_pool=license_pool,
-            type=internal_event_type, start=start_time,
-            foreign_patron_id=foreign_patron_id,
-            create_method_kwargs=dict(delta=1,end=end_time)
-            )
+    def new_license_pool(self, license_pool):
+        """Queue a LicensePool we've never seen before to be looked up
+        once we're done with the current batch of events.
+        """
+        if self.pending_lookups is None:
+            self.pending_lookups = []
+        self.pending_lookups.append(license_pool)
+
+    def pools_without_delivery_mechanisms(self):
+        """Find new books that an earlier run never looked up.
 
-        # If this is our first time seeing this LicensePool, log its
-        # occurance as a separate event
-        if is_new:
-            event = get_one_or_create(
-                self._db, CirculationEvent,
-                type=CirculationEvent.TITLE_ADD,
-                license_pool=license_pool,
-                create_method_kwargs=dict(
-                    start=license_pool.last_checked or start_time,
-                    delta=1,
-                    end=license_pool.last_checked or end_time,
+        Books the ThreeMBibliographicCoverageProvider has already
+        covered (or failed to cover) are left alone; looking them up
+        again won't turn up anything new.
+        """
+        covered = self._db.query(CoverageRecord.identifier_id).filter(
+            CoverageRecord.data_source==self.api.source)
+        return self._db.query(LicensePool).filter(
+            LicensePool.data_source==self.api.source).filter(
+                ~LicensePool.delivery_mechanisms.any()).filter(
+                    ~LicensePool.identifier_id.in_(covered)).order_by(
+                        LicensePool.id).limit(self.STARTUP_LOOKUP_LIMIT).all()
+
+    def process_pending_lookups(self):
+        """Look up the new books LOOKUP_BATCH_SIZE at a time, and add a
+        DeliveryMechanism for every format 3M says each one is available
+        in.
+
+        The rest of the bibliographic information is filled in by the
+        ThreeMBibliographicCoverageProvider. A book that can't be looked
+        up after MAX_LOOKUP_ATTEMPTS tries is left to it entirely.
+        """
+        pending = self.pending_lookups or []
+        self.pending_lookups = []
+        for start in range(0, len(pending), self.LOOKUP_BATCH_SIZE):
+            batch = pending[start:start+self.LOOKUP_BATCH_SIZE]
+            try:
+                metadata_by_id = self.api.bibliographic_lookup_batch(
+                    [x.identifier for x in batch]
                 )
+            except Exception, e:
+                self.log.error(
+                    "Could not look up %d new books.", len(batch), exc_info=e
+                )
+                self.lookup_failed(batch)
+                continue
+            for license_pool in batch:
+                self.lookup_attempts.pop(license_pool.id, None)
+                metadata = metadata_by_id.get(license_pool.identifier.identifier)
+                if not metadata:
+                    # Record the failure, so neither we nor the
+                    # coverage provider keep asking about this book.
+                    self.log.warn(
+                        "3M has no bibliographic information for new book %s",
+                        license_pool.identifier.identifier
+                    )
+                    record, is_new = CoverageRecord.add_for(
+                        license_pool.identifier, self.api.source
+                    )
+                    record.exception = (
+                        "3M has no bibliographic information for this book."
+                    )
+                    continue
+                for format in metadata.formats:
+                    mech = license_pool.set_delivery_mechanism(
+                        format.content_type,
+                        format.drm_scheme,
+                        format.link
+                    )
+            self._db.commit()
+
+    def lookup_failed(self, batch):
+        """Try a batch of books again after the next batch of events,
+        unless they've already been tried too many times.
+        """
+        for license_pool in batch:
+            attempts = self.lookup_attempts.get(license_pool.id, 0) + 1
+            if attempts < self.MAX_LOOKUP_ATTEMPTS:
+                self.lookup_attempts[license_pool.id] = attempts
+                self.pending_lookups.append(license_pool)
+            else:
+                self.lookup_attempts.pop(license_pool.id, None)
+                self.log.warn(
+                    "Giving up on new book %s after %d lookups; the "
+                    "coverage provider will pick it up.",
+                    license_pool.identifier.identifier, attempts
+                )
+
+    def insert_circulation_events(self, events, pools, new_pools):
+        """Insert a CirculationEvent for every event, and a TITLE_ADD
+        event for every new LicensePool, unless an identical event
+        already exists.
+
+        Events are identified by their LicensePool, type, start time
+        and patron.
+        """
+        _db = self._db
+        rows = []
+        for (threem_id, isbn, foreign_patron_id, start_time, end_time,
+             internal_event_type) in events:
+            rows.append(dict(
+                license_pool_id=pools[threem_id].id,
+                type=internal_event_type, start=start_time, end=end_time,
+                foreign_patron_id=foreign_patron_id, delta=1,
+            ))
+        # If this is our first time seeing a LicensePool, log its
+        # occurance as a separate event.
+        for threem_id, pool in pools.items():
+            if pool not in new_pools:
+                continue
+            [start_time, end_time] = min(
+                (x[3], x[4]) for x in events if x[0] == threem_id
             )
-        title = edition.title or "[no title]"
-        self.log.info("%r %s: %s", start_time, title, internal_event_type)
-        return start_time
+            rows.append(dict(
+                license_pool_id=pool.id, type=CirculationEvent.TITLE_ADD,
+                start=start_time, end=end_time, foreign_patron_id=None,
+                delta=1
+            ))
+
+        def key(row):
+            return (row['license_pool_id'], row['type'], row['start'],
+                    row['foreign_patron_id'])
+
+        # Find the events we already know about. They all start
+        # within this batch's span of time.
+        starts = [x['start'] for x in rows]
+        qu = _db.query(
+            CirculationEvent.license_pool_id, CirculationEvent.type,
+            CirculationEvent.start, CirculationEvent.foreign_patron_id
+        ).filter(
+            CirculationEvent.license_pool_id.in_(
+                set(x['license_pool_id'] for x in rows))
+        ).filter(
+            CirculationEvent.start >= min(starts)
+        ).filter(
+            CirculationEvent.start <= max(starts)
+        )
+        seen = set(qu)
+        new_rows = []
+        for row in rows:
+            if key(row) in seen:
+                continue
+            seen.add(key(row))
+            new_rows.append(row)
+        if new_rows:
+            _db.execute(CirculationEvent.__table__.insert(), new_rows)
+        return len(new_rows)
 
 
 class ThreeMCirculationMonitor(Monitor):
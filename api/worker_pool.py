@@ -0,0 +1,70 @@
+from nose.tools import set_trace
+import logging
+import Queue
+from threading import (
+    Thread,
+    local,
+)
+
+
+class WorkerPool(object):
+    """Run a function over a list of items using a fixed number of
+    threads, and return the results in the same order as the items.
+
+    This is meant for work that spends most of its time waiting on
+    HTTP requests. The function must not touch the database, since
+    the database session belongs to the main thread: fetch in the pool,
+    then apply the results in the main thread.
+    """
+
+    _thread_state = local()
+
+    @classmethod
+    def in_worker_thread(cls):
+        """Is the current thread one of a WorkerPool's threads?"""
+        return getattr(cls._thread_state, 'worker', False)
+
+    def __init__(self, size=5):
+        self.size = size
+        self.log = logging.getLogger("Worker pool")
+
+    def map(self, function, items):
+        """Call `function` on every item.
+
+        :return: A list of results, in the same order as `items`. If
+        `function` raises an exception for an item, the exception is
+        logged and the result for that item is None.
+        """
+        items = list(items)
+        results = [None] * len(items)
+        if self.size <= 1 or len(items) <= 1:
+            for i, item in enumerate(items):
+                results[i] = self._call(function, item)
+            return results
+
+        queue = Queue.Queue()
+        for i, item in enumerate(items):
+            queue.put((i, item))
+
+        def work():
+            self._thread_state.worker = True
+            while True:
+                try:
+                    i, item = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                results[i] = self._call(function, item)
+
+        threads = [Thread(target=work) for i in range(min(self.size, len(items)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def _call(self, function, item):
+        try:
+            return function(item)
+        except Exception, e:
+            self.log.error("Error processing %r", item, exc_info=e)
+            return None
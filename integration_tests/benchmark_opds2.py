@@ -0,0 +1,110 @@
+# encoding: utf-8
+"""Compare the time it takes to render the same works as an Atom feed
+and as an OPDS 2 JSON feed, and the size of the results.
+
+OPDS 2 documents are built three ways, as the circulation manager
+builds them: straight from the works, by converting a cached Atom
+feed, and from a streaming feed (as with a patron's bookshelf).
+
+Usage: benchmark_opds2.py [number of works] [number of rounds]
+"""
+import os
+import sys
+import time
+import numpy
+
+bin_dir = os.path.split(__file__)[0]
+package_dir = os.path.join(bin_dir, "..")
+sys.path.append(os.path.abspath(package_dir))
+
+from core.model import (
+    Work,
+    production_session,
+)
+from core.opds import AcquisitionFeed
+from api.opds import (
+    CirculationManagerAnnotator,
+    StreamingAcquisitionFeed,
+)
+from api.opds2 import OPDS2Serializer
+
+
+def render_atom(_db, works, annotator):
+    feed = AcquisitionFeed(_db, "Benchmark", "http://benchmark/", works,
+                           annotator)
+    return unicode(feed).encode("utf8")
+
+def render_opds2(_db, works, annotator):
+    document = OPDS2Serializer(annotator).feed(
+        "Benchmark", "http://benchmark/", works
+    )
+    return OPDS2Serializer.to_json(document)
+
+def render_streaming_atom(_db, works, annotator):
+    feed = StreamingAcquisitionFeed(_db, "Benchmark", "http://benchmark/",
+                                    works, annotator)
+    return unicode(feed).encode("utf8")
+
+def render_streaming_opds2(_db, works, annotator):
+    feed = StreamingAcquisitionFeed(_db, "Benchmark", "http://benchmark/",
+                                    works, annotator)
+    document = OPDS2Serializer.streaming_feed(feed, "http://benchmark/")
+    return OPDS2Serializer.to_json(document)
+
+def converter(atom):
+    """Make a renderer that converts an already-rendered Atom feed, the
+    way a cached lane feed is served as OPDS 2.
+    """
+    def render_opds2_from_atom(_db, works, annotator):
+        return OPDS2Serializer.to_json(OPDS2Serializer.from_atom(atom))
+    return render_opds2_from_atom
+
+def benchmark(name, render, _db, works, annotator, rounds):
+    elapsed = []
+    for i in range(rounds):
+        a = time.time()
+        output = render(_db, works, annotator)
+        elapsed.append(time.time()-a)
+    print "%s" % name
+    print "------------------"
+    print "Mean time elapsed: %.4f" % numpy.mean(elapsed)
+    print "Median time elapsed: %.4f" % numpy.median(elapsed)
+    print "Max time elapsed: %.4f" % numpy.max(elapsed)
+    print "Bytes: %d" % len(output)
+    print ""
+    return numpy.mean(elapsed), len(output)
+
+size = 50
+rounds = 20
+if len(sys.argv) > 1:
+    size = int(sys.argv[1])
+if len(sys.argv) > 2:
+    rounds = int(sys.argv[2])
+
+_db = production_session()
+works = _db.query(Work).filter(Work.presentation_ready==True).limit(size).all()
+annotator = CirculationManagerAnnotator(None, None, test_mode=True)
+print "Rendering %d works, %d rounds each." % (len(works), rounds)
+print ""
+
+atom_time, atom_bytes = benchmark(
+    "Atom", render_atom, _db, works, annotator, rounds)
+json_time, json_bytes = benchmark(
+    "OPDS 2 JSON", render_opds2, _db, works, annotator, rounds)
+cached_atom = render_atom(_db, works, annotator)
+converted_time, converted_bytes = benchmark(
+    "OPDS 2 JSON from cached Atom", converter(cached_atom), _db, works,
+    annotator, rounds)
+streaming_atom_time, streaming_atom_bytes = benchmark(
+    "Streaming Atom", render_streaming_atom, _db, works, annotator, rounds)
+streaming_json_time, streaming_json_bytes = benchmark(
+    "Streaming OPDS 2 JSON", render_streaming_opds2, _db, works, annotator,
+    rounds)
+
+print "OPDS 2 JSON takes %.0f%% of the time and %.0f%% of the bytes." % (
+    100.0 * json_time / atom_time, 100.0 * json_bytes / atom_bytes)
+print "Converting cached Atom takes %.0f%% of the time of rendering Atom." % (
+    100.0 * converted_time / atom_time)
+print "Streaming OPDS 2 JSON takes %.0f%% of the time and %.0f%% of the bytes of streaming Atom." % (
+    100.0 * streaming_json_time / streaming_atom_time,
+    100.0 * streaming_json_bytes / streaming_atom_bytes)
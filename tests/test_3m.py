@@ -1,21 +1,32 @@
-from nose.tools import set_trace, eq_
+from nose.tools import set_trace, eq_, assert_raises
 import datetime
 import pkgutil
 from api.threem import (
     CirculationParser,
     EventParser,
     ErrorParser,
+    ThreeMAvailabilityRefresh,
+    ThreeMCirculationSweep,
     ThreeMEventMonitor,
 )
 from core.model import (
     CirculationEvent,
     Contributor,
+    CoverageRecord,
     DataSource,
+    DeliveryMechanism,
+    Equivalency,
     LicensePool,
+    Representation,
     Resource,
     Identifier,
     Edition,
-    Timestamp
+    Timestamp,
+    get_one_or_create,
+)
+from core.metadata_layer import (
+    FormatData,
+    Metadata,
 )
 from . import DatabaseTest
 from api.circulation_exceptions import *
@@ -235,3 +246,268 @@ class TestThreeMEventMonitor(DatabaseTest):
     proper_args = ['2013-04-02']
     default_start_time = monitor.create_default_start_time(self._db, proper_args)
     eq_(datetime.datetime(2013, 4, 2), default_start_time)
+
+  def test_handle_events(self):
+    monitor = ThreeMEventMonitor(self._db, testing=True)
+    edition, pool = self._edition(
+      data_source_name=DataSource.THREEM,
+      identifier_type=Identifier.THREEM_ID,
+      with_license_pool=True
+    )
+    threem_id = pool.identifier.identifier
+    pool.last_checked = datetime.datetime.utcnow()
+    t1 = datetime.datetime(2015, 1, 1, 10)
+    t2 = datetime.datetime(2015, 1, 1, 11)
+    checkout = (threem_id, "9781453219539", "patron1", t1, t2,
+                CirculationEvent.CHECKOUT)
+    checkin = (threem_id, "9781453219539", "patron1", t2, None,
+               CirculationEvent.CHECKIN)
+
+    # An event that shows up twice in the same batch is only
+    # registered once.
+    eq_(t2, monitor.handle_events([checkout, checkout, checkin]))
+    eq_(None, pool.last_checked)
+    eq_([CirculationEvent.CHECKOUT, CirculationEvent.CHECKIN],
+        [x.type for x in self._db.query(CirculationEvent).order_by(
+          CirculationEvent.start)])
+
+    # The 3M ID is now equivalent to the ISBN.
+    [equivalency] = self._db.query(Equivalency).filter(
+      Equivalency.input_id==pool.identifier.id).all()
+    eq_(Identifier.ISBN, equivalency.output.type)
+    eq_("9781453219539", equivalency.output.identifier)
+
+    # Handling the same events again doesn't register them again.
+    monitor.handle_events([checkout, checkin])
+    eq_(2, self._db.query(CirculationEvent).count())
+
+  def test_new_books_are_looked_up_in_batches(self):
+    monitor = ThreeMEventMonitor(self._db, testing=True)
+    t1 = datetime.datetime(2015, 1, 1, 10)
+    monitor.handle_events([
+      ("newbook", None, "patron1", t1, None, CirculationEvent.CHECKOUT)
+    ])
+
+    # The new book wasn't looked up right away; it was queued.
+    [pool] = monitor.pending_lookups
+    eq_("newbook", pool.identifier.identifier)
+    eq_([], pool.delivery_mechanisms)
+
+    looked_up = []
+    def lookup(identifiers):
+      looked_up.append([x.identifier for x in identifiers])
+      return dict(newbook=Metadata(
+        DataSource.THREEM,
+        formats=[FormatData(Representation.EPUB_MEDIA_TYPE,
+                            DeliveryMechanism.ADOBE_DRM)]
+      ))
+    monitor.api.bibliographic_lookup_batch = lookup
+    monitor.LOOKUP_BATCH_SIZE = 1
+    monitor.process_pending_lookups()
+    eq_([["newbook"]], looked_up)
+    eq_([], monitor.pending_lookups)
+    [mechanism] = pool.delivery_mechanisms
+    eq_(Representation.EPUB_MEDIA_TYPE,
+        mechanism.delivery_mechanism.content_type)
+
+  def test_failed_lookups_are_retried(self):
+    monitor = ThreeMEventMonitor(self._db, testing=True)
+    t1 = datetime.datetime(2015, 1, 1, 10)
+    monitor.handle_events([
+      ("newbook", None, "patron1", t1, None, CirculationEvent.CHECKOUT)
+    ])
+    [pool] = monitor.pending_lookups
+
+    def lookup(identifiers):
+      raise IOError("Server gave status code 500")
+    monitor.api.bibliographic_lookup_batch = lookup
+    monitor.process_pending_lookups()
+
+    # The book is still waiting to be looked up.
+    eq_([pool], monitor.pending_lookups)
+    eq_([], pool.delivery_mechanisms)
+
+    # But not forever. After too many failures, it's left for the
+    # bibliographic coverage provider.
+    for i in range(monitor.MAX_LOOKUP_ATTEMPTS - 1):
+      monitor.process_pending_lookups()
+    eq_([], monitor.pending_lookups)
+    eq_({}, monitor.lookup_attempts)
+    eq_([], self._db.query(CoverageRecord).all())
+
+  def test_failure_recorded_when_book_has_no_information(self):
+    monitor = ThreeMEventMonitor(self._db, testing=True)
+    t1 = datetime.datetime(2015, 1, 1, 10)
+    monitor.handle_events([
+      ("deadbook", None, "patron1", t1, None, CirculationEvent.CHECKOUT)
+    ])
+    [pool] = monitor.pending_lookups
+    eq_([pool], monitor.pools_without_delivery_mechanisms())
+
+    monitor.api.bibliographic_lookup_batch = lambda identifiers: {}
+    monitor.process_pending_lookups()
+    eq_([], monitor.pending_lookups)
+
+    # The failure was recorded, so the book won't be picked up again
+    # the next time the monitor starts.
+    [record] = self._db.query(CoverageRecord).all()
+    eq_(pool.identifier, record.identifier)
+    eq_(DataSource.THREEM, record.data_source.name)
+    assert "no bibliographic information" in record.exception
+    eq_([], monitor.pools_without_delivery_mechanisms())
+
+  def test_startup_lookups_are_limited(self):
+    monitor = ThreeMEventMonitor(self._db, testing=True)
+    t1 = datetime.datetime(2015, 1, 1, 10)
+    monitor.handle_events([
+      (threem_id, None, "patron1", t1, None, CirculationEvent.CHECKOUT)
+      for threem_id in ("book1", "book2", "book3")
+    ])
+    pools = sorted(monitor.pending_lookups, key=lambda x: x.id)
+    monitor.STARTUP_LOOKUP_LIMIT = 2
+    eq_(pools[:2], monitor.pools_without_delivery_mechanisms())
+
+  def test_slices_are_fetched_concurrently_and_applied_in_order(self):
+    monitor = ThreeMEventMonitor(self._db, testing=True, workers=3)
+    monitor.pending_lookups = []
+    monitor.timestamp, ignore = get_one_or_create(
+      self._db, Timestamp, service=monitor.service_name
+    )
+    day = datetime.timedelta(days=1)
+    start = datetime.datetime(2015, 1, 1)
+    bad_day = start + 3 * day
+
+    prefetched = []
+    def fetch_events_between(slice_start, slice_cutoff):
+      prefetched.append(slice_start)
+      if slice_start == bad_day:
+        raise IOError("Server gave status code 500")
+      return [slice_start + datetime.timedelta(hours=1)]
+    fetched_normally = []
+    def get_events_between(slice_start, slice_cutoff, full_slice):
+      fetched_normally.append(slice_start)
+      raise IOError("Server gave status code 500")
+    applied = []
+    def handle_events(events):
+      applied.extend(events)
+      return events[0]
+    monitor.api.fetch_events_between = fetch_events_between
+    monitor.api.get_events_between = get_events_between
+    monitor.handle_events = handle_events
+
+    assert_raises(IOError, monitor.run_once, start, start + 5 * day)
+
+    # Days 0-2 were fetched together, then days 3-4.
+    eq_(set(start + x * day for x in range(5)), set(prefetched))
+
+    # Days 0-2 were applied in order. Day 3 couldn't be fetched, even
+    # when we tried again, so we stopped there, and day 4 was never
+    # applied.
+    eq_([start + x * day + datetime.timedelta(hours=1) for x in range(3)],
+        applied)
+    eq_([bad_day], fetched_normally)
+    eq_(applied[-1], monitor.timestamp.timestamp)
+
+
+class TestThreeMCirculationSweep(DatabaseTest):
+
+    def test_requests_for(self):
+        sweep = ThreeMCirculationSweep(self._db, testing=True)
+        sweep.request_size = 3
+        ids = ["id%d" % x for x in range(7)]
+        eq_([ids[0:3], ids[3:6], ids[6:]], sweep.requests_for(ids))
+
+        # No request is allowed to have a URL that's too long.
+        sweep.request_size = 100
+        base_url = sweep.api.full_url(sweep.api.CIRCULATION_PATH)
+        sweep.MAX_URL_LENGTH = len(base_url) + 8
+        eq_([ids[0:2], ids[2:4], ids[4:6], ids[6:]], sweep.requests_for(ids))
+
+    def test_batch_size_keeps_every_worker_busy(self):
+        sweep = ThreeMCirculationSweep(self._db, testing=True, workers=4)
+        sweep.request_size = 10
+        eq_(40, sweep.batch_size)
+        ids = ["id%d" % x for x in range(sweep.batch_size)]
+        eq_(4, len(sweep.requests_for(ids)))
+
+        # The batch size follows the request size.
+        sweep.request_size = 20
+        eq_(80, sweep.batch_size)
+
+        # Unless it was set explicitly.
+        sweep = ThreeMCirculationSweep(self._db, testing=True, batch_size=7)
+        eq_(7, sweep.batch_size)
+
+        # The availability refresh uses the sweep's batch size.
+        refresh = ThreeMAvailabilityRefresh(self._db, testing=True)
+        refresh.sweep.request_size = 10
+        eq_(10 * refresh.sweep.workers, refresh.batch_size)
+
+    def test_requests_for_counts_the_whole_url(self):
+        sweep = ThreeMCirculationSweep(self._db, testing=True)
+        sweep.request_size = 100
+        ids = ["%020d" % x for x in range(50)]
+        # The IDs alone would fit in one request, but not once the
+        # base URL and a long library ID are added.
+        assert (len(sweep.api.CIRCULATION_PATH + ",".join(ids))
+                < sweep.MAX_URL_LENGTH)
+        sweep.api.library_id = "l" * 1000
+        requests = sweep.requests_for(ids)
+        eq_(2, len(requests))
+        eq_(ids, sum(requests, []))
+        for request in requests:
+            url = sweep.api.full_url(
+                sweep.api.CIRCULATION_PATH + ",".join(request)
+            )
+            assert len(url) <= sweep.MAX_URL_LENGTH
+
+    def test_adjust_request_size(self):
+        sweep = ThreeMCirculationSweep(self._db, testing=True)
+        sweep.request_size = 20
+        sweep.adjust_request_size([1, 2], 0)
+        eq_(25, sweep.request_size)
+        sweep.adjust_request_size([1, sweep.TARGET_RESPONSE_TIME + 1], 0)
+        eq_(12, sweep.request_size)
+        sweep.adjust_request_size([1], 1)
+        eq_(6, sweep.request_size)
+        sweep.adjust_request_size([1], 1)
+        eq_(sweep.MIN_REQUEST_SIZE, sweep.request_size)
+
+    def test_process_batch(self):
+        sweep = ThreeMCirculationSweep(self._db, testing=True, workers=2)
+        sweep.request_size = 1
+        ignore, kept = self._edition(
+            data_source_name=DataSource.THREEM,
+            identifier_type=Identifier.THREEM_ID,
+            with_license_pool=True
+        )
+        ignore, removed = self._edition(
+            data_source_name=DataSource.THREEM,
+            identifier_type=Identifier.THREEM_ID,
+            with_license_pool=True
+        )
+        kept_id = kept.identifier.identifier
+
+        requests = []
+        def get_circulation_for(threem_ids):
+            requests.append(threem_ids)
+            if threem_ids == [kept_id]:
+                yield {
+                    Identifier: {Identifier.THREEM_ID: kept_id},
+                    LicensePool.licenses_owned: 5,
+                    LicensePool.licenses_available: 2,
+                    LicensePool.licenses_reserved: 0,
+                    LicensePool.patrons_in_hold_queue: 1,
+                }
+        sweep.api.get_circulation_for = get_circulation_for
+        sweep.process_batch([kept.identifier, removed.identifier])
+
+        # Each book was asked about in a separate request.
+        eq_(2, len(requests))
+        eq_(5, kept.licenses_owned)
+        eq_(2, kept.licenses_available)
+        eq_(1, kept.patrons_in_hold_queue)
+
+        # 3M didn't mention the other book, so it was taken out of
+        # circulation.
+        eq_(0, removed.licenses_owned)
@@ -0,0 +1,147 @@
+import datetime
+from nose.tools import (
+    eq_,
+    set_trace,
+)
+
+from core.model import (
+    CirculationEvent,
+    DataSource,
+    Identifier,
+)
+
+from api.availability_refresh import (
+    AvailabilityRefreshSchedule,
+    DemandWeightedRefreshMonitor,
+)
+
+from . import DatabaseTest
+
+
+class MockSweep(object):
+
+    def __init__(self, _db):
+        self._db = _db
+        self.batches = []
+
+    def identifier_query(self):
+        return self._db.query(Identifier).join(
+            Identifier.licensed_through).filter(
+                Identifier.type==Identifier.OVERDRIVE_ID)
+
+    def process_batch(self, identifiers):
+        self.batches.append(identifiers)
+
+
+class TestAvailabilityRefresh(DatabaseTest):
+
+    def _pool(self, hours_since_checked):
+        edition, pool = self._edition(
+            data_source_name=DataSource.OVERDRIVE,
+            identifier_type=Identifier.OVERDRIVE_ID,
+            with_license_pool=True
+        )
+        if hours_since_checked is None:
+            pool.last_checked = None
+        else:
+            pool.last_checked = self.now - datetime.timedelta(
+                hours=hours_since_checked)
+        return pool
+
+    def setup(self):
+        super(TestAvailabilityRefresh, self).setup()
+        self.now = datetime.datetime.utcnow()
+        self.quiet = self._pool(2)
+        self.popular = self._pool(2)
+        self.popular.patrons_in_hold_queue = 3
+        self.borrowed = self._pool(1.5)
+        self._db.add(CirculationEvent(
+            license_pool=self.borrowed, type=CirculationEvent.CHECKOUT,
+            start=self.now - datetime.timedelta(days=1), delta=1
+        ))
+        self.neglected = self._pool(24 * 3)
+        self.never_checked = self._pool(None)
+        self.just_checked = self._pool(0)
+        self._db.flush()
+
+    def test_next_batch(self):
+        schedule = AvailabilityRefreshSchedule(
+            self._db, DataSource.OVERDRIVE, Identifier.OVERDRIVE_ID
+        )
+        batch = schedule.next_batch(10, self.now)
+
+        # Books that have never been checked come first. Then come
+        # books in demand, even if they were checked more recently
+        # than books nobody wants. The book that was just checked
+        # isn't included at all.
+        eq_([self.never_checked, self.neglected, self.popular,
+             self.borrowed, self.quiet],
+            [x.licensed_through for x in batch])
+
+        eq_([self.never_checked.identifier],
+            schedule.next_batch(1, self.now))
+
+        # Books can be left out.
+        batch = schedule.next_batch(
+            10, self.now, exclude=[self.never_checked.identifier.id,
+                                   self.popular.identifier.id])
+        eq_([self.neglected, self.borrowed, self.quiet],
+            [x.licensed_through for x in batch])
+
+    def test_popular_book_beats_long_tail_book(self):
+        # This book is in demand, but it was checked a few hours ago.
+        hot = self._pool(8)
+        hot.patrons_in_hold_queue = 3
+        self._db.flush()
+        schedule = AvailabilityRefreshSchedule(
+            self._db, DataSource.OVERDRIVE, Identifier.OVERDRIVE_ID
+        )
+        batch = schedule.next_batch(2, self.now)
+
+        # Nobody has wanted the neglected book for three days, but a
+        # book is never staler than the staleness cap, so the book
+        # patrons are waiting for comes first.
+        eq_([self.never_checked, hot], [x.licensed_through for x in batch])
+
+    def test_run_once(self):
+        sweep = MockSweep(self._db)
+        monitor = DemandWeightedRefreshMonitor(
+            self._db, "Test Refresh", sweep, DataSource.OVERDRIVE,
+            Identifier.OVERDRIVE_ID, batch_size=2, batches_per_run=2
+        )
+        rankings = []
+        next_batch = monitor.schedule.next_batch
+        def counting_next_batch(size, now=None, exclude=None):
+            rankings.append(size)
+            return next_batch(size, now, exclude)
+        monitor.schedule.next_batch = counting_next_batch
+        monitor.run_once(None, None)
+
+        # The first batch continued the ID-order pass through the
+        # collection. The rest of the budget went to the books that
+        # most needed it, ranked once.
+        eq_([2], rankings)
+        eq_([[self.quiet.identifier, self.popular.identifier],
+             [self.never_checked.identifier, self.neglected.identifier]],
+            sweep.batches)
+        for pool in (self.quiet, self.popular, self.never_checked,
+                     self.neglected):
+            assert pool.last_checked > self.now
+        eq_(self.popular.identifier.id, monitor.reap_cursor().counter)
+
+        # The ID-order pass picks up where it left off. Every other
+        # book was checked too recently to be refreshed again.
+        monitor.run_once(None, None)
+        eq_([[self.borrowed.identifier, self.neglected.identifier]],
+            sweep.batches[2:])
+
+        # When the pass reaches the end of the collection, it starts
+        # over.
+        monitor.run_once(None, None)
+        eq_([self.never_checked.identifier, self.just_checked.identifier],
+            sweep.batches[3])
+        monitor.run_once(None, None)
+        eq_(0, monitor.reap_cursor().counter)
+        monitor.run_once(None, None)
+        eq_([self.quiet.identifier, self.popular.identifier],
+            sweep.batches[-1])
@@ -1,3 +1,4 @@
+import copy
 import datetime
 from nose.tools import (
     eq_, 
@@ -32,6 +33,8 @@ from api.axis import (
     HoldReleaseResponseParser,
 )
 
+from api.payload_fingerprint import PayloadFingerprints
+
 from . import (
     DatabaseTest,
 )
@@ -125,6 +128,77 @@ class TestCirculationMonitor(DatabaseTest):
         for e in events:
             eq_(e.start, license_pool.last_checked)
 
+    def test_process_book_skips_unchanged_availability(self):
+        monitor = Axis360CirculationMonitor(self._db)
+        monitor.api = None
+        edition, license_pool = monitor.process_book(
+            self.BIBLIOGRAPHIC_DATA, self.AVAILABILITY_DATA)
+
+        # Until it's committed, the same data is applied again.
+        edition2, license_pool2 = monitor.process_book(
+            self.BIBLIOGRAPHIC_DATA, self.AVAILABILITY_DATA)
+        eq_(license_pool, license_pool2)
+
+        # Once it's committed, the same data a second time is ignored.
+        monitor.commit()
+        eq_((None, None), monitor.process_book(
+            self.BIBLIOGRAPHIC_DATA, self.AVAILABILITY_DATA))
+
+        # Only availability is fingerprinted, so a book whose
+        # bibliographic data looks different is still skipped.
+        retitled = copy.deepcopy(self.BIBLIOGRAPHIC_DATA)
+        retitled.title = u"A new title"
+        eq_((None, None), monitor.process_book(
+            retitled, self.AVAILABILITY_DATA))
+
+        # Different availability is applied.
+        changed = CirculationData(
+            licenses_owned=9,
+            licenses_available=7,
+            licenses_reserved=0,
+            patrons_in_hold_queue=0,
+            last_checked=datetime.datetime(2015, 5, 21),
+        )
+        edition2, license_pool2 = monitor.process_book(
+            self.BIBLIOGRAPHIC_DATA, changed)
+        eq_(license_pool, license_pool2)
+        eq_(7, license_pool.licenses_available)
+
+    def test_same_response_gives_same_fingerprint(self):
+        # Parsing the same response twice gives different objects,
+        # which may not even list things in the same order.
+        def parse(contributor_names):
+            bibliographic = copy.deepcopy(self.BIBLIOGRAPHIC_DATA)
+            bibliographic.contributors = [
+                ContributorData(sort_name=x, roles=[Contributor.AUTHOR_ROLE])
+                for x in contributor_names
+            ]
+            availability = CirculationData(
+                licenses_owned=9,
+                licenses_available=8,
+                licenses_reserved=0,
+                patrons_in_hold_queue=0,
+                last_checked=datetime.datetime.utcnow(),
+            )
+            return bibliographic, availability
+        names = [u"McCain, John", u"Salter, Mark"]
+        bibliographic, availability = parse(names)
+        bibliographic2, availability2 = parse(list(reversed(names)))
+
+        # But their fingerprints are the same.
+        fingerprint = PayloadFingerprints.fingerprint
+        payload = Axis360CirculationMonitor.availability_payload
+        eq_(fingerprint(payload(availability)),
+            fingerprint(payload(availability2)))
+
+        # So the second one is skipped.
+        monitor = Axis360CirculationMonitor(self._db)
+        monitor.api = None
+        edition, license_pool = monitor.process_book(
+            bibliographic, availability)
+        monitor.commit()
+        eq_((None, None), monitor.process_book(bibliographic2, availability2))
+
 class TestResponseParser(object):
 
     base_path = os.path.split(__file__)[0]
@@ -0,0 +1,65 @@
+from nose.tools import (
+    eq_,
+    set_trace,
+)
+import gzip
+from StringIO import StringIO
+
+from flask import Response
+
+from api.compression import CompressedVariants
+
+
+class TestCompressedVariants(object):
+
+    def setup(self):
+        self.variants = CompressedVariants(max_documents=2)
+        self.document = "<feed>" + ("<entry/>" * 500) + "</feed>"
+
+    def test_acceptable_encodings(self):
+        m = CompressedVariants.acceptable_encodings
+        eq_([], m(None))
+        eq_([], m("identity"))
+        eq_(["gzip"], m("gzip, deflate"))
+        eq_([], m("gzip;q=0"))
+        assert "gzip" in m("*")
+        if 'br' in CompressedVariants.ENCODERS:
+            eq_(["br", "gzip"], m("gzip, br"))
+            eq_(["gzip", "br"], m("gzip, br;q=0.5"))
+
+    def test_variants_are_only_compressed_once(self):
+        first = self.variants.variants(self.document)
+        assert first is self.variants.variants(self.document)
+
+        data = gzip.GzipFile(fileobj=StringIO(first['gzip'])).read()
+        eq_(self.document, data)
+
+        # The least recently used document is dropped to make room.
+        self.variants.variants("a")
+        self.variants.variants("b")
+        assert first is not self.variants.variants(self.document)
+
+    def test_compress_response(self):
+        response = self.variants.compress_response(
+            Response(self.document, 200), "gzip"
+        )
+        eq_("gzip", response.headers['Content-Encoding'])
+        assert "Accept-Encoding" in response.headers['Vary']
+        eq_(self.variants.variants(self.document)['gzip'], response.data)
+
+        # A client that doesn't ask for compression gets the document
+        # as is, but is still told the response varies.
+        response = self.variants.compress_response(
+            Response(self.document, 200), None
+        )
+        assert 'Content-Encoding' not in response.headers
+        assert "Accept-Encoding" in response.headers['Vary']
+        eq_(self.document, response.data)
+
+        # Small documents and errors are left alone.
+        response = self.variants.compress_response(Response("tiny"), "gzip")
+        assert 'Content-Encoding' not in response.headers
+        response = self.variants.compress_response(
+            Response(self.document, 404), "gzip"
+        )
+        assert 'Content-Encoding' not in response.headers
@@ -0,0 +1,66 @@
+from nose.tools import (
+    eq_,
+    set_trace,
+    assert_raises,
+)
+
+from api.config import (
+    Configuration,
+    ConfigurationSnapshot,
+    temp_config,
+)
+
+class TestConfigurationSnapshot(object):
+
+    def test_snapshot_reused_until_configuration_changes(self):
+        with temp_config() as config:
+            config[Configuration.POLICIES] = {
+                Configuration.HOLD_POLICY : Configuration.HOLD_POLICY_HIDE
+            }
+            snapshot = Configuration.snapshot()
+            eq_(False, snapshot.holds_allowed)
+
+            # Asking again gives the same object.
+            assert snapshot is Configuration.snapshot()
+
+            # Replacing the configuration gives a new snapshot.
+            with temp_config() as config2:
+                config2[Configuration.POLICIES] = {
+                    Configuration.HOLD_POLICY : Configuration.HOLD_POLICY_ALLOW
+                }
+                eq_(True, Configuration.snapshot().holds_allowed)
+
+            # Once the old configuration is back, so is the old policy.
+            eq_(False, Configuration.snapshot().holds_allowed)
+
+    def test_refresh_snapshot(self):
+        with temp_config() as config:
+            config[Configuration.POLICIES] = {
+                Configuration.HOLD_POLICY : Configuration.HOLD_POLICY_HIDE
+            }
+            snapshot = Configuration.snapshot()
+
+            # Changing the configuration in place doesn't change the
+            # snapshot until it's refreshed.
+            config[Configuration.POLICIES] = {
+                Configuration.HOLD_POLICY : Configuration.HOLD_POLICY_ALLOW
+            }
+            assert snapshot is Configuration.snapshot()
+            refreshed = Configuration.refresh_snapshot()
+            eq_(True, refreshed.holds_allowed)
+            assert refreshed is Configuration.snapshot()
+
+    def test_configuration_links(self):
+        with temp_config() as config:
+            config['links'] = {
+                "terms_of_service": "a",
+                "about": "d",
+            }
+            snapshot = ConfigurationSnapshot.from_configuration()
+            eq_((("terms-of-service", "a"), ("about", "d")),
+                snapshot.configuration_links)
+
+    def test_snapshot_is_immutable(self):
+        snapshot = Configuration.snapshot()
+        assert_raises(AttributeError, setattr, snapshot, 'hold_policy', 'x')
+        assert_raises(AttributeError, setattr, snapshot, 'new_field', 'x')
@@ -6,12 +6,15 @@ from nose.tools import (
 from contextlib import contextmanager
 import os
 import datetime
+import gzip
+from StringIO import StringIO
 
 import flask
 from flask import url_for
 from flask_sqlalchemy_session import current_session
 
 from . import DatabaseTest
+from api.search_cache import SearchIndexGeneration
 from api.config import (
     Configuration,
     temp_config,
@@ -36,6 +39,7 @@ from core.model import (
     Complaint,
     SessionManager,
     CachedFeed,
+    CirculationEvent,
     Work,
     get_one,
     create,
@@ -60,11 +64,16 @@ from core.opds import (
     OPDSFeed,
     AcquisitionFeed,
 )
-from api.opds import CirculationManagerAnnotator
+from api.opds import (
+    ChangesFeed,
+    CirculationManagerAnnotator,
+    CompactCirculationManagerAnnotator,
+)
 from api.admin.oauth import DummyGoogleClient
 from lxml import etree
 import random
 import json
+import urllib
 
 class TestCirculationManager(CirculationManager):
 
@@ -261,6 +270,46 @@ class TestBaseController(CirculationControllerTest):
         eq_(FORBIDDEN_BY_POLICY.uri, problem.uri)
 
 
+class TestConfigurationReload(ControllerTest):
+
+    def test_reload_refreshes_configuration_snapshot(self):
+        with temp_config() as config:
+            config[Configuration.POLICIES] = {
+                Configuration.HOLD_POLICY : Configuration.HOLD_POLICY_HIDE
+            }
+            config[Configuration.INTEGRATIONS] = {
+                Configuration.CIRCULATION_MANAGER_INTEGRATION : {
+                    "url": 'http://test-circulation-manager/'
+                }
+            }
+            eq_(False, Configuration.snapshot().holds_allowed)
+
+            # Loading the configuration file changes the existing
+            # configuration object rather than replacing it.
+            def load(cls):
+                config[Configuration.POLICIES] = {
+                    Configuration.HOLD_POLICY : Configuration.HOLD_POLICY_ALLOW
+                }
+                config['links'] = {"terms_of_service": "http://terms/"}
+            original_load = Configuration.__dict__['load']
+            Configuration.load = classmethod(load)
+            try:
+                # Nothing happens until someone asks for a reload.
+                eq_(False, self.manager.reload_configuration_if_requested())
+                eq_(False, Configuration.snapshot().holds_allowed)
+
+                self.manager.reload_requested = True
+                eq_(True, self.manager.reload_configuration_if_requested())
+                eq_(False, self.manager.reload_requested)
+
+                # The snapshot, and everything built from it, reflects
+                # the new configuration.
+                eq_(True, Configuration.snapshot().holds_allowed)
+                assert "http://terms/" in self.manager.opds_authentication_document
+            finally:
+                Configuration.load = original_load
+
+
 class TestIndexController(CirculationControllerTest):
     
     def test_simple_redirect(self):
@@ -546,6 +595,7 @@ class TestLoanController(CirculationControllerTest):
                 "/", headers=dict(Authorization=self.valid_auth)):
             patron = self.manager.loans.authenticated_patron_from_request()
             response = self.manager.loans.sync()
+            assert response.is_streamed
             assert not "<entry>" in response.data
             assert response.headers['Cache-Control'].startswith('private,')
 
@@ -618,6 +668,102 @@ class TestLoanController(CirculationControllerTest):
             eq_(1, len(account_links))
             assert 'me' in account_links[0]['href']
 
+    def test_active_loans_conditional_get(self):
+        auth = dict(Authorization=self.valid_auth)
+        with self.app.test_request_context("/", headers=auth):
+            self.manager.loans.authenticated_patron_from_request()
+            response = self.manager.loans.sync()
+            etag = response.headers['ETag']
+
+        # Nothing has changed, so the feed isn't sent again.
+        headers = dict(auth)
+        headers['If-None-Match'] = etag
+        with self.app.test_request_context("/", headers=headers):
+            self.manager.loans.authenticated_patron_from_request()
+            response = self.manager.loans.sync()
+            eq_(304, response.status_code)
+            eq_(etag, response.headers['ETag'])
+
+        # Once the patron has a new loan, the shelf has a new version.
+        [pool] = self.english_1.license_pools
+        loan = LoanInfo(
+            pool.identifier.type, pool.identifier.identifier,
+            datetime.datetime.utcnow(),
+            datetime.datetime.utcnow() + datetime.timedelta(seconds=3600),
+        )
+        self.manager.circulation.set_patron_activity([loan], [])
+        with self.app.test_request_context("/", headers=headers):
+            self.manager.loans.authenticated_patron_from_request()
+            response = self.manager.loans.sync()
+            eq_(200, response.status_code)
+            assert etag != response.headers['ETag']
+            assert self.english_1.title in response.data
+
+    def test_active_loans_etag_depends_on_representation(self):
+        auth = dict(Authorization=self.valid_auth)
+        etags = []
+        for accept in ("application/atom+xml", "application/opds+json"):
+            headers = dict(auth)
+            headers['Accept'] = accept
+            with self.app.test_request_context("/", headers=headers):
+                self.manager.loans.authenticated_patron_from_request()
+                response = self.manager.loans.sync()
+                eq_('Accept', response.headers['Vary'])
+                etags.append(response.headers['ETag'])
+        assert etags[0] != etags[1]
+
+        # The Atom ETag can't be used to get a 304 for the JSON feed.
+        headers = dict(auth)
+        headers['Accept'] = "application/opds+json"
+        headers['If-None-Match'] = etags[0]
+        with self.app.test_request_context("/", headers=headers):
+            self.manager.loans.authenticated_patron_from_request()
+            eq_(200, self.manager.loans.sync().status_code)
+
+class TestWorkLookupController(CirculationControllerTest):
+
+    def test_work_lookup(self):
+        urn_1 = self.english_1.primary_edition.primary_identifier.urn
+        urn_2 = self.english_2.primary_edition.primary_identifier.urn
+        missing = "urn:isbn:9780000000000"
+        annotator = CirculationManagerAnnotator(None, None, test_mode=True)
+
+        url = "/?" + "&".join(
+            "urn=%s" % urllib.quote(x) for x in [urn_1, urn_2, urn_1, missing]
+        )
+        with self.app.test_request_context(url):
+            response = self.manager.urn_lookup.work_lookup(annotator, 'work')
+            feed = feedparser.parse(response.data)
+            eq_([self.english_1.title, self.english_2.title],
+                [x['title'] for x in feed['entries']])
+            eq_([urn_1, urn_2], [x['id'] for x in feed['entries']])
+            assert missing in response.data
+            assert "404" in response.data
+
+        # The URNs we found are remembered for next time.
+        controller = self.manager.urn_lookup
+        eq_(set([urn_1, urn_2]), set(controller.ids_by_urn.keys()))
+        eq_(self.english_1.id, controller.ids_by_urn[urn_1][2])
+
+    def test_two_urns_for_the_same_work(self):
+        urn_1 = self.english_1.primary_edition.primary_identifier.urn
+        edition, pool = self._edition(with_license_pool=True)
+        pool.work = self.english_1
+        urn_2 = pool.identifier.urn
+        annotator = CirculationManagerAnnotator(None, None, test_mode=True)
+
+        url = "/?" + "&".join(
+            "urn=%s" % urllib.quote(x) for x in [urn_1, urn_2]
+        )
+        with self.app.test_request_context(url):
+            response = self.manager.urn_lookup.work_lookup(annotator, 'work')
+            feed = feedparser.parse(response.data)
+
+        # Each URN gets its own entry, identified by that URN.
+        eq_([urn_1, urn_2], [x['id'] for x in feed['entries']])
+        eq_([self.english_1.title] * 2, [x['title'] for x in feed['entries']])
+
+
 class TestWorkController(CirculationControllerTest):
     def setup(self):
         super(TestWorkController, self).setup()
@@ -625,6 +771,33 @@ class TestWorkController(CirculationControllerTest):
         self.datasource = self.lp.data_source.name
         self.identifier = self.lp.identifier.identifier
 
+    def test_availability(self):
+        self.lp.licenses_owned = 5
+        self.lp.licenses_available = 2
+        self.lp.patrons_in_hold_queue = 1
+        expect = dict(
+            data_source=self.datasource, identifier=self.identifier,
+            licenses_owned=5, licenses_available=2, patrons_in_hold_queue=1,
+        )
+
+        url = "/?book=%s&book=%s" % (
+            urllib.quote("%s/%s" % (self.datasource, self.identifier)),
+            urllib.quote("%s/nosuchbook" % self.datasource),
+        )
+        with self.app.test_request_context(url):
+            response = self.manager.work_controller.availability()
+            eq_("application/json", response.headers['Content-Type'])
+            eq_(dict(availability=[expect]), json.loads(response.data))
+
+        body = json.dumps([[self.datasource, self.identifier]])
+        with self.app.test_request_context("/", method="POST", data=body):
+            response = self.manager.work_controller.availability()
+            eq_(dict(availability=[expect]), json.loads(response.data))
+
+        with self.app.test_request_context("/?book=nodatasource"):
+            response = self.manager.work_controller.availability()
+            eq_(400, response.status_code)
+
     def test_permalink(self):
         with self.app.test_request_context("/"):
             response = self.manager.work_controller.permalink(self.datasource, self.identifier)
@@ -705,7 +878,8 @@ class TestFeedController(CirculationControllerTest):
 
             links = feed['feed']['links']
             next_link = [x for x in links if x['rel'] == 'next'][0]['href']
-            assert 'after=1' in next_link
+            assert 'key=' in next_link
+            assert 'after=' not in next_link
             assert 'size=1' in next_link
 
             facet_links = [x for x in links if x['rel'] == 'http://opds-spec.org/facet']
@@ -718,6 +892,202 @@ class TestFeedController(CirculationControllerTest):
             shelf_link = [x for x in links if x['rel'] == 'http://opds-spec.org/shelf'][0]['href']
             assert shelf_link.endswith('/loans/')
 
+    def test_opds2_feed(self):
+        SessionManager.refresh_materialized_views(self._db)
+        with self.app.test_request_context(
+                "/", headers={"Accept": "application/opds+json"}):
+            response = self.manager.opds_feeds.feed('eng', 'Adult Fiction')
+            eq_("application/opds+json", response.headers['Content-Type'])
+            document = json.loads(response.data)
+            assert len(document['publications']) > 0
+            assert 'next' in [x.get('rel') for x in document['links']]
+
+    def test_negotiated_feeds_vary_on_accept(self):
+        SessionManager.refresh_materialized_views(self._db)
+        for accept in ("application/atom+xml", "application/opds+json"):
+            with self.app.test_request_context(
+                    "/", headers={"Accept": accept,
+                                  "Accept-Encoding": "gzip"}):
+                for response in (
+                    self.manager.opds_feeds.feed('eng', 'Adult Fiction'),
+                    self.manager.opds_feeds.groups(None, None),
+                ):
+                    vary = response.headers['Vary']
+                    assert 'Accept' in [x.strip() for x in vary.split(',')]
+                    assert 'Accept-Encoding' in vary
+
+    def test_compact_feed(self):
+        SessionManager.refresh_materialized_views(self._db)
+        with self.app.test_request_context("/?entries=compact"):
+            response = self.manager.opds_feeds.feed('eng', 'Adult Fiction')
+            feed = feedparser.parse(response.data)
+            assert len(feed['entries']) > 0
+            for entry in feed['entries']:
+                assert 'issues' not in [x['rel'] for x in entry['links']]
+            [next_link] = [x['href'] for x in feed['feed']['links']
+                           if x['rel'] == 'next']
+            assert 'entries=compact' in next_link
+
+    def test_compact_entries_requested(self):
+        requested = self.manager.opds_feeds.compact_entries_requested
+        profile = CompactCirculationManagerAnnotator.PROFILE
+
+        # By query parameter.
+        with self.app.test_request_context("/?entries=compact"):
+            eq_(True, requested())
+
+        # By a profile on one of the media types in the Accept header.
+        for accept in (
+                'application/atom+xml;profile="%s"' % profile,
+                'application/json, application/atom+xml;profile=%s;q=0.9' % profile,
+        ):
+            with self.app.test_request_context(
+                    "/", headers={"Accept": accept}):
+                eq_(True, requested())
+
+        # Any other Accept header gets full entries.
+        for accept in (
+                "application/atom+xml",
+                "application/atom+xml;entries=compact",
+                'application/atom+xml;profile="%s";q=0' % profile,
+        ):
+            with self.app.test_request_context(
+                    "/", headers={"Accept": accept}):
+                eq_(False, requested())
+        with self.app.test_request_context("/"):
+            eq_(False, requested())
+
+    def test_compact_feed_by_accept_profile(self):
+        SessionManager.refresh_materialized_views(self._db)
+        accept = 'application/atom+xml;profile="%s"' % (
+            CompactCirculationManagerAnnotator.PROFILE
+        )
+        with self.app.test_request_context(
+                "/", headers={"Accept": accept}):
+            response = self.manager.opds_feeds.feed('eng', 'Adult Fiction')
+            feed = feedparser.parse(response.data)
+            assert len(feed['entries']) > 0
+            for entry in feed['entries']:
+                assert 'issues' not in [x['rel'] for x in entry['links']]
+
+            # The same URL gives full entries to other clients, so the
+            # response varies by Accept.
+            vary = response.headers['Vary']
+            assert 'Accept' in [x.strip() for x in vary.split(',')]
+
+    def test_feed_is_compressed_on_request(self):
+        SessionManager.refresh_materialized_views(self._db)
+        with self.app.test_request_context(
+                "/", headers={"Accept-Encoding": "gzip"}):
+            response = self.manager.opds_feeds.feed('eng', 'Adult Fiction')
+            eq_("gzip", response.headers['Content-Encoding'])
+            assert 'Accept-Encoding' in response.headers['Vary']
+            feed = feedparser.parse(
+                gzip.GzipFile(fileobj=StringIO(response.data)).read()
+            )
+            assert len(feed['entries']) > 0
+
+    def test_keyset_pagination_walks_the_feed(self):
+        self._work("A work", language="eng", fiction=True, with_open_access_download=True)
+        self._work("B work", language="eng", fiction=True, with_open_access_download=True)
+        SessionManager.refresh_materialized_views(self._db)
+
+        with self.app.test_request_context("/?size=1&order=title"):
+            response = self.manager.opds_feeds.feed('eng', 'Adult Fiction')
+            feed = feedparser.parse(response.data)
+            eq_(["A work"], [x['title'] for x in feed['entries']])
+            next_link = [x for x in feed['feed']['links']
+                         if x['rel'] == 'next'][0]['href']
+
+        query = next_link[next_link.index('?'):]
+        with self.app.test_request_context("/" + query):
+            response = self.manager.opds_feeds.feed('eng', 'Adult Fiction')
+            feed = feedparser.parse(response.data)
+            eq_(["B work"], [x['title'] for x in feed['entries']])
+
+    def test_keyset_pagination_handles_null_and_empty_sort_keys(self):
+        for title, author in (("Null A", None), ("Null B", None),
+                              ("Empty A", u''), ("Empty B", u'')):
+            work = self._work(title, language="eng", fiction=True,
+                              with_open_access_download=True)
+            work.primary_edition.sort_author = author
+        SessionManager.refresh_materialized_views(self._db)
+
+        # Walk the whole feed one entry at a time.
+        titles = []
+        url = "/?size=1&order=author"
+        for i in range(20):
+            with self.app.test_request_context(url):
+                response = self.manager.opds_feeds.feed('eng', 'Adult Fiction')
+                feed = feedparser.parse(response.data)
+            titles.extend([x['title'] for x in feed['entries']])
+            next_links = [x['href'] for x in feed['feed']['links']
+                          if x['rel'] == 'next']
+            if not feed['entries'] or not next_links:
+                break
+            url = "/" + next_links[0][next_links[0].index('?'):]
+
+        # NULL authors come first, then empty authors, and no work is
+        # skipped or repeated at the boundaries between them.
+        eq_(["Null A", "Null B", "Empty A", "Empty B"], titles[:4])
+        eq_(len(titles), len(set(titles)))
+
+    def test_offset_pagination_still_supported(self):
+        self._work("fiction work", language="eng", fiction=True, with_open_access_download=True)
+        SessionManager.refresh_materialized_views(self._db)
+        with self.app.test_request_context("/?after=0&size=1"):
+            response = self.manager.opds_feeds.feed('eng', 'Adult Fiction')
+            feed = feedparser.parse(response.data)
+            next_link = [x for x in feed['feed']['links']
+                         if x['rel'] == 'next'][0]['href']
+            assert 'after=1' in next_link
+            assert 'key=' not in next_link
+
+    def test_bad_pagination_key_gives_problem_detail(self):
+        with self.app.test_request_context("/?key=notakey"):
+            response = self.manager.opds_feeds.feed('eng', 'Adult Fiction')
+            eq_(400, response.status_code)
+            eq_(
+                "http://librarysimplified.org/terms/problem/invalid-input",
+                response.uri
+            )
+
+    def test_malformed_pagination_key_gives_problem_detail(self):
+        def encode(values):
+            return base64.urlsafe_b64encode(json.dumps(values))
+        for order, values in (
+                # Dates that aren't dates.
+                ("added", [{}, 1]),
+                ("added", [{"date": 5}, 1]),
+                ("added", [{"date": "yesterday"}, 1]),
+                ("added", ["2016-01-01T00:00:00.000000", 1]),
+                # Titles and authors that aren't strings.
+                ("title", [{"date": "2016-01-01T00:00:00.000000"}, "b", 1]),
+                ("title", [5, "b", 1]),
+                ("author", ["a", [], 1]),
+                # Bad work IDs.
+                ("title", ["a", "b", "1"]),
+                ("title", ["a", "b", None]),
+                ("title", ["a", "b", True]),
+                # The wrong number of values.
+                ("title", ["a", 1]),
+                ("title", {"a": 1}),
+        ):
+            url = "/?order=%s&key=%s" % (order, encode(values))
+            with self.app.test_request_context(url):
+                response = self.manager.opds_feeds.feed('eng', 'Adult Fiction')
+                eq_(400, response.status_code)
+                eq_(
+                    "http://librarysimplified.org/terms/problem/invalid-input",
+                    response.uri
+                )
+
+        # A key with NULLs in it is fine.
+        url = "/?order=title&key=%s" % encode([None, None, 1])
+        with self.app.test_request_context(url):
+            response = self.manager.opds_feeds.feed('eng', 'Adult Fiction')
+            eq_(200, response.status_code)
+
     def test_bad_order_gives_problem_detail(self):
         with self.app.test_request_context("/?order=nosuchorder"):
             response = self.manager.opds_feeds.feed('eng', 'Adult Fiction')
@@ -794,6 +1164,107 @@ class TestFeedController(CirculationControllerTest):
             previous_links = [link for link in feed['feed']['links'] if link.rel == 'previous']
             eq_(1, len(previous_links))
 
+    def test_opensearch_document(self):
+        with self.app.test_request_context("/"):
+            response = self.manager.opds_feeds.search('eng', 'Adult Fiction')
+            eq_(200, response.status_code)
+            eq_("application/opensearchdescription+xml",
+                response.headers['Content-Type'])
+            assert "max-age=" in response.headers['Cache-Control']
+            etag = response.headers['ETag']
+            assert 'OpenSearchDescription' in response.data
+
+        with self.app.test_request_context(
+                "/", headers={"If-None-Match": etag}):
+            response = self.manager.opds_feeds.search('eng', 'Adult Fiction')
+            eq_(304, response.status_code)
+            eq_(etag, response.headers['ETag'])
+
+    def test_changes(self):
+        long_ago = datetime.datetime(2000, 1, 1)
+        for work in self._db.query(Work):
+            work.last_update_time = long_ago
+            for pool in work.license_pools:
+                pool.last_checked = long_ago
+        recently = datetime.datetime(2015, 6, 1)
+        [pool] = self.english_1.license_pools
+        CirculationEvent.log(
+            self._db, pool, CirculationEvent.CHECKOUT, 1, 0, start=recently
+        )
+        self.english_2.last_update_time = recently
+
+        # A monitor checked on this book, but nothing changed.
+        [unchanged] = self.french_1.license_pools
+        unchanged.last_checked = recently
+
+        with self.app.test_request_context(
+                "/?since=2015-01-01T00:00:00Z&until=2016-01-01T00:00:00Z&size=1"):
+            response = self.manager.opds_feeds.changes()
+            feed = feedparser.parse(response.data)
+            eq_([self.english_1.title], [x['title'] for x in feed['entries']])
+            [next_link] = [x['href'] for x in feed['feed']['links']
+                           if x['rel'] == 'next']
+            assert 'after_work=%d' % self.english_1.id in next_link
+            assert 'until=2016-01-01' in next_link
+
+        query = next_link[next_link.index('?'):]
+        with self.app.test_request_context("/" + query):
+            response = self.manager.opds_feeds.changes()
+            feed = feedparser.parse(response.data)
+            eq_([self.english_2.title], [x['title'] for x in feed['entries']])
+
+        with self.app.test_request_context("/?since=yesterday"):
+            response = self.manager.opds_feeds.changes()
+            eq_(400, response.status_code)
+
+    def test_changes_include_removed_works(self):
+        long_ago = datetime.datetime(2000, 1, 1)
+        for work in self._db.query(Work):
+            work.last_update_time = long_ago
+        recently = datetime.datetime(2015, 6, 1)
+
+        # This work was withdrawn: it lost its last license, and it's
+        # no longer presentation-ready.
+        [pool] = self.english_1.license_pools
+        CirculationEvent.log(
+            self._db, pool, CirculationEvent.LICENSE_REMOVE, 1, 0,
+            start=recently
+        )
+        self.english_1.presentation_ready = False
+
+        # This work changed, and it's still around.
+        self.english_2.last_update_time = recently
+
+        with self.app.test_request_context(
+                "/?since=2015-01-01T00:00:00Z&until=2016-01-01T00:00:00Z"):
+            response = self.manager.opds_feeds.changes()
+
+        # The work that's still around gets an entry. The withdrawn
+        # work gets a tombstone, so clients know to drop it.
+        feed = feedparser.parse(response.data)
+        eq_([self.english_2.title], [x['title'] for x in feed['entries']])
+        root = etree.fromstring(response.data)
+        [tombstone] = root.findall(
+            "{%s}deleted-entry" % ChangesFeed.TOMBSTONES_NS
+        )
+        eq_(self.english_1.primary_edition.primary_identifier.urn,
+            tombstone.get('ref'))
+        eq_("2016-01-01T00:00:00Z", tombstone.get('when'))
+
+    def test_suggest(self):
+        work = self._work("Moby Dick", language="eng", fiction=True,
+                          with_open_access_download=True)
+        SearchIndexGeneration.bump(self._db)
+        # In production a background thread does this.
+        self.manager.suggestions.generation_check_interval = 0
+        self.manager.suggestions.update_if_needed()
+
+        with self.app.test_request_context("/?q=moby"):
+            response = self.manager.opds_feeds.suggest('eng', 'Adult Fiction')
+            eq_("application/x-suggestions+json",
+                response.headers['Content-Type'])
+            eq_(["moby", ["Moby Dick"]], json.loads(response.data))
+
     def test_preload(self):
         SessionManager.refresh_materialized_views(self._db)
 
@@ -807,6 +1278,22 @@ class TestFeedController(CirculationControllerTest):
                 assert self.english_1.title not in response.data
                 assert self.english_2.title in response.data
                 assert self.french_1.author not in response.data
+                etag = response.headers['ETag']
+
+            # The feed is reused until the configuration changes.
+            with self.app.test_request_context(
+                    "/", headers={"If-None-Match": etag}):
+                response = self.manager.opds_feeds.preload()
+                eq_(304, response.status_code)
+
+            urn = self.english_1.primary_edition.primary_identifier.urn
+            config[Configuration.POLICIES][Configuration.PRELOADED_CONTENT] = [urn]
+            with self.app.test_request_context(
+                    "/", headers={"If-None-Match": etag}):
+                response = self.manager.opds_feeds.preload()
+                eq_(200, response.status_code)
+                assert self.english_1.title in response.data
+                assert self.english_2.title not in response.data
 
 
 class TestScopedSession(ControllerTest):
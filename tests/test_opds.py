@@ -1,7 +1,9 @@
 import datetime
 import os
 import re
+from contextlib import contextmanager
 from lxml import etree
+from sqlalchemy import event
 from nose.tools import (
     set_trace,
     eq_,
@@ -40,6 +42,8 @@ from api.config import (
 from api.opds import (
     CirculationManagerAnnotator,
     CirculationManagerLoanAndHoldAnnotator,
+    CompactCirculationManagerAnnotator,
+    StreamingAcquisitionFeed,
 )
 from core.opds import (
     AcquisitionFeed,
@@ -48,6 +52,21 @@ from core.opds import (
 
 from core.util.cdn import cdnify
 
+@contextmanager
+def count_queries(_db):
+    """Collect the SQL statements sent through the given session."""
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+    connection = _db.connection()
+    event.listen(connection, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(
+            connection, "before_cursor_execute", before_cursor_execute
+        )
+
 class TestCirculationManagerAnnotator(DatabaseTest):
 
     def setup(self):
@@ -283,6 +302,34 @@ class TestOPDS(DatabaseTest):
         eq_(now_s, has_until.attrib['since'])
         eq_(tomorrow_s, has_until.attrib['until'])
 
+    def test_active_loan_feed_query_count_does_not_grow_with_shelf(self):
+        patron = self._patron()
+        now = datetime.datetime.utcnow()
+
+        def queries_to_render():
+            # Render once to fill in any cached entries, then make
+            # sure nothing is left over in the session before counting.
+            unicode(CirculationManagerLoanAndHoldAnnotator.active_loans_for(
+                None, patron, test_mode=True))
+            self._db.commit()
+            self._db.expire_all()
+            with count_queries(self._db) as statements:
+                unicode(CirculationManagerLoanAndHoldAnnotator.active_loans_for(
+                    None, patron, test_mode=True))
+            return len(statements)
+
+        work = self._work(language="eng", with_open_access_download=True)
+        work.license_pools[0].loan_to(patron, start=now)
+        one_loan = queries_to_render()
+
+        for i in range(3):
+            work = self._work(language="eng", with_open_access_download=True)
+            work.license_pools[0].loan_to(patron, start=now)
+        for i in range(2):
+            work = self._work(language="eng", with_license_pool=True)
+            work.license_pools[0].on_hold_to(patron, start=now, position=1)
+        eq_(one_loan, queries_to_render())
+
     def test_loan_feed_includes_patron(self):
         patron = self._patron()
         patron.username = u'bellhooks'
@@ -336,3 +383,72 @@ class TestOPDS(DatabaseTest):
         copies_re = re.compile('<opds:copies[^>]+total="100"', re.S)
         assert copies_re.search(u) is not None
 
+
+class TestStreamingAcquisitionFeed(DatabaseTest):
+
+    def test_serialize(self):
+        w1 = self._work(with_open_access_download=True)
+        w2 = self._work(with_open_access_download=True)
+        annotator = CirculationManagerAnnotator(None, Fantasy, test_mode=True)
+        feed = StreamingAcquisitionFeed(
+            self._db, "test", "url", [w1, w2], annotator
+        )
+
+        # The feed is sent in four pieces: the feed-level elements,
+        # one piece for each entry, and the closing tag.
+        chunks = list(feed.serialize())
+        eq_(4, len(chunks))
+        assert "<entry" not in chunks[0]
+        eq_("</feed>", chunks[-1])
+
+        # Put together, the pieces make a normal feed.
+        parsed = feedparser.parse(unicode(feed))
+        eq_(set([w1.title, w2.title]),
+            set([x['title'] for x in parsed['entries']]))
+
+
+class TestCompactCirculationManagerAnnotator(DatabaseTest):
+
+    def test_compact_entries(self):
+        work = self._work(with_open_access_download=True)
+        work.summary_text = u"A very long summary."
+        full = AcquisitionFeed(
+            self._db, "test", "url", [work],
+            CirculationManagerAnnotator(None, Fantasy, test_mode=True)
+        )
+        compact = AcquisitionFeed(
+            self._db, "test", "url", [work],
+            CompactCirculationManagerAnnotator(None, Fantasy, test_mode=True)
+        )
+        [full_entry] = feedparser.parse(unicode(full))['entries']
+        [compact_entry] = feedparser.parse(unicode(compact))['entries']
+
+        eq_(full_entry['title'], compact_entry['title'])
+        assert 'summary' not in compact_entry
+        assert 'tags' not in compact_entry
+        rels = [x['rel'] for x in compact_entry['links']]
+        assert 'issues' in [x['rel'] for x in full_entry['links']]
+        assert 'issues' not in rels
+        assert 'alternate' in rels
+        acquisition_rels = [
+            x for x in rels if x.startswith("http://opds-spec.org/acquisition")
+        ]
+        eq_(1, len(acquisition_rels))
+        assert len(unicode(compact)) < len(unicode(full))
+
+    def test_compact_feed(self):
+        work = self._work(with_open_access_download=True)
+        feed = AcquisitionFeed(
+            self._db, "test", "http://host/feed", [work],
+            CirculationManagerAnnotator(None, Fantasy, test_mode=True)
+        )
+        feed.add_link(rel="next", href="http://host/feed?after=1")
+        compact = CompactCirculationManagerAnnotator.compact_feed(
+            unicode(feed)
+        )
+        parsed = feedparser.parse(compact)
+        [next_link] = [x['href'] for x in parsed['feed']['links']
+                       if x['rel'] == 'next']
+        eq_("http://host/feed?after=1&entries=compact", next_link)
+        [entry] = parsed['entries']
+        assert 'issues' not in [x['rel'] for x in entry['links']]
@@ -0,0 +1,74 @@
+from nose.tools import (
+    eq_,
+    set_trace,
+)
+import json
+
+from . import DatabaseTest
+from core.opds import AcquisitionFeed
+from api.opds import CirculationManagerAnnotator
+from api.opds2 import OPDS2Serializer
+
+
+class TestOPDS2Serializer(DatabaseTest):
+
+    def setup(self):
+        super(TestOPDS2Serializer, self).setup()
+        self.work = self._work(with_open_access_download=True)
+        self.annotator = CirculationManagerAnnotator(None, None, test_mode=True)
+
+    def test_link(self):
+        tag = AcquisitionFeed.link(
+            rel="http://opds-spec.org/acquisition/borrow",
+            href="http://borrow/", type="application/atom+xml"
+        )
+        tag.extend(AcquisitionFeed.license_tags(
+            self.work.license_pools[0], None, None
+        ))
+        link = OPDS2Serializer.link(tag)
+        eq_("http://borrow/", link['href'])
+        eq_("http://opds-spec.org/acquisition/borrow", link['rel'])
+        assert 'state' in link['properties']['availability']
+
+    def test_publication_uses_annotator_acquisition_links(self):
+        publication = OPDS2Serializer(self.annotator).publication(self.work)
+        eq_(self.work.title, publication['metadata']['title'])
+        [pool] = self.work.license_pools
+        eq_(pool.identifier.urn, publication['metadata']['identifier'])
+
+        rels = [x['rel'] for x in publication['links']]
+        eq_('self', rels[0])
+        expect = [x.get('rel') for x in self.annotator.acquisition_links(
+            pool, None, None, AcquisitionFeed, pool.data_source.name,
+            pool.identifier.identifier
+        )]
+        eq_(expect, rels[1:])
+
+    def test_from_atom(self):
+        feed = AcquisitionFeed(
+            self._db, "A feed", "http://feed/", [self.work], self.annotator
+        )
+        document = OPDS2Serializer.from_atom(unicode(feed))
+        eq_("A feed", document['metadata']['title'])
+        [publication] = document['publications']
+        eq_(self.work.title, publication['metadata']['title'])
+        assert 'self' in [x['rel'] for x in publication['links']]
+
+        # The document survives a trip through JSON.
+        eq_(document['metadata'],
+            json.loads(OPDS2Serializer.to_json(document))['metadata'])
+
+    def test_from_atom_groups(self):
+        feed = AcquisitionFeed(
+            self._db, "Groups", "http://groups/", [self.work], self.annotator
+        )
+        [entry] = feed.feed.findall("{%s}entry" % OPDS2Serializer.ATOM_NS)
+        feed.add_link_to_entry(
+            entry, rel="collection", href="http://lane/", title="A lane"
+        )
+        document = OPDS2Serializer.from_atom(unicode(feed))
+        assert 'publications' not in document
+        [group] = document['groups']
+        eq_("A lane", group['metadata']['title'])
+        eq_("http://lane/", group['links'][0]['href'])
+        eq_(1, len(group['publications']))
@@ -8,11 +8,15 @@ import pkgutil
 import json
 from api.overdrive import (
     DummyOverdriveAPI,
+    OverdriveCirculationMonitor,
+    OverdriveCollectionReaper,
+    FullOverdriveCollectionMonitor,
 )
 
 from api.circulation import (
     CirculationAPI,
 )
+from api.rate_limit import RateLimiter
 
 from . import (
     DatabaseTest,
@@ -277,3 +281,249 @@ class TestOverdriveAPI(DatabaseTest):
         loans, holds = circulation.sync_bookshelf(patron, "dummy pin")
         eq_(5, len(patron.holds))
         assert threem_hold in patron.holds
+
+
+class MockAvailabilityAPI(object):
+    """Pretends to fetch and apply availability, recording the order
+    in which things happen.
+    """
+
+    def __init__(self, ids, changed):
+        self.ids = ids
+        self.changed = changed
+        self.applied = []
+        self.creds_checked = 0
+
+    def check_creds(self, force_refresh=False):
+        self.creds_checked += 1
+
+    def recently_changed_ids(self, start, cutoff):
+        return self.ids
+
+    def fetch_availability(self, book):
+        if book == 'broken':
+            return None
+        return dict(id=book)
+
+    def apply_availability(self, book):
+        self.applied.append(book['id'])
+        return None, False, book['id'] in self.changed
+
+
+class MockProductsAPI(MockAvailabilityAPI):
+    """Pretends to walk the collection two products per page. Applying
+    the book called 'crash' raises an exception.
+    """
+
+    def __init__(self, ids, changed=[]):
+        super(MockProductsAPI, self).__init__(ids, changed)
+        self.offsets = []
+
+    def product_pages(self, offset=0):
+        self.offsets.append(offset)
+        for i in range(offset, len(self.ids), 2):
+            yield len(self.ids), self.ids[i:i+2]
+
+    def apply_availability(self, book):
+        if book['id'] == 'crash':
+            raise Exception("Crash!")
+        return super(MockProductsAPI, self).apply_availability(book)
+
+
+class TestOverdriveCirculationMonitor(DatabaseTest):
+
+    def test_books_are_applied_in_order_in_batches(self):
+        monitor = OverdriveCirculationMonitor(self._db, batch_size=2)
+        ids = ['a', None, 'b', 'broken', 'c', 'd', 'e']
+        monitor.api = MockAvailabilityAPI(ids, changed=[])
+        commits = []
+        original_commit = self._db.commit
+        self._db.commit = lambda: commits.append(1)
+        try:
+            monitor.run_once(None, None)
+        finally:
+            self._db.commit = original_commit
+        eq_(['a', 'b', 'c', 'd', 'e'], monitor.api.applied)
+        eq_(7, monitor.total_books)
+        # The access token was checked in this thread before each
+        # batch was handed to the worker threads.
+        eq_(3, monitor.api.creds_checked)
+        # One commit per batch of two books: the empty ID doesn't count,
+        # and the book we couldn't get availability for does.
+        eq_(3, len(commits))
+
+    def test_early_stop_on_consecutive_unchanged_books(self):
+        monitor = OverdriveCirculationMonitor(
+            self._db, maximum_consecutive_unchanged_books=3, batch_size=2
+        )
+        ids = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h']
+        # 'c' resets the count, so we stop after 'd', 'e' and 'f'
+        # are unchanged, without applying anything after that.
+        monitor.api = MockAvailabilityAPI(ids, changed=['c'])
+        monitor.run_once(None, None)
+        eq_(['a', 'b', 'c', 'd', 'e', 'f'], monitor.api.applied)
+
+    def test_unchanged_payloads_are_not_applied(self):
+        monitor = OverdriveCirculationMonitor(self._db, batch_size=2)
+        monitor.api = MockAvailabilityAPI(['a', 'b', 'c'], changed=[])
+        monitor.run_once(None, None)
+        eq_(['a', 'b', 'c'], monitor.api.applied)
+
+        # Overdrive says the same thing about every book the second
+        # time around, so nothing needs to be written.
+        monitor.api.applied = []
+        monitor.run_once(None, None)
+        eq_([], monitor.api.applied)
+
+    def test_payloads_count_only_once_committed(self):
+        monitor = OverdriveCirculationMonitor(self._db, batch_size=2)
+        monitor.api = MockAvailabilityAPI(['a', 'b'], changed=[])
+
+        def fail():
+            raise Exception("Commit failed!")
+        original_commit = self._db.commit
+        self._db.commit = fail
+        try:
+            assert_raises(Exception, monitor.run_once, None, None)
+        finally:
+            self._db.commit = original_commit
+
+        # Nothing was saved, so everything is applied again.
+        monitor.api.applied = []
+        monitor.run_once(None, None)
+        eq_(['a', 'b'], monitor.api.applied)
+
+
+class TestFullOverdriveCollectionMonitor(DatabaseTest):
+
+    def test_product_pages(self):
+        api = DummyOverdriveAPI(self._db)
+        page2 = dict(totalItems=3, products=[dict(id="c")], links={})
+        page1 = dict(
+            totalItems=3,
+            products=[
+                dict(id="a", links=dict(availability=dict(href="http://a/"))),
+                dict(id="b"),
+            ],
+            links=dict(next=dict(href="http://next/"))
+        )
+        api.queue_response(content=json.dumps(page2))
+        api.queue_response(content=json.dumps(page1))
+        pages = list(api.product_pages())
+        eq_([(3, [dict(id="a", availability_link="http://a/"), "b"]),
+             (3, ["c"])], pages)
+        assert api.products_link(400).endswith("?limit=200&offset=400")
+
+    def test_sweep_resumes_from_checkpoint(self):
+        monitor = FullOverdriveCollectionMonitor(self._db)
+        monitor.batch_size = 2
+        monitor.api = MockProductsAPI(['a', 'b', 'crash', 'd'])
+        assert_raises(Exception, monitor.run_once, None, None)
+        eq_(['a', 'b'], monitor.api.applied)
+
+        # The first batch was committed and checkpointed.
+        checkpoint = monitor.checkpoint()
+        eq_(2, checkpoint.counter)
+        started = checkpoint.timestamp
+        assert started is not None
+
+        # The next run picks up after the first batch, starting with
+        # the last book processed to make sure it's still there.
+        monitor.api = MockProductsAPI(['a', 'b', 'c', 'd'])
+        monitor.run_once(None, None)
+        eq_([1], monitor.api.offsets)
+        eq_(['c', 'd'], monitor.api.applied)
+
+        # Once the sweep is done, the checkpoint is cleared so the
+        # next sweep starts from the beginning.
+        eq_(0, checkpoint.counter)
+        eq_(None, checkpoint.timestamp)
+        eq_(None, monitor.last_product().counter)
+
+    def test_sweep_starts_over_if_collection_changed(self):
+        monitor = FullOverdriveCollectionMonitor(self._db)
+        monitor.batch_size = 2
+        monitor.api = MockProductsAPI(['a', 'b', 'crash', 'd'])
+        assert_raises(Exception, monitor.run_once, None, None)
+        eq_(monitor.product_fingerprint('b'), monitor.last_product().counter)
+
+        # A book was added at the front of the collection, so 'b' is
+        # no longer the second product.
+        monitor.api = MockProductsAPI(['new', 'a', 'b', 'c', 'd'])
+        monitor.run_once(None, None)
+        # The sweep started over and went through every book.
+        eq_([1, 0], monitor.api.offsets)
+        eq_(5, monitor.total_books)
+        eq_(0, monitor.checkpoint().counter)
+
+
+class MockRateLimiter(object):
+
+    def __init__(self, available):
+        self.available = available
+        self.overdrawn = 0
+
+    def acquire(self, priority):
+        return self.available
+
+    def overdraw(self, cost=1):
+        self.overdrawn += cost
+
+
+class TestOverdriveRateLimit(DatabaseTest):
+
+    def test_patron_requests_that_cannot_wait_are_charged(self):
+        api = DummyOverdriveAPI(self._db)
+        api._rate_limiter = MockRateLimiter(True)
+        api.wait_for_rate_limit(RateLimiter.PATRON)
+        eq_(0, api._rate_limiter.overdrawn)
+
+        # The patron gave up waiting, so the request goes ahead, but
+        # it's counted against the shared budget.
+        api._rate_limiter = MockRateLimiter(False)
+        api.wait_for_rate_limit(RateLimiter.PATRON)
+        eq_(1, api._rate_limiter.overdrawn)
+
+
+class TestOverdriveCollectionReaper(DatabaseTest):
+
+    def test_bulk_availability_with_fallback(self):
+        data, raw = TestOverdriveAPI.sample_json(
+            "overdrive_availability_information.json"
+        )
+        ignore, in_bulk = self._edition(
+            data_source_name=DataSource.OVERDRIVE,
+            identifier_type=Identifier.OVERDRIVE_ID,
+            with_license_pool=True
+        )
+        ignore, not_in_bulk = self._edition(
+            data_source_name=DataSource.OVERDRIVE,
+            identifier_type=Identifier.OVERDRIVE_ID,
+            with_license_pool=True
+        )
+
+        api = DummyOverdriveAPI(self._db)
+        # Responses are popped off the end of the list, so the bulk
+        # response goes last.
+        raw['id'] = not_in_bulk.identifier.identifier
+        raw['numberOfHolds'] = 3
+        api.queue_response(content=json.dumps(raw))
+        bulk = dict(availability=[dict(
+            reserveId=in_bulk.identifier.identifier.upper(),
+            copiesOwned=7, copiesAvailable=2, numberOfHolds=0
+        )])
+        api.queue_response(content=json.dumps(bulk))
+
+        reaper = OverdriveCollectionReaper(self._db, workers=1)
+        reaper.api = api
+        reaper.process_batch(
+            [in_bulk.identifier, not_in_bulk.identifier]
+        )
+
+        # One request covered the first book; the second book needed
+        # a request of its own.
+        eq_([], api.responses)
+        eq_(7, in_bulk.licenses_owned)
+        eq_(2, in_bulk.licenses_available)
+        eq_(5, not_in_bulk.licenses_owned)
+        eq_(3, not_in_bulk.patrons_in_hold_queue)
@@ -0,0 +1,67 @@
+from nose.tools import (
+    eq_,
+    set_trace,
+)
+
+from api.payload_fingerprint import PayloadFingerprints
+
+
+class TestPayloadFingerprints(object):
+
+    def test_unchanged(self):
+        fingerprints = PayloadFingerprints()
+        payload = dict(copiesOwned=2, copiesAvailable=1)
+        eq_(False, fingerprints.unchanged("a", payload))
+        fingerprints.remember("a", payload)
+        fingerprints.commit()
+
+        # Key order doesn't matter; the values do.
+        eq_(True, fingerprints.unchanged("a", dict(copiesAvailable=1, copiesOwned=2)))
+        eq_(False, fingerprints.unchanged("a", dict(copiesOwned=2, copiesAvailable=0)))
+        eq_(False, fingerprints.unchanged("b", payload))
+
+        fingerprints.forget("a")
+        eq_(False, fingerprints.unchanged("a", payload))
+
+    def test_fingerprints_expire(self):
+        fingerprints = PayloadFingerprints(max_age=-1)
+        fingerprints.remember("a", [1, 2])
+        fingerprints.commit()
+        eq_(False, fingerprints.unchanged("a", [1, 2]))
+        eq_({}, fingerprints.fingerprints)
+
+    def test_max_entries(self):
+        fingerprints = PayloadFingerprints(max_entries=2)
+        fingerprints.remember("a", 1)
+        fingerprints.remember("b", 2)
+        fingerprints.commit()
+        fingerprints.remember("b", 3)
+        fingerprints.commit()
+        eq_(2, len(fingerprints.fingerprints))
+        fingerprints.remember("c", 4)
+        fingerprints.commit()
+        eq_(["c"], fingerprints.fingerprints.keys())
+
+    def test_only_committed_payloads_count(self):
+        fingerprints = PayloadFingerprints()
+        fingerprints.remember("a", 1)
+        eq_(False, fingerprints.unchanged("a", 1))
+
+        # The transaction failed, so the payload was never saved.
+        fingerprints.rollback()
+        fingerprints.commit()
+        eq_(False, fingerprints.unchanged("a", 1))
+
+        fingerprints.remember("a", 1)
+        fingerprints.commit()
+        eq_(True, fingerprints.unchanged("a", 1))
+
+    def test_objects_are_fingerprinted_by_their_attributes(self):
+        class Data(object):
+            def __init__(self, title):
+                self.title = title
+                self._cache = object()
+        eq_(PayloadFingerprints.fingerprint([Data(u"A")]),
+            PayloadFingerprints.fingerprint([Data(u"A")]))
+        assert (PayloadFingerprints.fingerprint([Data(u"A")]) !=
+                PayloadFingerprints.fingerprint([Data(u"B")]))
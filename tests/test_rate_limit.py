@@ -0,0 +1,77 @@
+from nose.tools import (
+    assert_raises,
+    eq_,
+    set_trace,
+)
+
+from core.model import (
+    Timestamp,
+    get_one,
+)
+
+from api.rate_limit import RateLimiter
+
+from . import DatabaseTest
+
+
+class TestRateLimiter(DatabaseTest):
+
+    def test_patrons_get_the_reserve(self):
+        # A bucket of four tokens that will take a very long time to
+        # refill. Half of it is reserved for patrons.
+        limiter = RateLimiter(self._db, "Test", 0.0001, capacity=4)
+        eq_(2, limiter.reserve)
+
+        # Background requests can use up the unreserved half.
+        eq_(True, limiter.take(RateLimiter.BACKGROUND))
+        eq_(True, limiter.take(RateLimiter.BACKGROUND))
+        eq_(False, limiter.take(RateLimiter.BACKGROUND))
+
+        # Patron requests can use the rest.
+        eq_(True, limiter.take(RateLimiter.PATRON))
+        eq_(True, limiter.take(RateLimiter.PATRON))
+        eq_(False, limiter.take(RateLimiter.PATRON))
+
+        # A patron request that can't get a token waits a while, then
+        # gives up.
+        eq_(False, limiter.acquire(RateLimiter.PATRON, max_wait=0))
+
+        # The bucket is shared by everyone using the same name.
+        timestamp = get_one(self._db, Timestamp, service="Test rate limit")
+        eq_(0, timestamp.counter)
+        other_process = RateLimiter(self._db, "Test", 0.0001, capacity=4)
+        eq_(False, other_process.take(RateLimiter.PATRON))
+
+    def test_small_buckets_still_have_a_reserve(self):
+        # Less than one request per second, with no burst configured.
+        limiter = RateLimiter(self._db, "Slow", 0.5)
+        eq_(2, limiter.capacity)
+        eq_(1, limiter.reserve)
+        eq_(True, limiter.take(RateLimiter.BACKGROUND))
+        eq_(False, limiter.take(RateLimiter.BACKGROUND))
+        eq_(True, limiter.take(RateLimiter.PATRON))
+
+        eq_(1, RateLimiter(self._db, "Small", 10, capacity=3,
+                           patron_reserve=0.1).reserve)
+        eq_(0, RateLimiter(self._db, "None", 10, patron_reserve=0).reserve)
+        assert_raises(ValueError, RateLimiter, self._db, "Tiny", 10,
+                      capacity=1)
+
+    def test_overdraft_is_paid_back_by_background_requests(self):
+        limiter = RateLimiter(self._db, "Test", 0.0001, capacity=4)
+        for i in range(4):
+            eq_(True, limiter.take(RateLimiter.PATRON))
+
+        # Two patron requests went ahead without a token.
+        limiter.overdraw()
+        limiter.overdraw()
+        timestamp = get_one(self._db, Timestamp, service="Test rate limit")
+        self._db.refresh(timestamp)
+        eq_(-2 * RateLimiter.SCALE, timestamp.counter)
+        eq_(False, limiter.take(RateLimiter.PATRON))
+        eq_(False, limiter.take(RateLimiter.BACKGROUND))
+
+    def test_bucket_refills(self):
+        limiter = RateLimiter(self._db, "Test", 1000000, capacity=2)
+        for i in range(10):
+            eq_(True, limiter.take(RateLimiter.PATRON))
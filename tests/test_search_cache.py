@@ -0,0 +1,63 @@
+from nose.tools import (
+    eq_,
+    set_trace,
+)
+
+from . import DatabaseTest
+from api.search_cache import (
+    CachingSearchClient,
+    SearchIndexGeneration,
+    normalize_query,
+)
+
+
+class MockSearchClient(object):
+
+    works_index = "works"
+
+    def __init__(self):
+        self.queries = []
+
+    def query_works(self, query_string, *args, **kwargs):
+        self.queries.append(query_string)
+        return [len(self.queries)]
+
+
+class TestSearchResultCache(DatabaseTest):
+
+    def setup(self):
+        super(TestSearchResultCache, self).setup()
+        self.search = MockSearchClient()
+        self.client = CachingSearchClient(
+            self.search, self._db, generation_check_interval=0
+        )
+
+    def test_normalize_query(self):
+        eq_("moby%20dick", normalize_query("  Moby   DICK "))
+        eq_(normalize_query(u"café"), normalize_query("CAF\xc3\x89"))
+
+    def test_equivalent_queries_share_results(self):
+        eq_([1], self.client.query_works("Moby Dick", size=10, offset=0))
+        eq_([1], self.client.query_works(" moby  dick", size=10, offset=0))
+        eq_(["Moby Dick"], self.search.queries)
+
+        # A different page is a different query.
+        eq_([2], self.client.query_works("Moby Dick", size=10, offset=10))
+
+        # Other methods go straight through to the search client.
+        eq_("works", self.client.works_index)
+
+    def test_results_expire(self):
+        self.client.ttl = -1
+        self.client.query_works("Moby Dick")
+        self.client.query_works("Moby Dick")
+        eq_(2, len(self.search.queries))
+
+    def test_index_update_invalidates_results(self):
+        self.client.query_works("Moby Dick")
+        self.client.query_works("Moby Dick")
+        eq_(1, len(self.search.queries))
+
+        eq_(1, SearchIndexGeneration.bump(self._db))
+        self.client.query_works("Moby Dick")
+        eq_(2, len(self.search.queries))
@@ -0,0 +1,133 @@
+from nose.tools import (
+    eq_,
+    set_trace,
+)
+import datetime
+
+from . import DatabaseTest
+from api.search_cache import SearchIndexGeneration
+from api.suggest import (
+    PrefixIndex,
+    SuggestionIndex,
+)
+
+
+class TestPrefixIndex(object):
+
+    def test_matches(self):
+        index = PrefixIndex()
+        index.extend([u"Moby Dick", u"Melville, Herman", u"moby  dick",
+                      u"Middlemarch", None])
+        eq_(4, len(index))
+        eq_([u"Melville, Herman"], index.matches(u"mel"))
+        eq_([u"Moby Dick", u"moby  dick"], index.matches(u" MOBY d"))
+        eq_([u"Melville, Herman"], index.matches(u"m", limit=1))
+        eq_([], index.matches(u"x"))
+        eq_([], index.matches(u""))
+
+    def test_extend_and_remove_keep_the_index_sorted(self):
+        index = PrefixIndex()
+        index.extend([u"Middlemarch", u"Moby Dick"])
+        index.extend([u"Melville, Herman", u"Moby Dick", u"Mrs. Dalloway"])
+        eq_([u"Melville, Herman", u"Middlemarch", u"Moby Dick",
+             u"Mrs. Dalloway"], index.matches(u"m"))
+
+        index.remove([u"Middlemarch", u"Not in the index"])
+        eq_([u"Melville, Herman", u"Moby Dick", u"Mrs. Dalloway"],
+            index.matches(u"m"))
+
+
+class TestSuggestionIndex(DatabaseTest):
+
+    def test_suggestions_by_language(self):
+        english = self._work(u"Moby Dick", language="eng",
+                             with_license_pool=True)
+        english.presentation_ready = True
+        index = SuggestionIndex(self._db, generation_check_interval=0)
+
+        french = self._work(u"Madame Bovary", language="fre",
+                            with_license_pool=True)
+        french.presentation_ready = True
+        french.last_update_time = datetime.datetime.utcnow()
+
+        # The new work isn't picked up until the search index changes.
+        index.update_if_needed()
+        eq_([], index.suggestions(u"ma"))
+
+        SearchIndexGeneration.bump(self._db)
+        index.update_if_needed()
+        eq_([u"Madame Bovary"], index.suggestions(u"ma"))
+        eq_([u"Madame Bovary"], index.suggestions(u"ma", ["fre"]))
+        eq_([], index.suggestions(u"ma", ["eng"]))
+        eq_([u"Moby Dick"], index.suggestions(u"mo", ["eng"]))
+
+    def _indexed_work(self, title, when):
+        work = self._work(title, language="eng", with_license_pool=True)
+        work.presentation_ready = True
+        work.last_update_time = when
+        return work
+
+    def test_changed_works_are_indexed_again(self):
+        now = datetime.datetime.utcnow()
+        retitled = self._indexed_work(u"Moby Dick", now)
+        withdrawn = self._indexed_work(u"Middlemarch", now)
+        index = SuggestionIndex(self._db, generation_check_interval=0)
+        eq_([u"Middlemarch", u"Moby Dick"], index.suggestions(u"m"))
+
+        # One work is retitled and the other is no longer presentation
+        # ready. Neither is a new work.
+        later = now + datetime.timedelta(minutes=1)
+        retitled.primary_edition.title = u"Moby-Dick; or, The Whale"
+        retitled.last_update_time = later
+        withdrawn.presentation_ready = False
+        withdrawn.last_update_time = later
+
+        SearchIndexGeneration.bump(self._db)
+        index.update_if_needed()
+        eq_([u"Moby-Dick; or, The Whale"], index.suggestions(u"m"))
+
+    def test_shared_terms_stay_until_the_last_work_goes(self):
+        now = datetime.datetime.utcnow()
+        first = self._indexed_work(u"Hamlet", now)
+        second = self._indexed_work(u"Hamlet", now)
+        index = SuggestionIndex(self._db, generation_check_interval=0)
+
+        first.presentation_ready = False
+        first.last_update_time = now + datetime.timedelta(minutes=1)
+        SearchIndexGeneration.bump(self._db)
+        index.update_if_needed()
+        eq_([u"Hamlet"], index.suggestions(u"ham"))
+
+    def test_periodic_rebuild(self):
+        now = datetime.datetime.utcnow()
+        work = self._indexed_work(u"Moby Dick", now)
+        index = SuggestionIndex(
+            self._db, generation_check_interval=0, rebuild_interval=0
+        )
+
+        # This change doesn't touch last_update_time, so only a
+        # rebuild can notice it.
+        work.presentation_ready = False
+        SearchIndexGeneration.bump(self._db)
+        index.update_if_needed()
+        eq_([], index.suggestions(u"mo"))
+
+    def test_no_update_times_does_not_force_a_rebuild(self):
+        work = self._work(u"Moby Dick", language="eng", with_license_pool=True)
+        work.presentation_ready = True
+        work.last_update_time = None
+        index = SuggestionIndex(self._db, generation_check_interval=0)
+        assert index.last_update_time is not None
+
+        rebuilds = []
+        index.rebuild = lambda _db=None: rebuilds.append(1)
+        later = self._work(u"Middlemarch", language="eng",
+                           with_license_pool=True)
+        later.presentation_ready = True
+        later.last_update_time = datetime.datetime.utcnow()
+        SearchIndexGeneration.bump(self._db)
+        index.update_if_needed()
+
+        # The new work was picked up without rebuilding the index.
+        eq_([], rebuilds)
+        eq_([u"Middlemarch", u"Moby Dick"], index.suggestions(u"m"))
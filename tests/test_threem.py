@@ -1,5 +1,6 @@
 import datetime
 import os
+import requests
 from nose.tools import (
     set_trace, eq_,
     assert_raises,
@@ -24,9 +25,11 @@ from . import (
 )
 
 from core.model import (
+    DeliveryMechanism,
     Identifier,
     Loan,
     Hold,
+    Representation,
 )
 
 class TestThreeMAPI(DatabaseTest):
@@ -41,6 +44,33 @@ class TestThreeMAPI(DatabaseTest):
         return data
 
 
+class TestFullURL(TestThreeMAPI):
+
+    def test_full_url_is_the_url_request_asks_for(self):
+        # The circulation sweep uses full_url() to keep its requests
+        # under 3M's URL length limit, so it has to agree with the URL
+        # request() actually sends.
+        api = ThreeMAPI(self._db, testing=True)
+        sent = []
+        def send(session, method, url, *args, **kwargs):
+            sent.append(url)
+            raise IOError("No network in tests.")
+        original = requests.Session.request
+        requests.Session.request = send
+        try:
+            for path in (api.CIRCULATION_PATH + "id1,id2",
+                         "circulation/items/id1"):
+                del sent[:]
+                try:
+                    api.request(path)
+                except Exception, e:
+                    pass
+                assert sent
+                eq_(set([api.full_url(path)]), set(sent))
+        finally:
+            requests.Session.request = original
+
+
 class TestPatronCirculationParser(TestThreeMAPI):
 
     def test_parse(self):
@@ -77,6 +107,36 @@ class TestPatronCirculationParser(TestThreeMAPI):
         eq_(4, h2.hold_position)
 
 
+class TestBibliographicLookupBatch(TestThreeMAPI):
+
+    def test_lookup_batch(self):
+        api = DummyThreeMAPI(self._db)
+        api.queue_response(content=self.sample_data("item_metadata_list.xml"))
+        identifiers = [
+            Identifier.for_foreign_id(self._db, Identifier.THREEM_ID, x)[0]
+            for x in ("ddf4gr9", "f4tkk89")
+        ]
+        metadata = api.bibliographic_lookup_batch(identifiers)
+        eq_(["ddf4gr9", "f4tkk89"], sorted(metadata.keys()))
+
+        ebook = metadata["ddf4gr9"]
+        eq_("The Incense Game", ebook.title)
+        [format] = ebook.formats
+        eq_(Representation.EPUB_MEDIA_TYPE, format.content_type)
+        eq_(DeliveryMechanism.ADOBE_DRM, format.drm_scheme)
+
+        [format] = metadata["f4tkk89"].formats
+        eq_(Representation.MP3_MEDIA_TYPE, format.content_type)
+
+    def test_lookup_batch_not_found(self):
+        api = DummyThreeMAPI(self._db)
+        api.queue_response(response_code=404)
+        identifier, ignore = Identifier.for_foreign_id(
+            self._db, Identifier.THREEM_ID, "nosuchbook"
+        )
+        eq_({}, api.bibliographic_lookup_batch([identifier]))
+
+
 class TestCheckoutResponseParser(TestThreeMAPI):
     def test_parse(self):
         data = self.sample_data("successful_checkout.xml")
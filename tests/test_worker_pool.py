@@ -0,0 +1,33 @@
+from nose.tools import (
+    eq_,
+    set_trace,
+)
+import time
+
+from api.worker_pool import WorkerPool
+
+
+class TestWorkerPool(object):
+
+    def test_map_preserves_order(self):
+        def slow_square(x):
+            # Make earlier items finish later.
+            time.sleep(0.001 * (10 - x))
+            return x * x
+        pool = WorkerPool(4)
+        eq_([x * x for x in range(10)], pool.map(slow_square, range(10)))
+
+    def test_exception_becomes_none(self):
+        def fails_on_odd(x):
+            if x % 2:
+                raise ValueError(x)
+            return x
+        for size in (1, 3):
+            eq_([0, None, 2, None], WorkerPool(size).map(fails_on_odd, range(4)))
+
+    def test_in_worker_thread(self):
+        in_worker = lambda x: WorkerPool.in_worker_thread()
+        eq_(False, WorkerPool.in_worker_thread())
+        eq_([True, True], WorkerPool(2).map(in_worker, range(2)))
+        # A pool of one runs everything in the calling thread.
+        eq_([False], WorkerPool(1).map(in_worker, range(1)))